@@ -7,12 +7,14 @@
 
 import os
 import sys
-import queue
+import time
 import socket
 import signal
 import logging
+import threading
 import traceback
 import multiprocessing
+import multiprocessing.connection
 
 import paramiko
 from dotmap import DotMap
@@ -20,11 +22,26 @@ from oslo_config import cfg
 from osmo.base import Application
 
 import lanus.bastion.common as cm
+from lanus.bastion.lib.credential import wipe_credential
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.metrics import MetricsExporter
+from lanus.bastion.lib.metrics import track_active
+from lanus.bastion.lib.notifier import WindowNotifier
+from lanus.bastion.lib.offload import CleanerPool
+from lanus.bastion.lib.pool import (
+    Admission,
+    ElasticPool
+)
+from lanus.bastion.lib.retention import RetentionProcess
+from lanus.bastion.lib.tracer import Tracer
+from lanus.bastion.lib.tracer import new_trace_id
 from lanus.bastion.sshd.interface import (
     SSHKeyGen,
     SSHServerInterface
 )
+from lanus.bastion.sshd.backend import close_backends
 from lanus.bastion.sshd.interactive import SSHInteractive
+from lanus.bastion.sshd.reactor import SessionReactor
 
 LOG = logging.getLogger(__name__)
 
@@ -34,9 +51,31 @@ server_opts = [
     cfg.IntOpt('port', default=None,
                 help='lanus bastion server listen port.'),
     cfg.IntOpt('pool_limit', default=None,
-                help='lanus bastion server process pool size.'),
+                help='lanus bastion server process pool max size.'),
+    cfg.IntOpt('pool_min', default=10,
+               help='lanus bastion server process pool min size.'),
+    cfg.IntOpt('pool_spare', default=5,
+               help='idle processes forked ahead of new connections.'),
+    cfg.IntOpt('pool_backlog', default=200,
+               help='connections held while the pool is saturated, more '
+                    'are rejected.'),
+    cfg.StrOpt('status_file', default=None,
+               help='file refreshed every second with pool workers, busy '
+                    'and backlog depth in json.'),
     cfg.IntOpt('session_limit', default=None,
-                help='lanus bastion server session clone size.')
+                help='lanus bastion server session clone size.'),
+    cfg.StrOpt('mode', default='pool',
+               choices=['pool', 'prefork', 'reactor'],
+               help='pool: one process per connection; prefork: pre-forked '
+                    'workers accept directly, one thread per connection; '
+                    'reactor: each worker multiplexes many connections on '
+                    'one event loop.'),
+    cfg.IntOpt('workers', default=4,
+               help='lanus bastion server worker process count, '
+                    'used by prefork and reactor mode.'),
+    cfg.BoolOpt('reuse_port', default=True,
+                help='each prefork/reactor worker binds its own SO_REUSEPORT '
+                     'listener, so the kernel spreads the accepts.')
 ]
 
 ssh_opts = [
@@ -48,37 +87,48 @@ CONF = cfg.CONF
 CONF.register_opts(server_opts, 'SERVER')
 CONF.register_opts(ssh_opts, 'SSH')
 
+# NOTE(worker启动后这么多秒内退出视为启动失败, 重新拉起的间隔逐次翻倍)
+RESPAWN_WINDOW = 10
+RESPAWN_DELAY = 0.5
+RESPAWN_MAX_DELAY = 60
+
 
 def SignalHandler():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def SSHBootstrap(client, rhost, rport):
+@track_active('lanus_transports_active')
+def SSHBootstrap(client, rhost, rport, accepted_at=None):
     # NOTE(为每一个socket进程定义一些全局属性; 每个channel线程共享.)
     context = DotMap()
     context.client = client
     context.channel_list = []
     context.remote_host = rhost
+    context.trace_id = new_trace_id()
 
-    transport = paramiko.Transport(client, gss_kex=False)
-    try:
-        transport.load_server_moduli()
-    except:
-        LOG.error('*** Failed to load moduli -- gex will be unsupported.')
-        client.close()
-        sys.exit(1)
+    tracer = Tracer.instance()
+    if accepted_at is not None:
+        # NOTE(pool模式: 从master accept到worker开始处理, 即排队耗时)
+        tracer.record(context.trace_id, 'accept', accepted_at,
+                      time.time() - accepted_at, host=rhost)
 
+    transport = paramiko.Transport(client, gss_kex=False)
     context.transport = transport
-    transport.add_server_key(SSHKeyGen.rsa_key())
+    for host_key in SSHKeyGen.host_keys():
+        transport.add_server_key(host_key)
 
     ssh_server = SSHServerInterface(context)
+    begin_time = time.monotonic()
     try:
-        transport.start_server(server=ssh_server)
+        with tracer.span(context.trace_id, 'start_server', host=rhost):
+            transport.start_server(server=ssh_server)
     except paramiko.SSHException as _ex:
         LOG.error('*** Bootstrap ssh start server failed: %s' % str(_ex))
         LOG.error(traceback.format_exc())
         client.close()
         sys.exit(1)
+    Metrics.instance().observe('lanus_handshake_seconds',
+                               time.monotonic() - begin_time)
 
     while transport.is_active():
         client_channel = transport.accept(timeout=CONF.SSH.timeout)
@@ -117,6 +167,7 @@ def SSHBootstrap(client, rhost, rport):
         if (len(context.channel_list) + 1) > CONF.SERVER.session_limit:
             tip = u'超出session预定上限值! 请使用已打开的窗口, 并关闭该窗口.'
             client_channel.sendall(cm.ws(tip, 1))
+            Metrics.instance().inc('lanus_session_rejected_total')
             close_data = client_channel.recv(1024)
             LOG.info(b'*** Session over limit, receive data: %s' % close_data)
             client_channel.close()
@@ -125,7 +176,7 @@ def SSHBootstrap(client, rhost, rport):
         # NOTE(channel list 需要多个线程共享, 因为若某个线程(session)
         # 自动退出，需要将自己自动从该列表剔除)
         context.channel_list.append(client_channel)
-        context[client_channel] = queue.Queue()
+        context[client_channel] = WindowNotifier()
 
         pid = os.getpid()
         LOG.info('*** Login user: %s from (%s:%s) on pid: %s.'
@@ -138,6 +189,8 @@ def SSHBootstrap(client, rhost, rport):
         except:
             LOG.error(traceback.format_exc())
 
+    wipe_credential(context)
+    close_backends(context)
     try:
         client.close()
     except:
@@ -146,6 +199,51 @@ def SSHBootstrap(client, rhost, rport):
     sys.exit(1)
 
 
+def BuildListener(host, port, backlog, reuse_port=False):
+    fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    fd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        fd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    fd.bind((host, port))
+    fd.listen(backlog)
+    return fd
+
+
+def WorkerListener(listener):
+    # NOTE(listener为None时, 由worker自己监听, 内核在各worker间分发连接)
+    if listener is not None:
+        return listener
+    return BuildListener(CONF.SERVER.host, CONF.SERVER.port,
+                         CONF.SERVER.pool_limit, reuse_port=True)
+
+
+def PreforkBootstrap(listener):
+    SignalHandler()
+    listener = WorkerListener(listener)
+    LOG.info('*** Prefork worker accepting on pid: %s.' % os.getpid())
+    while True:
+        try:
+            cs, (rhost, rport) = listener.accept()
+        except InterruptedError:
+            continue
+        LOG.info('*** Receive client addr: %s:%s' % (rhost, rport))
+        cs.setblocking(0)
+        # NOTE: 每个连接一个线程, SSHBootstrap结束时的sys.exit只结束该线程.
+        worker = threading.Thread(target=SSHBootstrap, args=(cs, rhost, rport))
+        worker.daemon = True
+        worker.start()
+
+
+def ReactorBootstrap(listener):
+    SignalHandler()
+    reactor = SessionReactor(WorkerListener(listener))
+    try:
+        reactor.serve_forever()
+    except:
+        LOG.error(traceback.format_exc())
+    sys.exit(1)
+
+
 class Bastion(Application):
     name = 'bastion'
     version = '0.1'
@@ -155,36 +253,147 @@ class Bastion(Application):
         self.host = CONF.SERVER.host
         self.port = CONF.SERVER.port
         self.limit = CONF.SERVER.pool_limit
-        self.pool = multiprocessing.Pool(self.limit, SignalHandler)
+        self.mode = CONF.SERVER.mode
+        self.reuse_port = CONF.SERVER.reuse_port
+        if self.reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            LOG.warn('*** SO_REUSEPORT unsupported, workers share listener.')
+            self.reuse_port = False
+        if self.mode == 'pool':
+            self.pool = ElasticPool(SSHBootstrap, CONF.SERVER.pool_min,
+                                    self.limit, CONF.SERVER.pool_spare,
+                                    SignalHandler)
+            self.admission = Admission(self.pool, CONF.SERVER.pool_backlog,
+                                       CONF.SERVER.status_file)
 
     def run(self):
-        self.build_lisen()
+        self.fd = None
+        # NOTE(clean进程先于监听socket和worker启动, 由worker继承)
+        self.cleaners = CleanerPool.start()
+        self.retention = RetentionProcess.start()
+        self.metrics = MetricsExporter.start()
+        if self.mode == 'pool' or not self.reuse_port:
+            self.build_lisen()
+        # NOTE(fork之前加载, worker以写时复制方式共享)
+        SSHKeyGen.preload()
         LOG.info('Starting ssh server at %s:%s' % (self.host, self.port))
         LOG.info('Quit the server with CONTROL-C.')
 
+        if self.mode == 'prefork':
+            self.run_workers(PreforkBootstrap)
+            return
+        if self.mode == 'reactor':
+            self.run_workers(ReactorBootstrap)
+            return
+
+        try:
+            self.run_pool()
+        except KeyboardInterrupt:
+            self.pool.terminate()
+            self.close()
+
+    def run_pool(self):
         while True:
+            try:
+                self.pool.maintain(len(self.admission.backlog))
+                self.maintain_helpers()
+                self.admission.drain()
+                self.admission.refresh()
+                self.admission.dump_status()
+                if self.metrics is not None:
+                    self.metrics.dump_pool(self.admission.status())
+            except Exception as _ex:
+                LOG.error('*** SSH bootstrap exception: %s' % str(_ex))
+                LOG.error(traceback.format_exc())
+
+            # NOTE(worker退出时也唤醒, 以便及时处理排队的连接)
+            ready = multiprocessing.connection.wait(
+                [self.fd] + self.pool.sentinels, timeout=1)
+            if self.fd not in ready:
+                continue
             cs, (rhost, rport) = self.fd.accept()
             LOG.info('*** Receive client addr: %s:%s' % (rhost, rport))
             cs.setblocking(0)
             try:
-                self.pool.apply_async(SSHBootstrap, (cs, rhost, rport))
-            except KeyboardInterrupt:
-                self.pool.terminate()
-                self.pool.close()
-                self.close()
+                self.admission.admit(cs, rhost, rport)
             except Exception as _ex:
-                self.close()
+                cs.close()
                 LOG.error('*** SSH bootstrap exception: %s' % str(_ex))
                 LOG.error(traceback.format_exc())
 
+    def run_workers(self, bootstrap):
+        workers = {}
+        started = {}
+        failures = 0
+        respawn_at = 0
+        try:
+            while True:
+                now = time.monotonic()
+                # NOTE(worker异常退出后重新拉起, 连续启动失败时推迟)
+                while len(workers) < CONF.SERVER.workers and \
+                        now >= respawn_at:
+                    worker = multiprocessing.Process(target=bootstrap,
+                                                     args=(self.fd,))
+                    worker.daemon = True
+                    worker.start()
+                    workers[worker.sentinel] = worker
+                    started[worker.sentinel] = now
+                    LOG.info('*** %s worker started on pid: %s.'
+                             % (self.mode, worker.pid))
+                if failures and any(now - started_at >= RESPAWN_WINDOW
+                                    for started_at in started.values()):
+                    failures = 0
+                if self.metrics is not None:
+                    self.metrics.dump_pool({'workers': len(workers)})
+                timeout = 1
+                if len(workers) < CONF.SERVER.workers:
+                    timeout = min(timeout, max(respawn_at - now, 0))
+                for sentinel in multiprocessing.connection.wait(
+                        list(workers) + self.helper_sentinels(),
+                        timeout=timeout):
+                    if sentinel not in workers:
+                        continue
+                    worker = workers.pop(sentinel)
+                    worker.join()
+                    LOG.error('*** %s worker pid: %s exit with code: %s.'
+                              % (self.mode, worker.pid, worker.exitcode))
+                    if time.monotonic() - started.pop(sentinel) < \
+                            RESPAWN_WINDOW:
+                        failures += 1
+                        delay = min(RESPAWN_DELAY * 2 ** (failures - 1),
+                                    RESPAWN_MAX_DELAY)
+                        respawn_at = time.monotonic() + delay
+                        LOG.error('*** %s worker failed %s times in a row, '
+                                  'respawn in %.1fs.'
+                                  % (self.mode, failures, delay))
+                self.maintain_helpers()
+        except KeyboardInterrupt:
+            for worker in workers.values():
+                worker.terminate()
+            self.close()
+
+    @property
+    def helpers(self):
+        return [helper for helper in (self.cleaners, self.retention,
+                                      self.metrics) if helper is not None]
+
+    def helper_sentinels(self):
+        sentinels = []
+        for helper in self.helpers:
+            sentinels.extend(helper.sentinels)
+        return sentinels
+
+    def maintain_helpers(self):
+        # NOTE(clean进程, 日志清理进程和metrics进程退出后重新拉起)
+        for helper in self.helpers:
+            helper.maintain()
+
     def build_lisen(self):
-        self.fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.fd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.fd.bind((self.host, self.port))
-        self.fd.listen(self.limit)
+        self.fd = BuildListener(self.host, self.port, self.limit)
 
     def close(self):
         try:
             self.fd.close()
         except:
             pass
+        for helper in self.helpers:
+            helper.terminate()
@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import logging
+
+from osmo.base import Application
+from oslo_config import cfg
+
+import lanus.bastion.common as cm
+from lanus.bastion.lib.cmdindex import CommandIndex
+
+LOG = logging.getLogger(__name__)
+
+query_opts = [
+    cfg.StrOpt('text', positional=True, required=False,
+               help='command text to search, as a substring.'),
+    cfg.StrOpt('user', default=None,
+               help='only commands of this bastion user.'),
+    cfg.StrOpt('host', default=None,
+               help='only commands on this host ip, glob such as 10.1.*'),
+    cfg.StrOpt('since', default=None,
+               help='only commands at or after, YYYY-mm-dd[ HH:MM:SS].'),
+    cfg.StrOpt('until', default=None,
+               help='only commands before, YYYY-mm-dd[ HH:MM:SS].'),
+    cfg.IntOpt('limit', default=100,
+               help='maximum commands printed.'),
+    cfg.BoolOpt('update', default=True,
+                help='index the new records before the query.'),
+    cfg.BoolOpt('update_only', default=False,
+                help='index the new records, no query, such as from cron.')
+]
+
+CONF = cfg.CONF
+CONF.register_cli_opts(query_opts)
+CONF.import_opt('record_path', 'lanus.bastion.lib.recorder', 'RECORD')
+
+
+class CommandQuery(Application):
+    name = 'lanus command query'
+    version = '1.0'
+
+    def run(self):
+        index = CommandIndex(CONF.RECORD.record_path,
+                             CONF.RECORD.index_file)
+        try:
+            if CONF.update or CONF.update_only:
+                index.update()
+            if CONF.update_only:
+                return
+            begin_time = time.monotonic()
+            rows = index.query(text=CONF.text, user=CONF.user,
+                               host=CONF.host,
+                               since=cm.parse_time(CONF.since),
+                               until=cm.parse_time(CONF.until),
+                               limit=CONF.limit)
+            for day, host, user, channel, offset, at, cmd in rows:
+                print('[%s] %-15s %-12s %s/%s_%s_%s.cmd:%s  %s'
+                      % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(at)),
+                         host, user, day, host, user, channel, offset, cmd))
+            LOG.info('** Command query returned %s rows in %.3fs.'
+                     % (len(rows), time.monotonic() - begin_time))
+        finally:
+            index.close()
+
+
+cmdquery = CommandQuery().entry_point()
@@ -5,6 +5,8 @@
 # Author: Jinlong Yang
 #
 
+import sys
+import time
 import logging
 from enum import Enum, unique
 
@@ -78,6 +80,7 @@ def terminal_nav(username):
 搜索登录(如果唯一).\r
         ➜  输入{color}/{end} + {color}IP, 主机名{end} 搜索, 如: /ip.\r
         ➜  输入{color}P/p{end} 显示您有权限的主机.\r
+        ➜  输入{color}R/r{end} 刷新您有权限的主机.\r
         ➜  输入{color}T/t{end} 进入常用工具集.\r
         ➜  输入{color}H/h{end} 帮助.\r
         ➜  输入{color}Q/q{end} 退出.\r
@@ -115,3 +118,16 @@ def wc(s, has_bg=True):
         return '\033[0;30;45m' + s + '\033[0m'
     else:
         return '\033[1;34m' + s + '\033[0m'
+
+
+def parse_time(value):
+    """Epoch seconds of ``YYYY-mm-dd[ HH:MM[:SS]]``, for the cli tools.
+    """
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    sys.exit('invalid time: %s, expect YYYY-mm-dd[ HH:MM:SS].' % value)
@@ -0,0 +1,195 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import logging
+import threading
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+buffer_opts = [
+    cfg.IntOpt('buffer_size', default=262144,
+               help='bytes of output kept per command: the first '
+                    'capture_head bytes and the latest ones, what is in '
+                    'between is replaced by a truncation marker.'),
+    cfg.IntOpt('capture_head', default=65536,
+               help='bytes kept from the start of the output of a command.'),
+    cfg.IntOpt('buffer_limit', default=256,
+               help='record buffers allocated per process at most.'),
+    cfg.IntOpt('overflow_size', default=16384,
+               help='bytes of output kept per command once buffer_limit '
+                    'buffers are in use, such buffers are allocated on '
+                    'demand and freed when written, smaller than '
+                    'buffer_size.'),
+    cfg.ListOpt('full_capture_groups', default=[],
+                help='asset groups whose whole output is recorded, a full '
+                     'buffer is handed to the recorder instead of '
+                     'truncated.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(buffer_opts, 'RECORD')
+
+TRUNCATED_MARKER = ('\r\n... [lanus: %s bytes truncated, %s bytes of output '
+                    'in total] ...\r\n')
+
+
+class RingBuffer:
+    """Fixed size byte buffer keeping the first ``head`` bytes and a ring
+    of the latest ones, older bytes of the ring are overwritten when full.
+    """
+
+    def __init__(self, capacity, head=0):
+        self.capacity = capacity
+        self.head = min(head, capacity)
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.ring = self.view[self.head:]
+        self.ring_capacity = capacity - self.head
+        self.head_size = 0
+        self.start = 0
+        self.size = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.head_size + self.size
+
+    @property
+    def total(self):
+        """Bytes appended since the last clear, kept or not.
+        """
+        return self.head_size + self.size + self.dropped
+
+    def is_full(self):
+        return len(self) >= self.capacity
+
+    def append(self, chunk):
+        if self.head_size < self.head:
+            length = min(len(chunk), self.head - self.head_size)
+            self.view[self.head_size:self.head_size + length] = \
+                chunk[:length]
+            self.head_size += length
+            if length == len(chunk):
+                return
+            chunk = chunk[length:]
+
+        capacity = self.ring_capacity
+        length = len(chunk)
+        if length >= capacity:
+            self.dropped += self.size + length - capacity
+            self.ring[:] = chunk[length - capacity:]
+            self.start = 0
+            self.size = capacity
+            return
+
+        overflow = self.size + length - capacity
+        if overflow > 0:
+            self.start = (self.start + overflow) % capacity
+            self.size -= overflow
+            self.dropped += overflow
+        end = (self.start + self.size) % capacity
+        head = min(length, capacity - end)
+        self.ring[end:end + head] = chunk[:head]
+        if head < length:
+            self.ring[:length - head] = chunk[head:]
+        self.size += length
+
+    def segments(self):
+        """Memoryviews of the content in order, without copying.
+
+        With a head, a marker with the byte counts stands for the bytes
+        overwritten between the head and the ring.
+        """
+        segments = []
+        if self.head_size:
+            segments.append(self.view[:self.head_size])
+            if self.dropped:
+                segments.append((TRUNCATED_MARKER % (
+                    self.dropped, self.total)).encode('utf-8'))
+        if not self.size:
+            return segments
+        end = self.start + self.size
+        if end <= self.ring_capacity:
+            segments.append(self.ring[self.start:end])
+        else:
+            segments.extend([self.ring[self.start:],
+                             self.ring[:end - self.ring_capacity]])
+        return segments
+
+    def getvalue(self):
+        return b''.join(self.segments())
+
+    def clear(self):
+        self.head_size = 0
+        self.start = 0
+        self.size = 0
+        self.dropped = 0
+
+
+class BufferPool:
+    """Preallocated output buffers shared by the channels of the process.
+
+    A channel hands its filled buffer to the recorder as is and takes an
+    empty one, the recorder gives it back once written. At most
+    ``buffer_limit`` buffers are ever pooled, past that a channel gets a
+    small ``overflow_size`` buffer which truncates sooner but still
+    records, and is dropped instead of pooled when given back.
+    """
+
+    _instance = None
+    _pid = None
+
+    @classmethod
+    def instance(cls):
+        pid = os.getpid()
+        if cls._instance is None or cls._pid != pid:
+            cls._instance = cls(CONF.RECORD.buffer_size,
+                                CONF.RECORD.buffer_limit,
+                                CONF.RECORD.capture_head,
+                                CONF.RECORD.overflow_size)
+            cls._pid = pid
+        return cls._instance
+
+    def __init__(self, capacity, limit, head=0, overflow=16384):
+        self.capacity = capacity
+        self.limit = limit
+        self.head = head
+        self.overflow = min(overflow, capacity)
+        self.lock = threading.Lock()
+        self.free = []
+        self.allocated = 0
+        self.is_exhausted = False
+
+    def acquire(self):
+        """Return an empty buffer, a small overflow one when all of the
+        pooled buffers are in use.
+        """
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            if self.allocated < self.limit:
+                self.allocated += 1
+                return RingBuffer(self.capacity, self.head)
+            is_exhausted, self.is_exhausted = self.is_exhausted, True
+        if not is_exhausted:
+            LOG.warn('*** Record buffers exhausted, output is recorded '
+                     'in %s bytes per command until one is released.'
+                     % self.overflow)
+        # NOTE(溢出的buffer按比例保留开头, 截断更早但不会漏记)
+        return RingBuffer(self.overflow, self.head * self.overflow //
+                          self.capacity)
+
+    def release(self, buffer):
+        # NOTE(溢出的buffer不放回池中, 交给gc回收)
+        if buffer.capacity != self.capacity:
+            return
+        buffer.clear()
+        with self.lock:
+            self.free.append(buffer)
+            self.is_exhausted = False
@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from oslo_config import cfg
+
+from lanus.bastion.lib.checker import Auth
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.search import AssetIndex
+
+LOG = logging.getLogger(__name__)
+
+asset_opts = [
+    cfg.IntOpt('cache_ttl', default=300,
+               help='seconds a user asset list is served without refresh.'),
+    cfg.IntOpt('cache_stale', default=3600,
+               help='seconds after ttl an expired asset list is still served '
+                    'while it is refreshed in background.'),
+    cfg.IntOpt('cache_size', default=1000,
+               help='user asset lists kept per process, the least recently '
+                    'used one is dropped beyond.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(asset_opts, 'ASSET')
+
+
+class AssetEntry:
+
+    def __init__(self, index):
+        self.index = index
+        self.loaded_at = time.monotonic()
+
+    @property
+    def age(self):
+        return time.monotonic() - self.loaded_at
+
+
+class AssetCache:
+    """User asset lists shared by every channel of the worker process.
+
+    A fresh entry is served as is, an expired one is served while a single
+    background refresh runs, and concurrent misses for the same user wait
+    on one api call instead of each making their own. Entries past the
+    stale period are dropped when looked up, and at most ``cache_size``
+    users are kept, least recently used first out.
+    """
+
+    _instance = None
+    _pid = None
+
+    @classmethod
+    def instance(cls):
+        pid = os.getpid()
+        if cls._instance is None or cls._pid != pid:
+            cls._instance = cls()
+            cls._pid = pid
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.loading = {}
+
+    def get(self, username, refresh=False):
+        """Return the ``AssetIndex`` of user, loading it when needed.
+        """
+        if not refresh:
+            index = self.peek(username)
+            if index is not None:
+                return index
+        return self.load(username)
+
+    def peek(self, username):
+        """Return the cached ``AssetIndex`` or ``None``, never blocks.
+        """
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            age = entry.age
+            if age >= CONF.ASSET.cache_ttl + CONF.ASSET.cache_stale:
+                self.entries.pop(username)
+                return None
+            self.entries.move_to_end(username)
+        if age >= CONF.ASSET.cache_ttl:
+            self.refresh(username)
+        return entry.index
+
+    def refresh(self, username):
+        with self.lock:
+            if username in self.loading:
+                return
+        worker = threading.Thread(target=self.load, args=(username,))
+        worker.daemon = True
+        worker.start()
+
+    def load(self, username):
+        with self.lock:
+            future = self.loading.get(username)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.loading[username] = future
+        if not is_owner:
+            return future.result()
+
+        begin_time = time.monotonic()
+        try:
+            index = AssetIndex(Auth().get_user_asset(username))
+            # NOTE(接口异常时返回空列表, 不缓存, 下次重新请求)
+            if index.assets:
+                with self.lock:
+                    self.entries[username] = AssetEntry(index)
+                    self.entries.move_to_end(username)
+                    while len(self.entries) > CONF.ASSET.cache_size:
+                        self.entries.popitem(last=False)
+            LOG.info('** user: %s asset list loaded, count: %s.'
+                     % (username, len(index)))
+        except Exception as _ex:
+            index = AssetIndex([])
+            LOG.error('** load user: %s asset error: %s' % (username, _ex))
+        finally:
+            with self.lock:
+                self.loading.pop(username, None)
+        Metrics.instance().observe('lanus_asset_fetch_seconds',
+                                   time.monotonic() - begin_time)
+        future.set_result(index)
+        return index
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
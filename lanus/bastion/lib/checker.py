@@ -8,10 +8,11 @@
 import logging
 from dotmap import DotMap
 
-import requests
 import osmo.util as ou
 from oslo_config import cfg
 
+from lanus.bastion.lib.httpclient import HTTPClient
+
 LOG = logging.getLogger(__name__)
 
 intf_opts = [
@@ -33,7 +34,8 @@ class Auth:
         url = CONF.INTF.user_check_intf
         payload = {'username': username, 'password': password}
         try:
-            user_info = ou.http_handler(url, ou.HTTP.POST,  payload=payload)
+            user_info = HTTPClient.instance().handle(
+                'user_check', url, ou.HTTP.POST, payload=payload)
         except Exception as _ex:
             LOG.error('** request validate api error: %s' % str(_ex))
             return False
@@ -59,7 +61,8 @@ class Auth:
         sign = ou.parameter_sign(payload, CONF.INTF.salt)
         payload['sign'] = sign
         try:
-            assets = ou.http_handler(url, ou.HTTP.POST, payload=payload)
+            assets = HTTPClient.instance().handle(
+                'user_asset', url, ou.HTTP.POST, payload=payload)
         except Exception as _ex:
             LOG.error('** request asset api error: %s' % str(_ex))
             return asset_list
@@ -76,7 +79,8 @@ class Auth:
         sign = ou.parameter_sign(payload, CONF.INTF.salt)
         payload['sign'] = sign
         try:
-            password = ou.http_handler(url, ou.HTTP.POST, payload=payload)
+            password = HTTPClient.instance().handle(
+                'user_ldap_pass', url, ou.HTTP.POST, payload=payload)
         except Exception as _ex:
             LOG.error('** request ldap password api error: %s' % str(_ex))
         return password
@@ -100,7 +104,8 @@ class Totp:
             try:
                 url = CONF.INTF.totp_check_intf
                 payload = {'username': username, 'token': token}
-                resp = requests.post(url, data=payload)
+                resp = HTTPClient.instance().request(
+                    'totp_check', url, ou.HTTP.POST, payload=payload)
             except Exception as _ex:
                 LOG.error('** Connect to otp serivce failed: %s' % str(_ex))
                 is_demote = True
@@ -6,36 +6,307 @@
 #
 
 import re
+import codecs
+import threading
 
 import pyte
+from pyte import modes as mo
+from pyte.screens import Margins
+from wcwidth import wcwidth
+
+# NOTE(除\t \r \n以外的控制字符和转义序列都交给pyte处理)
+CONTROL_PATTERN = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]')
+# NOTE(颜色和窗口标题不影响屏幕上的文字, 直接去掉)
+IGNORED_PATTERN = re.compile(
+    r'\x1b\[[0-9;:]*m|\x1b\][^\x07\x1b]*(\x07|\x1b\\)')
+# NOTE(数据以未结束的转义序列结尾, 下一段数据还需要pyte继续解析)
+PENDING_PATTERN = re.compile(r'\x1b(\[[0-?]*[ -/]*|\][^\x07\x1b]*|[ -/]*)?\Z')
+TAB_SIZE = 8
+
+
+def to_text(data, decoder=None):
+    """Decode str, bytes or a list of bytes-like segments.
+    """
+    if isinstance(data, str):
+        return data
+    if not isinstance(data, list):
+        data = [data]
+    if decoder is None:
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        return ''.join([decoder.decode(segment) for segment in data] +
+                       [decoder.decode(b'', final=True)])
+    return ''.join(decoder.decode(segment) for segment in data)
+
+
+def wrap(line, width):
+    """Screen rows of a line drawn from the first column, like pyte does.
+
+    ``None`` if the line has characters pyte draws differently.
+    """
+    if line.isascii():
+        if '\t' in line:
+            line = line.expandtabs(TAB_SIZE)
+            # NOTE(超过最后一个制表位的\t会停在最后一列, 交给pyte)
+            if len(line) >= width:
+                return None
+        if len(line) <= width:
+            return [line]
+        return [line[x:x + width] for x in range(0, len(line), width)]
+
+    rows, cells = [], []
+    for char in line:
+        char_width = wcwidth(char)
+        if char_width < 1 or char == '\t':
+            return None
+        if len(cells) == width:
+            rows.append(''.join(cells))
+            cells = []
+        cells.append(char)
+        # NOTE(宽字符在最后一列时会被截断, 不换行)
+        if char_width == 2 and len(cells) < width:
+            cells.append('')
+    rows.append(''.join(cells))
+    return rows
+
+
+class LineScreen(pyte.Screen):
+    """pyte screen keeping the rows scrolled off its top.
+    """
+
+    def __init__(self, columns, lines):
+        super().__init__(columns, lines)
+        self.scrolled = []
+
+    def index(self):
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+        if self.cursor.y == bottom and top == 0:
+            self.scrolled.append(self.row(0))
+        super().index()
+
+    def row(self, y):
+        line = self.buffer.get(y)
+        if not line:
+            return ''
+        return ''.join([line[x].data
+                        for x in range(max(line) + 1)]).rstrip()
+
+    def rows(self, end=None):
+        """The scrolled rows and the rows above ``end``, default all.
+        """
+        if end is None:
+            end = self.lines
+        return self.scrolled + [self.row(y) for y in range(end)]
+
+    def is_blank_from(self, y):
+        return all(not self.row(row) for row in self.buffer if row >= y)
+
+    def is_plain(self):
+        """Whether text drawn from here on looks as without emulation.
+        """
+        return (self.cursor.x == 0 and self.margins is None and
+                not self.charset and mo.DECAWM in self.mode and
+                not self.mode & {mo.IRM, mo.LNM, mo.DECOM} and
+                self.tabstops == set(range(TAB_SIZE, self.columns,
+                                           TAB_SIZE)) and
+                self.is_blank_from(self.cursor.y))
+
+    def clear(self):
+        """Blank the screen and go home, keeping the modes.
+        """
+        self.buffer.clear()
+        self.dirty.clear()
+        self.scrolled = []
+        self.cursor.x = self.cursor.y = 0
 
 
 class IOCleaner:
+    """Turn the raw output of one channel into text lines for the records.
+
+    Used by the recorder thread only, the records of a channel come in
+    order, so the emulator state is kept across them and every byte is
+    decoded and parsed once. Output without escape or control sequences
+    is split into rows directly. pyte is only fed from the first sequence
+    until its screen is back to a blank line, and rows scrolled off the
+    screen are kept instead of lost. Window resizes come from the session
+    thread under a lock and are taken at the next record.
+    """
 
     def __init__(self, width=167, height=33):
-        self.screen = pyte.Screen(width, height)
-        self.stream = pyte.ByteStream()
-        self.stream.attach(self.screen)
-        self.ps1_pattern = re.compile(r'^\[?.*@.*\]?[\$#]\s|mysql>\s')
-
-    def _clean(self, data):
-        display_list = []
-        if not isinstance(data, bytes):
-            data = data.encode('utf-8', errors='ignore')
-        self.stream.feed(data)
-        display_list = [line.strip('\r\n').strip('\n')
-                        for line in self.screen.display if line.strip()]
-        self.screen.reset()
-        return display_list
-
-    def output_clean(self, data):
-        display_list = self._clean(data)
-        return '\n'.join(display_list)
+        self.width = width
+        self.height = height
+        self.lock = threading.Lock()
+        self.size = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.screen = LineScreen(width, height)
+        self.stream = pyte.Stream(self.screen)
+        self.input_screen = None
+        self.is_emulating = False
+        self.is_pending = False
+        # NOTE(不走pyte时: 已结束的行 + 当前行, is_cr表示光标已回到行首)
+        self.rows = []
+        self.line = ''
+        self.is_cr = False
+        self.ps1_pattern = re.compile(
+            r'^\[?.*@.*\]?[\$#](\s|$)|mysql>(\s|$)')
+
+    def resize(self, width, height):
+        """Called by the session thread, applied by the recorder thread.
+        """
+        with self.lock:
+            self.size = (width, height)
+
+    def take_size(self):
+        """Return the size set since the last take or ``None``.
+        """
+        with self.lock:
+            size, self.size = self.size, None
+        return size
+
+    def apply_size(self):
+        size = self.take_size()
+        if size is None or size == (self.width, self.height):
+            return
+        screen = self.screen
+        is_default_tabs = screen.tabstops == set(
+            range(TAB_SIZE, screen.columns, TAB_SIZE))
+        self.width, self.height = size
+        screen.resize(lines=self.height, columns=self.width)
+        if is_default_tabs:
+            screen.tabstops = set(range(TAB_SIZE, self.width, TAB_SIZE))
+
+    def feed(self, text):
+        if not text:
+            return
+        if not self.is_emulating and self.feed_plain(text):
+            return
+        if not self.is_emulating:
+            self.start_emulating()
+        self.stream.feed(text)
+        position = text.rfind('\x1b')
+        if position >= 0:
+            self.is_pending = bool(PENDING_PATTERN.match(text, position))
+        if not self.is_pending and self.screen.is_plain():
+            self.stop_emulating()
+
+    def feed_plain(self, text):
+        """Split ``text`` into rows, ``False`` if it needs pyte.
+        """
+        if '\x1b' in text:
+            text = IGNORED_PATTERN.sub('', text)
+        if CONTROL_PATTERN.search(text):
+            return False
+        if self.is_cr:
+            text = '\r' + text
+        parts = text.split('\r\n')
+        last = parts[-1]
+        is_cr = last.endswith('\r')
+        if is_cr:
+            last = last[:-1]
+        if '\r' in last or '\n' in last or \
+           any('\r' in part or '\n' in part for part in parts[:-1]):
+            return False
+        rows = []
+        line = self.line
+        for part in parts[:-1]:
+            part_rows = wrap(line + part, self.width)
+            if part_rows is None:
+                return False
+            rows.extend(part_rows)
+            line = ''
+        line += last
+        if wrap(line, self.width) is None:
+            return False
+        self.rows.extend(rows)
+        self.line = line
+        self.is_cr = is_cr
+        return True
+
+    def start_emulating(self):
+        # NOTE(把最近的行画到屏幕上, 光标上移重绘时才能覆盖到)
+        screen = self.screen
+        screen.clear()
+        number = min(len(self.rows), self.height - 1)
+        seed = self.rows[len(self.rows) - number:]
+        del self.rows[len(self.rows) - number:]
+        for y, row in enumerate(seed):
+            screen.cursor.x, screen.cursor.y = 0, y
+            screen.draw(row)
+        screen.cursor.x, screen.cursor.y = 0, len(seed)
+        if self.line:
+            screen.draw(self.line)
+        if self.is_cr:
+            screen.carriage_return()
+        self.line = ''
+        self.is_cr = False
+        self.is_emulating = True
+
+    def stop_emulating(self):
+        self.rows.extend(self.screen.rows(self.screen.cursor.y))
+        self.screen.clear()
+        self.is_emulating = False
+
+    def take_rows(self, is_partial=False):
+        """Rows drawn since the last call, the screen starts over blank.
+
+        With ``is_partial`` the output goes on in the next record, so only
+        the finished rows are taken and the current line is kept.
+        """
+        if is_partial:
+            rows = self.rows
+            if self.is_emulating:
+                rows += self.screen.scrolled
+                self.screen.scrolled = []
+            self.rows = []
+            return [row.rstrip() for row in rows if row.strip()]
+        if self.is_emulating:
+            rows = self.rows + self.screen.rows()
+            self.screen.clear()
+            if not self.is_pending and self.screen.is_plain():
+                self.is_emulating = False
+        else:
+            rows = self.rows + (wrap(self.line, self.width) or [])
+        self.rows = []
+        self.line = ''
+        self.is_cr = False
+        return [row.rstrip() for row in rows if row.strip()]
+
+    def output_clean(self, data, is_partial=False):
+        """``data`` is str, bytes or a list of bytes-like segments.
+        """
+        self.apply_size()
+        self.feed(to_text(data, self.decoder))
+        return '\n'.join(self.take_rows(is_partial))
 
     def input_clean(self, data):
-        display_list = self._clean(data)
-        if display_list:
-            screen_info = display_list[-1]
+        # NOTE(不消费待处理的窗口大小, 留给输出清洗)
+        with self.lock:
+            size = self.size
+        width, height = size or (self.width, self.height)
+        rows = self.input_rows(to_text(data), width, height)
+        if rows:
+            screen_info = rows[-1]
         else:
             screen_info = ''
         return self.ps1_pattern.sub('', screen_info).strip()
+
+    def input_rows(self, text, width, height):
+        """Non-blank rows of one input line, drawn on a blank screen.
+        """
+        plain = IGNORED_PATTERN.sub('', text) if '\x1b' in text else text
+        if not CONTROL_PATTERN.search(plain):
+            rows = []
+            for part in plain.split('\r\n'):
+                part_rows = wrap(part, width)
+                if part_rows is None or '\r' in part or '\n' in part:
+                    break
+                rows.extend(part_rows)
+            else:
+                return [row.rstrip() for row in rows if row.strip()]
+        screen = self.input_screen
+        if screen is None:
+            screen = self.input_screen = LineScreen(width, height)
+        screen.resize(lines=height, columns=width)
+        screen.reset()
+        screen.scrolled = []
+        pyte.Stream(screen).feed(text)
+        return [row for row in screen.rows() if row.strip()]
@@ -0,0 +1,303 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import re
+import time
+import sqlite3
+import logging
+from datetime import datetime
+from datetime import timedelta
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+index_opts = [
+    cfg.StrOpt('index_file', default=None,
+               help='sqlite file of the command index, default '
+                    'cmd_index.db under record_path.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(index_opts, 'RECORD')
+
+DAY_PATTERN = re.compile(r'^\d{8}$')
+LINE_PATTERN = re.compile(r'^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] (.*)$')
+TOKEN_PATTERN = re.compile(r'[^\s;|&<>()\'"`]+')
+# NOTE(后缀只保留开头的字节数, 更长的查询词按前缀范围查后再由instr过滤)
+SUFFIX_SIZE = 16
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    host TEXT NOT NULL,
+    user TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    offset INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (day, name)
+);
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT PRIMARY KEY,
+    is_closed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    at INTEGER NOT NULL,
+    cmd TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT NOT NULL,
+    command_id INTEGER NOT NULL,
+    PRIMARY KEY (token, command_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS suffixes (
+    suffix TEXT NOT NULL,
+    command_id INTEGER NOT NULL,
+    PRIMARY KEY (suffix, command_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS commands_at ON commands (at);
+CREATE INDEX IF NOT EXISTS files_user ON files (user);
+CREATE INDEX IF NOT EXISTS files_host ON files (host);
+'''
+
+
+def tokenize(cmd):
+    return {token for token in TOKEN_PATTERN.findall(cmd.lower())}
+
+
+def suffixes(tokens):
+    """Proper suffixes of the tokens, cut to ``SUFFIX_SIZE``.
+    """
+    return {token[index:index + SUFFIX_SIZE] for token in tokens
+            for index in range(1, len(token))}
+
+
+def prefix_end(prefix):
+    """Smallest string above every string starting with ``prefix``.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def query_tokens(text):
+    """``(token, is_head, is_tail)`` of the tokens of ``text``.
+
+    A token touching the start of the text may be the end of a longer
+    token of the command, one touching the end may be its start, the
+    others are whole tokens.
+    """
+    text = text.lower()
+    return [(match.group(), match.start() == 0, match.end() == len(text))
+            for match in TOKEN_PATTERN.finditer(text)]
+
+
+def token_filter(token, is_head, is_tail):
+    """``(sql, args)`` selecting the ids of the commands that may hold
+    ``token`` at such a place.
+    """
+    if not is_head and not is_tail:
+        return 'SELECT command_id FROM tokens WHERE token = ?', [token]
+    if is_tail:
+        sql = ['SELECT command_id FROM tokens WHERE token >= ? AND '
+               'token < ?']
+        args = [token, prefix_end(token)]
+    else:
+        sql = ['SELECT command_id FROM tokens WHERE token = ?']
+        args = [token]
+    # NOTE(词首被截断时是某个词的后缀, 两端都被截断时是某个后缀的前缀)
+    suffix = token[:SUFFIX_SIZE]
+    sql.append('SELECT command_id FROM suffixes WHERE suffix >= ? AND '
+               'suffix < ?')
+    args.extend([suffix, prefix_end(suffix)])
+    return ' UNION '.join(sql), args
+
+
+def parse_name(name):
+    """``(host, user, channel)`` of ``<ip>_<user>_<channel>.cmd``.
+    """
+    stem = name[:-len('.cmd')]
+    host, rest = stem.split('_', 1)
+    user, channel = rest.rsplit('_', 1)
+    return host, user, channel
+
+
+class CommandIndex:
+    """Inverted index of the ``.cmd`` records under ``record_path``.
+
+    Every command is stored once with its file position, and each of its
+    tokens and their suffixes point to it, so a query narrows by whole
+    tokens, prefixes and substrings of tokens alike. Files are read on from the offset indexed last
+    time, and a day directory older than yesterday is marked closed once
+    indexed, so an update only looks at the days still written.
+    """
+
+    def __init__(self, record_path, index_file=None):
+        self.record_path = record_path
+        self.index_file = index_file or os.path.join(record_path,
+                                                     'cmd_index.db')
+        self.db = sqlite3.connect(self.index_file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        is_new = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'suffixes'"
+        ).fetchone() is None
+        self.db.executescript(SCHEMA)
+        if is_new:
+            self.index_suffixes()
+
+    def index_suffixes(self):
+        """Fill the suffixes of an index built before they were kept.
+        """
+        with self.db:
+            rows = self.db.execute('SELECT token, command_id FROM tokens')
+            self.db.executemany(
+                'INSERT OR IGNORE INTO suffixes (suffix, command_id) '
+                'VALUES (?, ?)',
+                [(suffix, command_id) for token, command_id in rows
+                 for suffix in suffixes([token])])
+
+    def close(self):
+        self.db.close()
+
+    def update(self):
+        """Index the records written since the last update.
+        """
+        begin_time = time.monotonic()
+        closed = {row[0] for row in self.db.execute(
+            'SELECT day FROM days WHERE is_closed = 1')}
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y%m%d')
+        count = 0
+        for day in sorted(os.listdir(self.record_path)):
+            if not DAY_PATTERN.match(day) or day in closed:
+                continue
+            day_path = os.path.join(self.record_path, day)
+            if not os.path.isdir(day_path):
+                continue
+            for name in sorted(os.listdir(day_path)):
+                if name.endswith('.cmd'):
+                    count += self.update_file(day, day_path, name)
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO days (day, is_closed) '
+                    'VALUES (?, ?)', (day, int(day < yesterday)))
+        LOG.info('** Command index updated %s commands in %.3fs.'
+                 % (count, time.monotonic() - begin_time))
+        return count
+
+    def update_file(self, day, day_path, name):
+        row = self.db.execute('SELECT id, offset FROM files '
+                              'WHERE day = ? AND name = ?',
+                              (day, name)).fetchone()
+        path = os.path.join(day_path, name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        if row is not None and row[1] >= size:
+            return 0
+
+        with self.db:
+            if row is None:
+                host, user, channel = parse_name(name)
+                cursor = self.db.execute(
+                    'INSERT INTO files (name, day, host, user, channel) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (name, day, host, user, channel))
+                file_id, offset = cursor.lastrowid, 0
+            else:
+                file_id, offset = row
+            count, offset = self.index_lines(file_id, path, offset)
+            self.db.execute('UPDATE files SET offset = ? WHERE id = ?',
+                            (offset, file_id))
+        return count
+
+    def index_lines(self, file_id, path, offset):
+        count = 0
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            for raw_line in fp:
+                # NOTE(只索引写完整的行, 剩余部分下次再读)
+                if not raw_line.endswith(b'\n'):
+                    break
+                line_offset = offset
+                offset += len(raw_line)
+                match = LINE_PATTERN.match(
+                    raw_line.decode('utf-8', errors='replace').rstrip('\n'))
+                if match is None:
+                    continue
+                at = int(time.mktime(time.strptime(match.group(1),
+                                                   '%Y-%m-%d %H:%M:%S')))
+                cmd = match.group(2)
+                cursor = self.db.execute(
+                    'INSERT INTO commands (file_id, offset, at, cmd) '
+                    'VALUES (?, ?, ?, ?)', (file_id, line_offset, at, cmd))
+                tokens = tokenize(cmd)
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO tokens (token, command_id) '
+                    'VALUES (?, ?)',
+                    [(token, cursor.lastrowid) for token in tokens])
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO suffixes (suffix, command_id) '
+                    'VALUES (?, ?)',
+                    [(suffix, cursor.lastrowid)
+                     for suffix in suffixes(tokens)])
+                count += 1
+        return count, offset
+
+    def forget(self, day):
+        """Drop the commands of a day directory deleted by the log clean.
+        """
+        with self.db:
+            for table in ('tokens', 'suffixes'):
+                self.db.execute(
+                    'DELETE FROM %s WHERE command_id IN ('
+                    'SELECT c.id FROM commands c JOIN files f '
+                    'ON c.file_id = f.id WHERE f.day = ?)' % table, (day,))
+            self.db.execute('DELETE FROM commands WHERE file_id IN ('
+                            'SELECT id FROM files WHERE day = ?)', (day,))
+            self.db.execute('DELETE FROM files WHERE day = ?', (day,))
+            self.db.execute('DELETE FROM days WHERE day = ?', (day,))
+
+    def query(self, text=None, user=None, host=None, since=None, until=None,
+              limit=100):
+        """Commands matching all the filters, oldest first.
+
+        ``text`` matches as a substring, each of its tokens narrows the
+        candidates through the index first, as a whole token, a prefix, a
+        suffix or a substring by its place in the text. ``host`` accepts
+        glob patterns.
+        """
+        sql = ['SELECT f.day, f.host, f.user, f.channel, c.offset, c.at, '
+               'c.cmd FROM commands c JOIN files f ON c.file_id = f.id '
+               'WHERE 1 = 1']
+        args = []
+        tokens = sorted(set(query_tokens(text))) if text else []
+        for token in tokens:
+            token_sql, token_args = token_filter(*token)
+            sql.append('AND c.id IN (%s)' % token_sql)
+            args.extend(token_args)
+        if text:
+            sql.append('AND instr(lower(c.cmd), ?) > 0')
+            args.append(text.lower())
+        if user:
+            sql.append('AND f.user = ?')
+            args.append(user)
+        if host:
+            sql.append('AND f.host GLOB ?')
+            args.append(host)
+        if since is not None:
+            sql.append('AND c.at >= ?')
+            args.append(int(since))
+        if until is not None:
+            sql.append('AND c.at < ?')
+            args.append(int(until))
+        sql.append('ORDER BY c.at, c.id LIMIT ?')
+        args.append(limit)
+        return self.db.execute(' '.join(sql), args).fetchall()
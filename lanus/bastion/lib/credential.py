@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import logging
+import threading
+
+from lanus.bastion.lib.checker import Auth
+
+LOG = logging.getLogger(__name__)
+
+
+class SessionCredential:
+    """LDAP password of one authenticated session.
+
+    Fetched on the first host login and reused by every later hop of the
+    session. Only this bytearray is kept, ``get`` decodes a str for the
+    paramiko call alone and callers must not store it; ``wipe`` zeroes the
+    bytearray once the transport closes. paramiko's own copy lives as
+    long as the backend transport.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self.lock = threading.Lock()
+        self.secret = None
+
+    def fetch(self):
+        """Fetch the password once, ``False`` if the api failed.
+        """
+        with self.lock:
+            if self.secret is None:
+                password = Auth().get_ldap_pass(self.username)
+                # NOTE(接口异常时不缓存, 下次登录机器时重新获取)
+                if not password:
+                    return False
+                self.secret = bytearray(password.encode('utf-8'))
+            return True
+
+    def get(self):
+        """The password as str for the ssh login, empty if unavailable.
+        """
+        if not self.fetch():
+            return ''
+        with self.lock:
+            # NOTE(fetch与get之间可能已被wipe)
+            if self.secret is None:
+                return ''
+            return self.secret.decode('utf-8')
+
+    def wipe(self):
+        with self.lock:
+            if self.secret is not None:
+                for i in range(len(self.secret)):
+                    self.secret[i] = 0
+                self.secret = None
+                LOG.info('** user: %s session credential wiped.'
+                         % self.username)
+
+
+def wipe_credential(context):
+    # NOTE(DotMap访问不存在的属性会自动创建, 所以用in判断)
+    if 'credential' in context:
+        context.credential.wipe()
@@ -0,0 +1,235 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import io
+import json
+import time
+import zlib
+import struct
+import bisect
+import logging
+
+from oslo_config import cfg
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+frames_opts = [
+    cfg.BoolOpt('record_frames', default=True,
+                help='record the raw session io with timestamps for replay.'),
+    cfg.BoolOpt('record_input', default=False,
+                help='also record the raw keystrokes of the users, they '
+                     'hold whatever is typed at no echo prompts such as '
+                     'passwords, replay does not need them.'),
+    cfg.StrOpt('frames_codec', default='gzip', choices=['gzip', 'zstd'],
+               help='compression of the frame blocks, zstd needs the '
+                    'zstandard package.'),
+    cfg.IntOpt('frames_block_size', default=65536,
+               help='raw bytes of frames compressed as one block, every '
+                    'block is a seek point of the index.'),
+    cfg.IntOpt('frames_block_interval', default=10,
+               help='seconds after which a partial block is written.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(frames_opts, 'RECORD')
+
+VERSION = 1
+
+# NOTE: 帧格式: 类型(1字节) + 相对会话开始的毫秒数(4字节) + 数据长度(4字节) + 数据.
+FRAME = struct.Struct('>cII')
+# NOTE: 索引格式: 块内第一帧的毫秒数 + 块在.rec文件中的偏移 + 压缩后长度.
+INDEX_ENTRY = struct.Struct('>IQI')
+RESIZE = struct.Struct('>HH')
+
+HEADER_FRAME = b'h'
+INPUT_FRAME = b'i'
+OUTPUT_FRAME = b'o'
+RESIZE_FRAME = b'r'
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def codec():
+    if CONF.RECORD.frames_codec != 'zstd':
+        return 'gzip'
+    if zstandard is None:
+        if not getattr(codec, 'is_warned', False):
+            LOG.warn('*** zstandard is not installed, record frames with '
+                     'gzip.')
+            codec.is_warned = True
+        return 'gzip'
+    return 'zstd'
+
+
+def compress(data, codec_name='gzip'):
+    """Compress one block as a standalone gzip member or zstd frame.
+    """
+    if codec_name == 'zstd':
+        return zstandard.ZstdCompressor().compress(bytes(data))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(block):
+    if block.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise Exception('zstd block needs the zstandard package.')
+        return zstandard.ZstdDecompressor().decompress(
+            block, max_output_size=64 * 1024 * 1024)
+    return zlib.decompress(block, 31)
+
+
+def pack_frame(kind, ms, payload):
+    return FRAME.pack(kind, ms, len(payload)) + payload
+
+
+def iter_frames(data):
+    """Yield ``(kind, ms, payload)`` of the frames of a raw block.
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset + FRAME.size <= len(view):
+        kind, ms, length = FRAME.unpack_from(view, offset)
+        offset += FRAME.size
+        yield kind, ms, bytes(view[offset:offset + length])
+        offset += length
+
+
+class FrameBuffer:
+    """Raw io frames of one channel waiting for the recorder.
+
+    Timestamps are monotonic milliseconds since the channel connected. The
+    filled block itself is handed over and replaced by a new one, and a
+    block is handed over once it reaches ``frames_block_size`` bytes or
+    ``frames_block_interval`` seconds, so a channel never holds more.
+    """
+
+    def __init__(self, header):
+        self.start = time.monotonic()
+        self.header = pack_frame(HEADER_FRAME, 0,
+                                 json.dumps(header).encode('utf-8'))
+        self.data = bytearray()
+        self.first_ms = 0
+
+    def elapsed(self):
+        return int((time.monotonic() - self.start) * 1000)
+
+    def add(self, kind, payload):
+        ms = self.elapsed()
+        if not self.data:
+            self.first_ms = ms
+        self.data += FRAME.pack(kind, ms, len(payload))
+        self.data += payload
+
+    def is_ready(self):
+        if not self.data:
+            return False
+        if len(self.data) >= CONF.RECORD.frames_block_size:
+            return True
+        interval = CONF.RECORD.frames_block_interval * 1000
+        return self.elapsed() - self.first_ms >= interval
+
+    def take(self):
+        """Return ``(first ms, block)`` and start a new block.
+        """
+        block, self.data = self.data, bytearray()
+        return self.first_ms, block
+
+
+class FrameReader:
+    """Read a ``.rec`` file, seeking through its ``.idx`` when present.
+    """
+
+    def __init__(self, rec_file):
+        self.rec_file = rec_file
+        self.index = self.load_index('%s.idx' % rec_file)
+        self.header = None
+        frames = self.frames()
+        try:
+            for kind, ms, payload in frames:
+                if kind == HEADER_FRAME:
+                    self.header = json.loads(payload.decode('utf-8'))
+                break
+        finally:
+            frames.close()
+
+    def load_index(self, idx_file):
+        entries = []
+        try:
+            with open(idx_file, 'rb') as fp:
+                data = fp.read()
+        except OSError:
+            return entries
+        for offset in range(0, len(data) - INDEX_ENTRY.size + 1,
+                            INDEX_ENTRY.size):
+            entries.append(INDEX_ENTRY.unpack_from(data, offset))
+        return entries
+
+    def seek(self, start_ms):
+        """Position of the block to read from to get the frames of ``start_ms``.
+        """
+        # NOTE(从最后一个开始时间早于start_ms的块读起)
+        times = [entry[0] for entry in self.index]
+        return max(bisect.bisect_left(times, start_ms) - 1, 0)
+
+    def blocks(self, position=0):
+        """Yield the raw blocks from the block number ``position``.
+        """
+        with open(self.rec_file, 'rb') as fp:
+            if not self.index:
+                for number, block in enumerate(self.scan(fp)):
+                    if number >= position:
+                        yield block
+                return
+            for ms, offset, length in self.index[position:]:
+                fp.seek(offset)
+                yield decompress(fp.read(length))
+
+    def scan(self, fp):
+        # NOTE(没有索引时按顺序解压每个gzip member)
+        data = fp.read()
+        if data.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise Exception('zstd record needs the zstandard package.')
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                io.BytesIO(data), read_across_frames=True)
+            yield reader.read()
+            return
+        while data:
+            decompressor = zlib.decompressobj(31)
+            yield decompressor.decompress(data)
+            data = decompressor.unused_data
+
+    def frames(self, start_ms=0):
+        for block in self.blocks(self.seek(start_ms)):
+            for kind, ms, payload in iter_frames(block):
+                yield kind, ms, payload
+
+    def positions(self, position=0, number=0):
+        """Yield ``(block, frame, kind, ms, payload)`` from a frame position.
+        """
+        blocks = self.blocks(position)
+        for block, data in enumerate(blocks, position):
+            for frame, (kind, ms, payload) in enumerate(iter_frames(data)):
+                if block == position and frame < number:
+                    continue
+                yield block, frame, kind, ms, payload
+
+    def duration(self):
+        """Milliseconds from the connect to the last frame.
+        """
+        position = max(len(self.index) - 1, 0)
+        last_ms = 0
+        for block in self.blocks(position):
+            for kind, ms, payload in iter_frames(block):
+                last_ms = max(last_ms, ms)
+        return last_ms
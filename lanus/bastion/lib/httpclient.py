@@ -0,0 +1,107 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import time
+import logging
+
+import requests
+import osmo.util as ou
+from oslo_config import cfg
+from requests.adapters import HTTPAdapter
+
+from lanus.bastion.lib.metrics import Metrics
+
+LOG = logging.getLogger(__name__)
+
+http_opts = [
+    cfg.IntOpt('pool_maxsize', default=16,
+               help='keep-alive connections kept per backend api host.'),
+    cfg.FloatOpt('connect_timeout', default=3,
+                 help='backend api connect timeout seconds.'),
+    cfg.FloatOpt('read_timeout', default=10,
+                 help='backend api read timeout seconds.'),
+    cfg.DictOpt('endpoint_timeout', default={},
+                help='read timeout per endpoint, such as: '
+                     'totp_check:3,user_asset:15.'),
+    cfg.FloatOpt('slow_request', default=1,
+                 help='log backend api calls slower than this seconds.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(http_opts, 'INTF')
+
+
+class HTTPClient:
+    """Keep-alive HTTP session shared by every backend api call.
+
+    One instance per process: a forked worker must not reuse the parent's
+    pooled sockets, so the instance is rebuilt when the pid changes.
+    """
+
+    _instance = None
+    _pid = None
+
+    @classmethod
+    def instance(cls):
+        pid = os.getpid()
+        if cls._instance is None or cls._pid != pid:
+            cls._instance = cls()
+            cls._pid = pid
+        return cls._instance
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=CONF.INTF.pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def timeout(self, endpoint):
+        read_timeout = CONF.INTF.endpoint_timeout.get(endpoint)
+        if read_timeout is None:
+            read_timeout = CONF.INTF.read_timeout
+        return (CONF.INTF.connect_timeout, float(read_timeout))
+
+    def request(self, endpoint, url, http_type, headers=None, payload=None):
+        """Send the request, returns the ``requests.Response``.
+        """
+        is_error = True
+        begin_time = time.monotonic()
+        try:
+            if http_type == ou.HTTP.GET:
+                resp = self.session.get(url, params=payload, headers=headers,
+                                        timeout=self.timeout(endpoint))
+            elif http_type == ou.HTTP.POST:
+                resp = self.session.post(url, data=payload, headers=headers,
+                                         timeout=self.timeout(endpoint))
+            else:
+                raise Exception('unknown http type!')
+            is_error = resp.status_code != 200
+            return resp
+        finally:
+            cost = time.monotonic() - begin_time
+            self.record(endpoint, cost, is_error)
+            if cost > CONF.INTF.slow_request:
+                LOG.warn('** slow %s api request cost: %.3fs' % (endpoint,
+                                                                cost))
+
+    def handle(self, endpoint, url, http_type, headers=None, payload=None):
+        """Same contract as ``osmo.util.http_handler``, returns ``data``.
+        """
+        resp = self.request(endpoint, url, http_type, headers, payload)
+        if resp.status_code != 200:
+            raise Exception('http status code is: %s' % resp.status_code)
+        ret_info = resp.json()
+        if ret_info.get('code') != 0:
+            raise Exception(ret_info.get('msg'))
+        return ret_info.get('data')
+
+    def record(self, endpoint, cost, is_error):
+        Metrics.instance().observe('lanus_api_request_seconds', cost,
+                                   endpoint=endpoint,
+                                   result='error' if is_error else 'ok')
@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import gzip
+import json
+import bisect
+import logging
+import itertools
+
+import pyte
+
+from lanus.bastion.lib.frames import OUTPUT_FRAME
+from lanus.bastion.lib.frames import RESIZE
+from lanus.bastion.lib.frames import RESIZE_FRAME
+
+LOG = logging.getLogger(__name__)
+
+VERSION = 1
+
+# NOTE(默认每30秒保存一个屏幕快照)
+KEYFRAME_INTERVAL = 30
+
+
+def new_screen(width, height):
+    screen = pyte.Screen(width or 80, height or 24)
+    stream = pyte.ByteStream()
+    stream.attach(screen)
+    return screen, stream
+
+
+def apply_frame(screen, stream, kind, payload):
+    if kind == OUTPUT_FRAME:
+        stream.feed(payload)
+    elif kind == RESIZE_FRAME:
+        width, height = RESIZE.unpack(payload)
+        screen.resize(lines=height, columns=width)
+
+
+def render(screen):
+    """Escape sequences drawing ``screen`` on a real terminal.
+    """
+    parts = ['\x1b[0m\x1b[2J']
+    for row, line in enumerate(screen.display, 1):
+        line = line.rstrip()
+        if line:
+            parts.append('\x1b[%d;1H%s' % (row, line))
+    parts.append('\x1b[%d;%dH' % (screen.cursor.y + 1, screen.cursor.x + 1))
+    return ''.join(parts).encode('utf-8')
+
+
+class Keyframe:
+    """Screen of a record right before the frame ``(block, frame)``.
+    """
+
+    def __init__(self, ms, block, frame, width, height, x, y, lines):
+        self.ms = ms
+        self.block = block
+        self.frame = frame
+        self.width = width
+        self.height = height
+        self.x = x
+        self.y = y
+        self.lines = lines
+
+    @classmethod
+    def capture(cls, ms, block, frame, screen):
+        return cls(ms, block, frame, screen.columns, screen.lines,
+                   screen.cursor.x, screen.cursor.y, list(screen.display))
+
+    def restore(self):
+        """Return a ``(screen, stream)`` showing this keyframe.
+        """
+        screen, stream = new_screen(self.width, self.height)
+        text = pyte.Stream(screen)
+        for row, line in enumerate(self.lines, 1):
+            line = line.rstrip()
+            if line:
+                text.feed('\x1b[%d;1H%s' % (row, line))
+        text.feed('\x1b[%d;%dH' % (self.y + 1, self.x + 1))
+        return screen, stream
+
+    def to_dict(self):
+        return self.__dict__
+
+
+class KeyframeIndex:
+    """Periodic screen snapshots of one ``.rec`` file.
+
+    Built once by emulating the whole record and cached next to it as
+    ``.rec.key``, so seeking restores the closest snapshot and emulates
+    only the frames after it.
+    """
+
+    def __init__(self, reader, interval=KEYFRAME_INTERVAL):
+        self.reader = reader
+        self.interval = interval
+        self.key_file = '%s.key' % reader.rec_file
+        self.keyframes = []
+
+    @classmethod
+    def load_or_build(cls, reader, interval=KEYFRAME_INTERVAL):
+        index = cls(reader, interval)
+        if not index.load():
+            index.build()
+            index.save()
+        return index
+
+    def load(self):
+        """Load the cached keyframes, ``False`` if missing or outdated.
+        """
+        try:
+            with gzip.open(self.key_file, 'rt', encoding='utf-8') as fp:
+                meta = json.loads(fp.readline())
+                if meta.get('version') != VERSION or \
+                   meta.get('rec_size') != self.rec_size() or \
+                   meta.get('interval') != self.interval:
+                    return False
+                self.keyframes = [Keyframe(**json.loads(line))
+                                  for line in fp]
+        except (OSError, ValueError, TypeError, EOFError):
+            return False
+        return True
+
+    def rec_size(self):
+        return os.path.getsize(self.reader.rec_file)
+
+    def build(self):
+        header = self.reader.header or {}
+        screen, stream = new_screen(header.get('width'),
+                                    header.get('height'))
+        interval_ms = self.interval * 1000
+        next_ms = interval_ms
+        self.keyframes = []
+        for block, frame, kind, ms, payload in self.reader.positions():
+            if ms >= next_ms:
+                self.keyframes.append(Keyframe.capture(ms, block, frame,
+                                                       screen))
+                next_ms = (ms // interval_ms + 1) * interval_ms
+            apply_frame(screen, stream, kind, payload)
+        LOG.info('** Build %s keyframes of record: %s.'
+                 % (len(self.keyframes), self.reader.rec_file))
+
+    def save(self):
+        tmp_file = '%s.tmp' % self.key_file
+        meta = {'version': VERSION, 'rec_size': self.rec_size(),
+                'interval': self.interval}
+        try:
+            with gzip.open(tmp_file, 'wt', encoding='utf-8') as fp:
+                fp.write(json.dumps(meta) + '\n')
+                for keyframe in self.keyframes:
+                    fp.write(json.dumps(keyframe.to_dict()) + '\n')
+            os.rename(tmp_file, self.key_file)
+        except OSError as _ex:
+            LOG.warn('** Save keyframes of record: %s failed: %s'
+                     % (self.reader.rec_file, str(_ex)))
+
+    def find(self, ms):
+        """The last keyframe at or before ``ms``, ``None`` before the first.
+        """
+        times = [keyframe.ms for keyframe in self.keyframes]
+        position = bisect.bisect_right(times, ms) - 1
+        if position < 0:
+            return None
+        return self.keyframes[position]
+
+    def screen_at(self, ms):
+        """Return ``(screen, frames)`` of the record at ``ms``.
+
+        ``frames`` iterates the ``(block, frame, kind, ms, payload)`` left
+        after ``ms``, for the caller to play on.
+        """
+        keyframe = self.find(ms)
+        if keyframe is None:
+            header = self.reader.header or {}
+            screen, stream = new_screen(header.get('width'),
+                                        header.get('height'))
+            frames = self.reader.positions()
+        else:
+            screen, stream = keyframe.restore()
+            frames = self.reader.positions(keyframe.block, keyframe.frame)
+        pending = []
+        for position in frames:
+            if position[3] > ms:
+                pending.append(position)
+                break
+            apply_frame(screen, stream, position[2], position[4])
+        return screen, itertools.chain(pending, frames)
@@ -0,0 +1,466 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import tempfile
+import functools
+import threading
+import traceback
+import http.server
+import multiprocessing
+import multiprocessing.util
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+metrics_opts = [
+    cfg.IntOpt('port', default=None,
+               help='port of the prometheus metrics endpoint served for '
+                    'the master, unset disables the metrics.'),
+    cfg.StrOpt('host', default='127.0.0.1',
+               help='listen address of the metrics endpoint.'),
+    cfg.StrOpt('metrics_dir', default=None,
+               help='directory of the metric snapshots of every process, '
+                    'default lanus-metrics-<port> under the temp dir.'),
+    cfg.FloatOpt('dump_interval', default=1,
+                 help='seconds between two metric snapshots of a process.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(metrics_opts, 'METRICS')
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+# NOTE: gauge按进程输出(pid标签), counter和histogram汇总所有进程, 包括已退出的.
+FAMILIES = {
+    'lanus_transports_active': (GAUGE, 'client ssh transports open.'),
+    'lanus_channels_active': (GAUGE, 'client channels open.'),
+    'lanus_session_rejected_total': (COUNTER,
+                                     'channels refused over session_limit.'),
+    'lanus_handshake_seconds': (HISTOGRAM,
+                                'key exchange of the client transports.'),
+    'lanus_auth_seconds': (HISTOGRAM,
+                           'password checks of the logins, by result.'),
+    'lanus_asset_fetch_seconds': (HISTOGRAM,
+                                  'asset list loads of the users.'),
+    'lanus_backend_connect_seconds': (HISTOGRAM,
+                                      'ssh connects to the backend hosts, '
+                                      'by result.'),
+    'lanus_api_request_seconds': (HISTOGRAM,
+                                  'backend api requests, by endpoint and '
+                                  'result.'),
+    'lanus_relay_bytes_total': (COUNTER,
+                                'bytes relayed, upstream is client to '
+                                'backend.'),
+    'lanus_recorder_queue_depth': (GAUGE,
+                                   'records waiting for the recorder.'),
+    'lanus_recorder_records_total': (COUNTER, 'records by state.'),
+    'lanus_recorder_errors_total': (COUNTER, 'record batches failed.'),
+    'lanus_recorder_frame_bytes_total': (COUNTER,
+                                         'session frame bytes, raw and '
+                                         'stored.'),
+    'lanus_pool_workers': (GAUGE, 'worker processes of the master.'),
+    'lanus_pool_busy': (GAUGE, 'pool workers serving a connection.'),
+    'lanus_pool_idle': (GAUGE, 'pool workers waiting for a connection.'),
+    'lanus_pool_queued': (GAUGE, 'connections handed to no worker yet.'),
+    'lanus_pool_backlog': (GAUGE, 'connections held by the admission.'),
+    'lanus_pool_max_size': (GAUGE, 'pool_limit of the pool.'),
+    'lanus_pool_saturation': (GAUGE, 'busy workers over pool_limit.'),
+    'lanus_pool_rejected_total': (COUNTER,
+                                  'connections refused over pool_backlog.')
+}
+
+RETIRED_FILE = 'retired.json'
+
+
+def series_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """Counters, gauges and histograms of one process.
+
+    Updated in memory only. When the master runs the metrics exporter, a
+    thread dumps them into a snapshot file of the process every
+    ``dump_interval`` and once more at exit, the exporter adds the files
+    of all the processes up.
+    """
+
+    _instance = None
+    _pid = None
+    # NOTE(由master在fork前设置, worker继承)
+    directory = None
+
+    @classmethod
+    def instance(cls):
+        pid = os.getpid()
+        if cls._instance is None or cls._pid != pid:
+            cls._instance = cls()
+            cls._pid = pid
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.collectors = []
+        if self.directory is not None:
+            self.path = os.path.join(self.directory, '%s.json' % os.getpid())
+            thread = threading.Thread(target=self.run, name='lanus-metrics')
+            thread.daemon = True
+            thread.start()
+            # NOTE(在Recorder之后执行, 记录下最终的计数)
+            multiprocessing.util.Finalize(None, self.dump, exitpriority=5)
+
+    def inc(self, name, value=1, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, name, value=1, **labels):
+        self.inc(name, -value, **labels)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[series_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            counts = histogram[0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            histogram[1] += value
+
+    def collect(self, collector):
+        """Call ``collector(metrics)`` before each snapshot.
+        """
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception:
+                LOG.error(traceback.format_exc())
+        with self.lock:
+            return {
+                'values': [[name, labels, value] for (name, labels), value
+                           in self.values.items()],
+                'histograms': [[name, labels, list(counts), total]
+                               for (name, labels), (counts, total)
+                               in self.histograms.items()]
+            }
+
+    def run(self):
+        while True:
+            time.sleep(CONF.METRICS.dump_interval)
+            self.dump()
+
+    def dump(self):
+        write_snapshot(self.path, self.snapshot())
+
+
+def write_snapshot(path, snapshot):
+    tmp_file = '%s.tmp' % path
+    try:
+        with open(tmp_file, 'w') as fp:
+            json.dump(snapshot, fp)
+        os.rename(tmp_file, path)
+    except OSError as _ex:
+        LOG.error('*** Dump metrics snapshot failed: %s' % str(_ex))
+
+
+def track_active(name):
+    """Keep gauge ``name`` raised while the decorated function runs.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = Metrics.instance()
+            metrics.inc(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.dec(name)
+        return wrapper
+    return decorator
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+class SnapshotCollector:
+    """Add the snapshot files of every process up, in the exporter.
+
+    Counters and histograms of the exited processes are folded into a
+    retired file and their snapshots removed, so a pool forking a worker
+    per connection does not pile the files up and no count goes back.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.retired_file = os.path.join(directory, RETIRED_FILE)
+        self.retired = self.load(self.retired_file) or {'values': [],
+                                                        'histograms': []}
+
+    def load(self, path):
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def snapshots(self):
+        """``(pid, snapshot)`` of every process with a snapshot file.
+        """
+        result = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext != '.json' or not stem.isdigit():
+                continue
+            snapshot = self.load(os.path.join(self.directory, name))
+            if snapshot is not None:
+                result.append((int(stem), snapshot))
+        return result
+
+    def fold(self):
+        values, histograms = {}, {}
+        self.add(self.retired, values, histograms)
+        is_changed = False
+        for pid, snapshot in self.snapshots():
+            if is_alive(pid):
+                continue
+            self.add(snapshot, values, histograms)
+            os.unlink(os.path.join(self.directory, '%s.json' % pid))
+            is_changed = True
+        if is_changed:
+            self.retired = {
+                'values': [[name, labels, value] for (name, labels), value
+                           in values.items()],
+                'histograms': [[name, labels, counts, total]
+                               for (name, labels), (counts, total)
+                               in histograms.items()]
+            }
+            write_snapshot(self.retired_file, self.retired)
+
+    def add(self, snapshot, values, histograms, pid=None):
+        """Add the counters and histograms up, gauges only with ``pid``.
+        """
+        for name, labels, value in snapshot['values']:
+            kind = FAMILIES.get(name, (None,))[0]
+            labels = tuple(tuple(label) for label in labels)
+            if kind == GAUGE:
+                if pid is not None:
+                    values[(name, labels + (('pid', pid),))] = value
+            elif kind == COUNTER:
+                key = (name, labels)
+                values[key] = values.get(key, 0) + value
+        for name, labels, counts, total in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            if key not in histograms:
+                histograms[key] = ([0] * len(counts), 0.0)
+            old_counts, old_total = histograms[key]
+            histograms[key] = ([a + b for a, b in zip(old_counts, counts)],
+                               old_total + total)
+
+    def render(self):
+        """Prometheus text exposition of all the processes.
+        """
+        self.fold()
+        values, histograms = {}, {}
+        self.add(self.retired, values, histograms)
+        for pid, snapshot in self.snapshots():
+            self.add(snapshot, values, histograms, pid=pid)
+
+        lines = []
+        for family, (kind, help_text) in FAMILIES.items():
+            if kind == HISTOGRAM:
+                series = sorted(item for item in histograms.items()
+                                if item[0][0] == family)
+            else:
+                series = sorted(item for item in values.items()
+                                if item[0][0] == family)
+            if not series:
+                continue
+            lines.append('# HELP %s %s' % (family, help_text))
+            lines.append('# TYPE %s %s' % (family, kind))
+            for (name, labels), value in series:
+                if kind != HISTOGRAM:
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              value))
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (
+                        name, format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              round(total, 6)))
+                lines.append('%s_count%s %s' % (name, format_labels(labels),
+                                                cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    # NOTE(单线程服务, 慢客户端最多阻塞这么久)
+    timeout = 5
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collector.render().encode('utf-8')
+        except Exception:
+            LOG.error(traceback.format_exc())
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('** Metrics request from %s: %s'
+                  % (self.address_string(), format % args))
+
+
+def export_loop(server, directory):
+    """Main of the exporter process: serve the scrapes, fold the exited.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.collector = SnapshotCollector(directory)
+    server.timeout = 1
+    while True:
+        server.handle_request()
+        try:
+            server.collector.fold()
+        except Exception:
+            LOG.error(traceback.format_exc())
+
+
+class MetricsExporter:
+    """Prometheus endpoint started by the master before the workers fork.
+
+    The listening socket is bound by the master, so a port in use fails
+    the start; a separate process serves it and is restarted when it
+    exits. The master adds the pool state as its own snapshot.
+    """
+
+    @classmethod
+    def start(cls):
+        if CONF.METRICS.port is None:
+            return None
+        exporter = cls(CONF.METRICS.host, CONF.METRICS.port,
+                       CONF.METRICS.metrics_dir)
+        exporter.maintain()
+        return exporter
+
+    def __init__(self, host, port, directory=None):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(),
+                                     'lanus-metrics-%s' % port)
+        os.makedirs(directory, exist_ok=True)
+        # NOTE(清除上次运行留下的快照, 计数从0开始)
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                os.unlink(os.path.join(directory, name))
+        self.directory = directory
+        self.path = os.path.join(directory, '%s.json' % os.getpid())
+        self.server = http.server.HTTPServer((host, port), MetricsHandler)
+        self.process = None
+        self.next_dump = 0
+        Metrics.directory = directory
+        LOG.info('*** Metrics served at http://%s:%s/metrics' % (host, port))
+
+    @property
+    def sentinels(self):
+        if self.process is None:
+            return []
+        return [self.process.sentinel]
+
+    def maintain(self):
+        proc = self.process
+        if proc is not None:
+            if proc.is_alive():
+                return
+            proc.join()
+            LOG.error('*** Metrics process pid: %s exit with code: %s.'
+                      % (proc.pid, proc.exitcode))
+        proc = multiprocessing.Process(target=export_loop,
+                                       args=(self.server, self.directory))
+        proc.daemon = True
+        proc.start()
+        self.process = proc
+        LOG.info('*** Metrics process started on pid: %s.' % proc.pid)
+
+    def dump_pool(self, status):
+        """Snapshot of the master, ``status`` as ``Admission.status``.
+        """
+        now = time.monotonic()
+        if now < self.next_dump:
+            return
+        self.next_dump = now + CONF.METRICS.dump_interval
+        values = [['lanus_pool_%s' % key, [], status[key]]
+                  for key in ('workers', 'busy', 'idle', 'queued', 'backlog',
+                              'max_size') if key in status]
+        if 'rejected' in status:
+            values.append(['lanus_pool_rejected_total', [],
+                           status['rejected']])
+        if status.get('max_size'):
+            values.append(['lanus_pool_saturation', [],
+                           round(status['busy'] / status['max_size'], 4)])
+        write_snapshot(self.path, {'values': values, 'histograms': []})
+
+    def terminate(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+        self.server.server_close()
+        Metrics.directory = None
@@ -0,0 +1,65 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import socket
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class WindowNotifier:
+    """Window size changes of one client channel.
+
+    The transport thread keeps the latest size and writes one byte to a
+    socketpair, so the relay wakes up from its selector instead of polling.
+    A burst of changes while the window is dragged collapses into one
+    resize of the backend pty.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.size = None
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def notify(self, width, height):
+        with self.lock:
+            is_pending = self.size is not None
+            self.size = (width, height)
+        # NOTE(已有未处理的通知时只更新尺寸, 不再写入)
+        if is_pending:
+            return
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            pass
+
+    def fetch(self):
+        """Return the latest ``(width, height)`` since last fetch or ``None``.
+        """
+        try:
+            self.reader.recv(64)
+        except OSError:
+            pass
+        with self.lock:
+            size, self.size = self.size, None
+        return size
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+def release_notifier(context, channel):
+    # NOTE(DotMap访问不存在的属性会自动创建, 所以用in判断)
+    if channel in context:
+        context.pop(channel).close()
@@ -0,0 +1,296 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import sys
+import time
+import struct
+import signal
+import logging
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+
+from oslo_config import cfg
+
+from lanus.bastion.lib.cleaner import IOCleaner
+from lanus.bastion.lib.writer import RecordWriter
+
+LOG = logging.getLogger(__name__)
+
+offload_opts = [
+    cfg.IntOpt('clean_workers', default=0,
+               help='processes cleaning the session output, started by the '
+                    'master and shared by every worker, 0 cleans in the '
+                    'recorder thread of each worker.'),
+    cfg.IntOpt('clean_slots', default=32,
+               help='shared memory output buffers per clean process, the '
+                    'recorder waits when all of them are in use.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(offload_opts, 'RECORD')
+
+# NOTE: 每个slot的头: 状态 + 序号 + 数据长度, 序号用来识别clean进程重启前的旧任务.
+SLOT = struct.Struct('>BQI')
+FREE = 0
+BUSY = 1
+
+# NOTE(等待空闲slot的最长时间, 超时则丢弃该条输出记录)
+WAIT_TIMEOUT = 5
+
+MARKER_ROOM = 256
+
+CLEAN_JOB = 'clean'
+END_JOB = 'end'
+
+
+class CleanChannel:
+    """Shared memory slots and job pipe of one clean process.
+
+    Created by the master before the workers fork, so every worker and the
+    clean process share them. A worker takes a free slot, copies the output
+    into it and sends a small job through the pipe; the clean process frees
+    the slot once the output is cleaned.
+    """
+
+    def __init__(self, number, slots, slot_size):
+        self.number = number
+        self.slots = slots
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=slots * (SLOT.size + slot_size))
+        self.lock = multiprocessing.Lock()
+        self.freed = multiprocessing.Semaphore(0)
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.waits = multiprocessing.Value('L', 0)
+        self.process = None
+
+    def data_offset(self, slot):
+        return self.slots * SLOT.size + slot * self.slot_size
+
+    def acquire(self):
+        """Take a free slot, returns ``(slot, seq)`` or ``None`` on timeout.
+        """
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        is_waiting = False
+        while True:
+            with self.lock:
+                buf = self.memory.buf
+                for slot in range(self.slots):
+                    state, seq, length = SLOT.unpack_from(buf,
+                                                          slot * SLOT.size)
+                    if state == FREE:
+                        SLOT.pack_into(buf, slot * SLOT.size, BUSY, seq + 1,
+                                       0)
+                        return slot, seq + 1
+            if not is_waiting:
+                is_waiting = True
+                with self.waits.get_lock():
+                    self.waits.value += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # NOTE(信号量只用来唤醒, 醒来后重新扫描slot状态)
+            self.freed.acquire(timeout=min(remaining, 0.1))
+
+    def release(self, slot, seq):
+        with self.lock:
+            state, current_seq, length = SLOT.unpack_from(
+                self.memory.buf, slot * SLOT.size)
+            if current_seq == seq:
+                SLOT.pack_into(self.memory.buf, slot * SLOT.size, FREE, seq,
+                               0)
+        self.wake()
+
+    def wake(self):
+        # NOTE(信号量只做唤醒提示, 没人等待时不累积)
+        if self.freed.get_value() == 0:
+            self.freed.release()
+
+    def put(self, slot, seq, segments):
+        buf = self.memory.buf
+        offset = self.data_offset(slot)
+        length = 0
+        for segment in segments:
+            size = min(len(segment), self.slot_size - length)
+            buf[offset + length:offset + length + size] = segment[:size]
+            length += size
+        with self.lock:
+            SLOT.pack_into(buf, slot * SLOT.size, BUSY, seq, length)
+        return length
+
+    def get(self, slot, seq):
+        """The output in ``slot``, ``None`` if it is not the job's anymore.
+        """
+        with self.lock:
+            state, current_seq, length = SLOT.unpack_from(
+                self.memory.buf, slot * SLOT.size)
+        if state != BUSY or current_seq != seq:
+            return None
+        offset = self.data_offset(slot)
+        return self.memory.buf[offset:offset + length]
+
+    def send(self, job):
+        with self.lock:
+            self.writer.send(job)
+
+    def reset(self):
+        """Free every slot, called by the master when the process restarts.
+        """
+        with self.lock:
+            for slot in range(self.slots):
+                state, seq, length = SLOT.unpack_from(self.memory.buf,
+                                                      slot * SLOT.size)
+                SLOT.pack_into(self.memory.buf, slot * SLOT.size, FREE, seq,
+                               0)
+        self.wake()
+
+    def close(self):
+        try:
+            self.memory.close()
+            self.memory.unlink()
+        except (OSError, BufferError):
+            pass
+
+
+def clean_loop(channel):
+    """Main of a clean process: clean the jobs and write the ``.log`` files.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    writer = RecordWriter(CONF.RECORD.record_path)
+    cleaners = {}
+    try:
+        while True:
+            if channel.reader.poll(CONF.RECORD.flush_interval):
+                job = channel.reader.recv()
+                try:
+                    handle_job(channel, writer, cleaners, job)
+                except Exception:
+                    LOG.error(traceback.format_exc())
+            writer.tick()
+    finally:
+        writer.close_all()
+
+
+def handle_job(channel, writer, cleaners, job):
+    if job[0] == END_JOB:
+        kind, key, stem = job
+        cleaners.pop(key, None)
+        writer.close(stem)
+        return
+
+    kind, key, name, width, height, size, is_partial, slot, seq = job
+    data = channel.get(slot, seq)
+    if data is None:
+        LOG.warn('** Clean process: %s skip stale job of: %s.'
+                 % (channel.number, name))
+        return
+    try:
+        io_cleaner = cleaners.get(key)
+        if io_cleaner is None:
+            io_cleaner = cleaners[key] = IOCleaner(width, height)
+        if size is not None:
+            io_cleaner.resize(*size)
+        output_msg = io_cleaner.output_clean([data], is_partial)
+    finally:
+        data.release()
+        channel.release(slot, seq)
+    if output_msg or not is_partial:
+        writer.write(name, [output_msg])
+
+
+class CleanerPool:
+    """Processes cleaning the session output of every worker.
+
+    Started by the master with ``clean_workers`` processes, inherited by
+    the workers through fork. The jobs of a channel always go to the same
+    process, which keeps its terminal state and writes its ``.log`` file,
+    so only bytes are moved by the workers and nothing is sent back.
+    """
+
+    _instance = None
+
+    @classmethod
+    def start(cls):
+        if CONF.RECORD.clean_workers > 0 and cls._instance is None:
+            # NOTE(slot要能放下截断标记)
+            cls._instance = cls(CONF.RECORD.clean_workers,
+                                CONF.RECORD.clean_slots,
+                                CONF.RECORD.buffer_size + MARKER_ROOM)
+            cls._instance.maintain()
+        return cls._instance
+
+    @classmethod
+    def instance(cls):
+        return cls._instance
+
+    def __init__(self, size, slots, slot_size):
+        self.channels = [CleanChannel(number, slots, slot_size)
+                         for number in range(size)]
+
+    @property
+    def sentinels(self):
+        return [channel.process.sentinel for channel in self.channels
+                if channel.process is not None]
+
+    def maintain(self):
+        """Start the clean processes, again when one exited.
+        """
+        for channel in self.channels:
+            proc = channel.process
+            if proc is not None:
+                if proc.is_alive():
+                    continue
+                proc.join()
+                LOG.error('*** Clean process pid: %s exit with code: %s.'
+                          % (proc.pid, proc.exitcode))
+                channel.reset()
+            proc = multiprocessing.Process(target=clean_loop,
+                                           args=(channel,))
+            proc.daemon = True
+            proc.start()
+            channel.process = proc
+            LOG.info('*** Clean process: %s started on pid: %s.'
+                     % (channel.number, proc.pid))
+
+    def channel(self, key):
+        return self.channels[hash(key) % len(self.channels)]
+
+    def clean(self, key, name, io_cleaner, segments, is_partial=False):
+        """Send output ``segments`` to be cleaned into record file ``name``.
+
+        Waits while the clean process of ``key`` has no free slot, returns
+        ``False`` if none was freed in time.
+        """
+        channel = self.channel(key)
+        taken = channel.acquire()
+        if taken is None:
+            return False
+        slot, seq = taken
+        try:
+            channel.put(slot, seq, segments)
+            channel.send((CLEAN_JOB, key, name, io_cleaner.width,
+                          io_cleaner.height, io_cleaner.take_size(),
+                          is_partial, slot, seq))
+        except Exception:
+            channel.release(slot, seq)
+            raise
+        return True
+
+    def end(self, key, stem):
+        self.channel(key).send((END_JOB, key, stem))
+
+    def waits(self):
+        return sum(channel.waits.value for channel in self.channels)
+
+    def terminate(self):
+        for channel in self.channels:
+            if channel.process is not None:
+                channel.process.terminate()
+                channel.process.join()
+            channel.close()
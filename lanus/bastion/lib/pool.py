@@ -0,0 +1,215 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import json
+import time
+import logging
+import traceback
+import collections
+import multiprocessing
+import multiprocessing.connection
+
+LOG = logging.getLogger(__name__)
+
+IDLE = 0
+BUSY = 1
+
+
+def worker_loop(tasks, state, taken, func, initializer=None):
+    """Serve a single connection, then exit like a ``Pool`` worker would.
+    """
+    if initializer is not None:
+        initializer()
+    task = tasks.get()
+    if task is None:
+        return
+    state.value = BUSY
+    with taken.get_lock():
+        taken.value += 1
+    try:
+        func(*task)
+    except SystemExit:
+        pass
+    except Exception:
+        LOG.error(traceback.format_exc())
+
+
+class ElasticPool:
+    """Process pool growing between ``min_size`` and ``max_size``.
+
+    Every worker serves one connection. The pool keeps ``spare`` idle
+    workers forked ahead of demand, retires the surplus when the load goes
+    down, and holds the connections it cannot serve yet in a backlog.
+    """
+
+    def __init__(self, func, min_size, max_size, spare, initializer=None):
+        self.func = func
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.spare = spare
+        self.initializer = initializer
+        # NOTE: SimpleQueue在put时同步序列化socket, 之后父进程可以关闭它.
+        self.tasks = multiprocessing.SimpleQueue()
+        self.taken = multiprocessing.Value('L', 0)
+        self.dispatched = 0
+        self.retiring = 0
+        self.workers = {}
+
+    @property
+    def busy(self):
+        return sum(state.value for proc, state in self.workers.values())
+
+    @property
+    def queued(self):
+        """Tasks put into the queue but not taken by a worker yet.
+        """
+        return self.dispatched - self.taken.value
+
+    @property
+    def idle(self):
+        return len(self.workers) - self.busy - self.queued - self.retiring
+
+    @property
+    def sentinels(self):
+        return list(self.workers)
+
+    def submit(self, *task):
+        self.tasks.put(task)
+        self.dispatched += 1
+
+    def reap(self):
+        for sentinel in multiprocessing.connection.wait(self.sentinels, 0):
+            proc, state = self.workers.pop(sentinel)
+            proc.join()
+            if state.value == IDLE and self.retiring > 0:
+                self.retiring -= 1
+
+    def maintain(self, backlog=0):
+        """Fork or retire workers according to the current demand.
+        """
+        self.reap()
+        busy = self.busy
+        demand = busy + self.queued + backlog + self.spare
+        target = min(self.max_size, max(self.min_size, demand))
+        alive = len(self.workers) - self.retiring
+        for i in range(target - alive):
+            self.spawn()
+        surplus = alive - target
+        while surplus > 0 and self.idle > self.spare:
+            self.tasks.put(None)
+            self.retiring += 1
+            surplus -= 1
+
+    def spawn(self):
+        state = multiprocessing.Value('b', IDLE, lock=False)
+        proc = multiprocessing.Process(target=worker_loop,
+                                       args=(self.tasks, state, self.taken,
+                                             self.func, self.initializer))
+        proc.daemon = True
+        proc.start()
+        self.workers[proc.sentinel] = (proc, state)
+
+    def terminate(self):
+        for proc, state in self.workers.values():
+            proc.terminate()
+        self.workers.clear()
+
+
+class Admission:
+    """Front of the pool: hold connections while every worker is busy.
+
+    Queued clients get a plain text line before the ssh version exchange
+    (RFC 4253 4.2 allows it), so they see why the login is waiting instead
+    of a silent hang, and nothing is spent on key exchange meanwhile.
+    """
+
+    def __init__(self, pool, max_backlog, status_file=None):
+        self.pool = pool
+        self.max_backlog = max_backlog
+        self.status_file = status_file
+        self.backlog = collections.deque()
+        self.rejected = 0
+        self.next_dump = 0
+        self.next_refresh = 0
+
+    def admit(self, client, rhost, rport):
+        # NOTE(accept时间随连接交给worker, 记录排队耗时)
+        accepted_at = time.time()
+        if not self.backlog and self.pool.idle > 0:
+            self.dispatch(client, rhost, rport, accepted_at)
+            return
+        if len(self.backlog) >= self.max_backlog:
+            LOG.warn('*** Server busy, reject client: %s:%s.' % (rhost, rport))
+            self.rejected += 1
+            self.notify(client, 'Server busy, please try again later.')
+            client.close()
+            return
+        self.backlog.append((client, rhost, rport, accepted_at))
+        position = len(self.backlog)
+        LOG.warn('*** Server busy, queue client: %s:%s at position: %s.'
+                 % (rhost, rport, position))
+        self.notify(client, 'Server busy, your position in queue: %s.'
+                    % position)
+
+    def dispatch(self, client, rhost, rport, accepted_at=None):
+        try:
+            self.pool.submit(client, rhost, rport, accepted_at)
+        finally:
+            client.close()
+
+    def drain(self):
+        """Hand queued connections to the workers that became idle.
+        """
+        while self.backlog and self.pool.idle > 0:
+            self.dispatch(*self.backlog.popleft())
+
+    def refresh(self):
+        """Tell every queued client its current position once a second.
+        """
+        now = time.monotonic()
+        if now < self.next_refresh:
+            return
+        self.next_refresh = now + 1
+        for position, (client, rhost, rport,
+                       accepted_at) in enumerate(self.backlog, 1):
+            self.notify(client, 'Server busy, your position in queue: %s.'
+                        % position)
+
+    def notify(self, client, msg):
+        try:
+            client.setblocking(False)
+            client.send(('%s\r\n' % msg).encode('utf-8'))
+        except OSError:
+            pass
+
+    def status(self):
+        pool = self.pool
+        return {
+            'time': int(time.time()),
+            'workers': len(pool.workers),
+            'busy': pool.busy,
+            'idle': max(pool.idle, 0),
+            'queued': pool.queued,
+            'backlog': len(self.backlog),
+            'rejected': self.rejected,
+            'min_size': pool.min_size,
+            'max_size': pool.max_size,
+        }
+
+    def dump_status(self):
+        now = time.monotonic()
+        if not self.status_file or now < self.next_dump:
+            return
+        self.next_dump = now + 1
+        tmp_file = '%s.tmp' % self.status_file
+        try:
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.status(), fp)
+            os.rename(tmp_file, self.status_file)
+        except OSError as _ex:
+            LOG.error('*** Dump pool status failed: %s' % str(_ex))
@@ -0,0 +1,322 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import queue
+import logging
+import threading
+import traceback
+import collections
+import multiprocessing.util
+from datetime import datetime
+
+from oslo_config import cfg
+
+from lanus.bastion.lib.buffer import BufferPool
+from lanus.bastion.lib.frames import INDEX_ENTRY
+from lanus.bastion.lib.frames import codec
+from lanus.bastion.lib.frames import compress
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.offload import CleanerPool
+from lanus.bastion.lib.writer import RecordWriter
+
+LOG = logging.getLogger(__name__)
+
+record_opts = [
+    cfg.StrOpt('record_path', help='record operation log path.'),
+    cfg.IntOpt('queue_size', default=1024,
+               help='records waiting to be written per process, more are '
+                    'dropped instead of blocking the sessions.'),
+    cfg.IntOpt('batch_size', default=64,
+               help='records written together at most.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(record_opts, 'RECORD')
+
+# NOTE(进程退出时等待记录写完的最长时间)
+STOP_TIMEOUT = 5
+
+# NOTE: is_end为True表示该channel的会话结束, 关闭其记录文件;
+#       is_partial为True表示同一命令的输出还未结束, 下一条记录接着写.
+Record = collections.namedtuple('Record', ['ip', 'username', 'channel_id',
+                                           'io_cleaner', 'cmd_data',
+                                           'log_buffer', 'oper_at', 'is_end',
+                                           'is_partial'],
+                                defaults=(False, False))
+
+FrameBlock = collections.namedtuple('FrameBlock', ['name', 'header',
+                                                   'first_ms', 'data'])
+
+
+class Recorder:
+    """Writes the command and output records of every session of the process.
+
+    Sessions queue their records and go on relaying, a single thread cleans
+    and writes them in batches. The queue is bounded: when the disk cannot
+    keep up records are dropped and counted instead of blocking the users.
+    """
+
+    _instance = None
+    _pid = None
+
+    @classmethod
+    def instance(cls):
+        pid = os.getpid()
+        if cls._instance is None or cls._pid != pid:
+            cls._instance = cls()
+            cls._pid = pid
+        return cls._instance
+
+    def __init__(self):
+        self.queue = queue.Queue(CONF.RECORD.queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.writer = RecordWriter(CONF.RECORD.record_path)
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.frame_bytes = 0
+        self.frame_stored = 0
+        self.offloaded = 0
+        self.clean_dropped = 0
+        # NOTE(master启动了clean进程时, 输出交给它们清洗和写入)
+        self.offload = CleanerPool.instance()
+        # NOTE: multiprocessing子进程退出时不执行atexit, 用Finalize写完剩余记录.
+        multiprocessing.util.Finalize(None, self.stop, exitpriority=10)
+        Metrics.instance().collect(self.collect_metrics)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run,
+                                           name='lanus-recorder')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self, ip, username, channel_id, io_cleaner, cmd_data,
+               log_buffer, is_partial=False):
+        """Queue one record, returns ``False`` if it was dropped.
+
+        ``cmd_data`` is the raw input line, cleaned here like the output so
+        the screen of ``io_cleaner`` is only ever used by this thread.
+        """
+        record = Record(ip, username, channel_id, io_cleaner,
+                        cmd_data, log_buffer, datetime.now(),
+                        is_partial=is_partial)
+        if self.put(record):
+            return True
+        LOG.warn('*** Record queue full, drop record of user: %s on '
+                 'host: %s.' % (username, ip))
+        if log_buffer is not None:
+            BufferPool.instance().release(log_buffer)
+        return False
+
+    def submit_frames(self, name, header, first_ms, data):
+        """Queue one raw frame block of the ``.rec`` file ``name``.
+        """
+        if self.put(FrameBlock(name, header, first_ms, data)):
+            return True
+        LOG.warn('*** Record queue full, drop frames of: %s.' % name)
+        return False
+
+    def put(self, item):
+        self.start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def finish(self, ip, username, channel_id, io_cleaner=None):
+        """Close the record files of a channel once its records are written.
+        """
+        record = Record(ip, username, channel_id, io_cleaner, None, None,
+                        None, True)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # NOTE(写满时不关闭, 文件由LRU淘汰)
+            pass
+
+    def run(self):
+        is_running = True
+        while is_running:
+            try:
+                batch = [self.queue.get(timeout=CONF.RECORD.flush_interval)]
+            except queue.Empty:
+                self.writer.tick()
+                continue
+            while len(batch) < CONF.RECORD.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                is_running = False
+                batch = [record for record in batch if record is not None]
+            self.write_batch(batch)
+            self.writer.tick()
+        self.writer.close_all()
+
+    def write_batch(self, batch):
+        # NOTE(同一文件的多条记录合并成一次写入)
+        contents = collections.OrderedDict()
+        finished = []
+        for record in batch:
+            if isinstance(record, FrameBlock):
+                self.write_frames(record)
+                continue
+            if record.is_end:
+                finished.append(self.stem(record))
+                if self.offload is not None and record.io_cleaner is not None:
+                    self.offload.end(self.clean_key(record),
+                                     self.stem(record))
+                continue
+            try:
+                for record_file, content in self.format(record):
+                    contents.setdefault(record_file, []).append(content)
+            except:
+                LOG.error(traceback.format_exc())
+                with self.lock:
+                    self.errors += 1
+            finally:
+                if record.log_buffer is not None:
+                    BufferPool.instance().release(record.log_buffer)
+
+        for record_file, content_list in contents.items():
+            try:
+                self.writer.write(record_file, content_list)
+            except:
+                LOG.error(traceback.format_exc())
+                with self.lock:
+                    self.errors += 1
+        for stem in finished:
+            self.writer.close(stem)
+        with self.lock:
+            self.written += len(batch)
+            self.batches += 1
+
+    def write_frames(self, block):
+        codec_name = codec()
+        try:
+            # NOTE(新文件, 包括跨天后的新文件, 先写入文件头)
+            if self.writer.offset(block.name) == 0:
+                self.write_block(block.name, 0, block.header, codec_name)
+            self.write_block(block.name, block.first_ms, block.data,
+                             codec_name)
+        except:
+            LOG.error(traceback.format_exc())
+            with self.lock:
+                self.errors += 1
+
+    def write_block(self, name, first_ms, data, codec_name):
+        compressed = compress(data, codec_name)
+        offset = self.writer.write_bytes(name, compressed)
+        self.writer.write_bytes('%s.idx' % name,
+                                INDEX_ENTRY.pack(first_ms, offset,
+                                                 len(compressed)))
+        with self.lock:
+            self.frame_bytes += len(data)
+            self.frame_stored += len(compressed)
+
+    def stem(self, record):
+        return '%s_%s_%s' % (record.ip, record.username, record.channel_id)
+
+    def clean_key(self, record):
+        # NOTE(同一channel的输出总是交给同一个clean进程, 保持终端状态)
+        return '%s-%s' % (os.getpid(), id(record.io_cleaner))
+
+    def format(self, record):
+        """Yield ``(record file, content)`` of the command and the output.
+
+        The output goes to the clean processes instead when they run.
+        """
+        prefix = self.stem(record)
+        # NOTE(命令记录)
+        if record.cmd_data:
+            user_input_cmd = record.io_cleaner.input_clean(record.cmd_data)
+            if user_input_cmd:
+                oper_at = record.oper_at.strftime('%Y-%m-%d %H:%M:%S')
+                yield ('%s.cmd' % prefix,
+                       '[%s] %s' % (oper_at, user_input_cmd))
+
+        # NOTE(日志记录-清洗)
+        log_buffer = record.log_buffer
+        if log_buffer is not None:
+            if log_buffer.dropped:
+                LOG.info('** Record of user: %s on host: %s truncated %s '
+                         'bytes of output.' % (record.username, record.ip,
+                                               log_buffer.dropped))
+            if self.offload is not None:
+                self.offload_output(record, '%s.log' % prefix)
+                return
+            output_msg = record.io_cleaner.output_clean(
+                log_buffer.segments(), record.is_partial)
+            if output_msg or not record.is_partial:
+                yield '%s.log' % prefix, output_msg
+
+    def offload_output(self, record, record_file):
+        if self.offload.clean(self.clean_key(record), record_file,
+                              record.io_cleaner,
+                              record.log_buffer.segments(),
+                              record.is_partial):
+            with self.lock:
+                self.offloaded += 1
+            return
+        LOG.warn('*** Clean processes busy, drop output of user: %s on '
+                 'host: %s.' % (record.username, record.ip))
+        with self.lock:
+            self.clean_dropped += 1
+
+    def stop(self):
+        """Write the queued records and stop the thread.
+        """
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=STOP_TIMEOUT)
+        except queue.Full:
+            return
+        thread.join(STOP_TIMEOUT)
+
+    def snapshot(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(),
+                    'submitted': self.submitted,
+                    'dropped': self.dropped,
+                    'written': self.written,
+                    'batches': self.batches,
+                    'errors': self.errors,
+                    'frame_bytes': self.frame_bytes,
+                    'frame_stored': self.frame_stored,
+                    'offloaded': self.offloaded,
+                    'clean_dropped': self.clean_dropped,
+                    'clean_waits': (self.offload.waits()
+                                    if self.offload is not None else 0)}
+
+    def collect_metrics(self, metrics):
+        snapshot = self.snapshot()
+        metrics.set('lanus_recorder_queue_depth', snapshot['queued'])
+        for state in ('submitted', 'dropped', 'written', 'offloaded',
+                      'clean_dropped'):
+            metrics.set('lanus_recorder_records_total', snapshot[state],
+                        state=state)
+        metrics.set('lanus_recorder_errors_total', snapshot['errors'])
+        metrics.set('lanus_recorder_frame_bytes_total',
+                    snapshot['frame_bytes'], state='raw')
+        metrics.set('lanus_recorder_frame_bytes_total',
+                    snapshot['frame_stored'], state='stored')
@@ -0,0 +1,374 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import signal
+import logging
+import tarfile
+import traceback
+import multiprocessing
+from datetime import datetime
+from datetime import timedelta
+
+from oslo_config import cfg
+
+from lanus.bastion.lib.cmdindex import DAY_PATTERN
+from lanus.bastion.lib.cmdindex import CommandIndex
+
+LOG = logging.getLogger(__name__)
+
+retention_opts = [
+    cfg.BoolOpt('is_clean_today_log', default=False,
+                help='run the log clean in a background process of the '
+                     'master: pack the closed days, delete the expired ones '
+                     'and keep record_path under max_record_size.'),
+    cfg.IntOpt('retention_days', default=180,
+               help='days of records kept besides today, older day '
+                    'directories are deleted, 0 keeps them all.'),
+    cfg.IntOpt('pack_after_days', default=1,
+               help='day directories this many days old are packed.'),
+    cfg.IntOpt('pack_file_size', default=1048576,
+               help='.log files smaller are rolled into the pack.tar.gz '
+                    'of their day, larger ones gzipped alone.'),
+    cfg.IntOpt('max_record_size', default=0,
+               help='megabytes of day directories kept at most, the oldest '
+                    'days but today are deleted beyond, 0 is unlimited.'),
+    cfg.IntOpt('retention_io_rate', default=8388608,
+               help='bytes per second read and written by the log clean, '
+                    '0 is unlimited.'),
+    cfg.IntOpt('retention_interval', default=3600,
+               help='seconds between two log clean passes.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(retention_opts, 'RECORD')
+
+# NOTE: 只打包.log; .cmd的位置记在命令索引里, .rec已按块压缩, .idx和.rec.key
+#       供回放随机读取, 都保持原样.
+PACK_SUFFIXES = ('.log',)
+PACK_NAME = 'pack'
+TMP_SUFFIX = '.tmp'
+
+# NOTE(零点后的写缓冲在flush_interval内落盘, 留足余量再视为关闭)
+CLOSE_GRACE = 3600
+
+COPY_SIZE = 65536
+# NOTE(删除文件按固定字节数计入限速, 避免大量unlink集中提交)
+UNLINK_COST = 4096
+
+
+class Throttle:
+    """Token bucket limiting the bytes per second of the log clean.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+
+    def consume(self, size):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.allowance = min(self.rate,
+                             self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        self.allowance -= size
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+
+class ThrottledReader:
+    """File wrapper paying every read to the throttle, for tarfile.
+    """
+
+    def __init__(self, fp, throttle):
+        self.fp = fp
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
+def day_start(day):
+    return datetime.strptime(day, '%Y%m%d')
+
+
+class RecordRetention:
+    """Pack, expire and cap the day directories under ``record_path``.
+
+    A day is closed an hour after its midnight, once every writer rolled
+    over and flushed. Days past ``retention_days`` are deleted, closed days
+    have their ``.log`` records packed, then the oldest days are deleted
+    until the ``max_record_size`` ceiling holds. The ``.cmd`` records stay
+    as they are for the command index, which forgets the deleted days.
+    Every byte read, written or unlinked goes through one throttle.
+    """
+
+    def __init__(self, record_path, index_file=None, throttle=None):
+        self.record_path = record_path
+        self.index_file = index_file or os.path.join(record_path,
+                                                     'cmd_index.db')
+        self.throttle = throttle or Throttle(CONF.RECORD.retention_io_rate)
+        self.index = None
+
+    def days(self):
+        try:
+            names = os.listdir(self.record_path)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if DAY_PATTERN.match(name) and
+                      os.path.isdir(os.path.join(self.record_path, name)))
+
+    def run(self):
+        """One pass of the log clean, returns ``(packed, deleted)`` days.
+        """
+        begin_time = time.monotonic()
+        now = datetime.now()
+        today = now.strftime('%Y%m%d')
+        days = self.days()
+        expire_day = ''
+        if CONF.RECORD.retention_days > 0:
+            expire_day = (now - timedelta(
+                days=CONF.RECORD.retention_days)).strftime('%Y%m%d')
+        try:
+            deleted = []
+            for day in [day for day in days if day < expire_day]:
+                self.delete_day(day)
+                deleted.append(day)
+            days = [day for day in days if day >= expire_day]
+
+            packed = 0
+            pack_before = now - timedelta(days=CONF.RECORD.pack_after_days,
+                                          seconds=CLOSE_GRACE)
+            for day in days:
+                if day != today and day_start(day) <= pack_before and \
+                   self.pack_day(day):
+                    packed += 1
+            # NOTE(打包后再按总大小删除, 按压缩后的大小计算)
+            deleted.extend(self.cap_size(days, today))
+        finally:
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+        LOG.info('** Log clean packed %s days, deleted %s days in %.3fs.'
+                 % (packed, len(deleted), time.monotonic() - begin_time))
+        return packed, deleted
+
+    def command_index(self):
+        """The command index, ``None`` if it was never built.
+        """
+        if self.index is None and os.path.exists(self.index_file):
+            self.index = CommandIndex(self.record_path, self.index_file)
+            self.index.update()
+        return self.index
+
+    def pack_day(self, day):
+        """Pack the ``.log`` records of a closed day, ``False`` if none left.
+        """
+        day_path = os.path.join(self.record_path, day)
+        small, large = [], []
+        for entry in os.scandir(day_path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(TMP_SUFFIX):
+                # NOTE(上次打包中断留下的临时文件)
+                os.unlink(entry.path)
+            elif entry.name.endswith(PACK_SUFFIXES):
+                if entry.stat().st_size < CONF.RECORD.pack_file_size:
+                    small.append(entry.name)
+                else:
+                    large.append(entry.name)
+        if not small and not large:
+            return False
+
+        for name in sorted(large):
+            self.gzip_file(day_path, name)
+        if small:
+            self.pack_files(day_path, sorted(small))
+        LOG.info('** Log clean packed day: %s, %s files rolled, %s gzipped.'
+                 % (day, len(small), len(large)))
+        return True
+
+    def gzip_file(self, day_path, name):
+        path = os.path.join(day_path, name)
+        gz_path = path + '.gz'
+        # NOTE(已有.gz说明上次压缩完成但未删除原文件)
+        if not os.path.exists(gz_path):
+            tmp_path = gz_path + TMP_SUFFIX
+            with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                while True:
+                    data = src.read(COPY_SIZE)
+                    if not data:
+                        break
+                    self.throttle.consume(len(data))
+                    dst.write(data)
+            self.throttle.consume(os.path.getsize(tmp_path))
+            shutil.copystat(path, tmp_path)
+            os.rename(tmp_path, gz_path)
+        self.unlink(path)
+
+    def pack_files(self, day_path, names):
+        # NOTE(上次打包完成但未删除原文件时, 跳过已在包中的文件)
+        packed = self.packed_members(day_path)
+        names_left = [name for name in names
+                      if packed.get(name) != os.path.getsize(
+                          os.path.join(day_path, name))]
+        if names_left:
+            pack_path = self.pack_path(day_path)
+            tmp_path = pack_path + TMP_SUFFIX
+            with tarfile.open(tmp_path, 'w:gz') as tar:
+                for name in names_left:
+                    path = os.path.join(day_path, name)
+                    info = tar.gettarinfo(path, arcname=name)
+                    with open(path, 'rb') as fp:
+                        tar.addfile(info, ThrottledReader(fp, self.throttle))
+            self.throttle.consume(os.path.getsize(tmp_path))
+            os.rename(tmp_path, pack_path)
+        for name in names:
+            self.unlink(os.path.join(day_path, name))
+
+    def pack_names(self, day_path):
+        return sorted(name for name in os.listdir(day_path)
+                      if name.startswith(PACK_NAME) and
+                      name.endswith('.tar.gz'))
+
+    def pack_path(self, day_path):
+        names = set(self.pack_names(day_path))
+        name = '%s.tar.gz' % PACK_NAME
+        number = 1
+        while name in names:
+            number += 1
+            name = '%s-%s.tar.gz' % (PACK_NAME, number)
+        return os.path.join(day_path, name)
+
+    def packed_members(self, day_path):
+        members = {}
+        for name in self.pack_names(day_path):
+            try:
+                with tarfile.open(os.path.join(day_path, name), 'r:gz') as tar:
+                    for info in tar:
+                        members[info.name] = info.size
+            except (OSError, tarfile.TarError) as _ex:
+                LOG.warn('** Log clean read pack: %s failed: %s'
+                         % (name, str(_ex)))
+        return members
+
+    def unlink(self, path):
+        self.throttle.consume(UNLINK_COST)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def delete_day(self, day):
+        day_path = os.path.join(self.record_path, day)
+        index = self.command_index()
+        if index is not None:
+            index.forget(day)
+        for root, dirs, files in os.walk(day_path, topdown=False):
+            for name in files:
+                self.unlink(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(day_path)
+        LOG.info('** Log clean deleted day: %s.' % day)
+
+    def day_size(self, day):
+        size = 0
+        for root, dirs, files in os.walk(os.path.join(self.record_path, day)):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
+
+    def cap_size(self, days, today):
+        """Delete the oldest days until ``max_record_size`` holds.
+        """
+        limit = CONF.RECORD.max_record_size * 1024 * 1024
+        if limit <= 0:
+            return []
+        sizes = [(day, self.day_size(day)) for day in days]
+        total = sum(size for day, size in sizes)
+        deleted = []
+        for day, size in sizes:
+            if total <= limit:
+                break
+            if day == today:
+                LOG.warn('** Log clean: today alone is over '
+                         'max_record_size: %s bytes.' % total)
+                break
+            self.delete_day(day)
+            deleted.append(day)
+            total -= size
+        return deleted
+
+
+def retention_loop():
+    """Main of the log clean process: one pass per ``retention_interval``.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # NOTE(最低CPU优先级, 磁盘读写由Throttle限速, 不和会话抢资源)
+    os.nice(19)
+    retention = RecordRetention(CONF.RECORD.record_path,
+                                CONF.RECORD.index_file)
+    while True:
+        try:
+            retention.run()
+        except Exception:
+            LOG.error(traceback.format_exc())
+        time.sleep(CONF.RECORD.retention_interval)
+
+
+class RetentionProcess:
+    """Log clean process started by the master, restarted when it exits.
+    """
+
+    @classmethod
+    def start(cls):
+        if not CONF.RECORD.is_clean_today_log or not CONF.RECORD.record_path:
+            return None
+        retention = cls()
+        retention.maintain()
+        return retention
+
+    def __init__(self):
+        self.process = None
+
+    @property
+    def sentinels(self):
+        if self.process is None:
+            return []
+        return [self.process.sentinel]
+
+    def maintain(self):
+        proc = self.process
+        if proc is not None:
+            if proc.is_alive():
+                return
+            proc.join()
+            LOG.error('*** Log clean process pid: %s exit with code: %s.'
+                      % (proc.pid, proc.exitcode))
+        proc = multiprocessing.Process(target=retention_loop)
+        proc.daemon = True
+        proc.start()
+        self.process = proc
+        LOG.info('*** Log clean process started on pid: %s.' % proc.pid)
+
+    def terminate(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
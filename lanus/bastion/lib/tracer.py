@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import json
+import time
+import uuid
+import logging
+import contextlib
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+trace_opts = [
+    cfg.StrOpt('trace_file', default=None,
+               help='jsonl file the login phases are traced to, one span '
+                    'per line, unset disables the tracing.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(trace_opts, 'METRICS')
+
+# NOTE: 登录各阶段的先后顺序, lanus-trace按此顺序输出.
+PHASES = ['load_server_moduli', 'accept', 'start_server', 'auth_validate',
+          'get_user_asset', 'get_ldap_pass', 'ssh_connect', 'open_shell']
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Tracer:
+    """Write the login phase spans of the process to ``trace_file``.
+
+    Each span is one json line with the trace id of its transport, so the
+    phases of a login can be put together across the transport thread,
+    the session thread and the reactor. Lines are appended with a single
+    write on an ``O_APPEND`` descriptor, every worker shares the file.
+    """
+
+    _instance = None
+    _pid = None
+
+    @classmethod
+    def instance(cls):
+        pid = os.getpid()
+        if cls._instance is None or cls._pid != pid:
+            cls._instance = cls(CONF.METRICS.trace_file)
+            cls._pid = pid
+        return cls._instance
+
+    def __init__(self, trace_file):
+        self.fd = None
+        if trace_file:
+            try:
+                self.fd = os.open(trace_file,
+                                  os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                  0o644)
+            except OSError as _ex:
+                LOG.error('*** Open trace file: %s failed: %s'
+                          % (trace_file, str(_ex)))
+
+    def record(self, trace_id, name, start, duration, **attrs):
+        """Write span ``name`` begun at epoch ``start``, lasting seconds.
+        """
+        if self.fd is None:
+            return
+        span = {'trace': trace_id, 'span': name, 'start': round(start, 6),
+                'ms': round(duration * 1000, 3), 'pid': os.getpid()}
+        span.update(attrs)
+        try:
+            os.write(self.fd, (json.dumps(span) + '\n').encode('utf-8'))
+        except OSError as _ex:
+            LOG.warn('** Write trace span: %s failed: %s' % (name, str(_ex)))
+
+    @contextlib.contextmanager
+    def span(self, trace_id, name, **attrs):
+        """Time the block, it may add attributes to the yielded dict.
+        """
+        start = time.time()
+        begin_time = time.monotonic()
+        try:
+            yield attrs
+        except BaseException as _ex:
+            attrs.setdefault('error', type(_ex).__name__)
+            raise
+        finally:
+            self.record(trace_id, name, start, time.monotonic() - begin_time,
+                        **attrs)
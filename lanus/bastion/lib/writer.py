@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import time
+import logging
+import collections
+from datetime import datetime
+from datetime import timedelta
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+writer_opts = [
+    cfg.IntOpt('max_open_files', default=128,
+               help='record files kept open per process, the least recently '
+                    'written one is closed beyond.'),
+    cfg.IntOpt('flush_bytes', default=65536,
+               help='flush the record files once this many bytes are '
+                    'buffered.'),
+    cfg.FloatOpt('flush_interval', default=1,
+                 help='seconds buffered records are kept before flush.'),
+    cfg.BoolOpt('fsync', default=False,
+                help='fsync the record files on every flush.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(writer_opts, 'RECORD')
+
+
+class RecordWriter:
+    """Open record files of the day directory, written with group commit.
+
+    Files stay open in a LRU and writes are buffered until ``flush_bytes``
+    or ``flush_interval`` is reached. The day directory is switched when
+    the precomputed midnight deadline passes, not looked up on each write.
+    Only used by the recorder thread, so nothing here is locked.
+    """
+
+    def __init__(self, record_path):
+        self.record_path = record_path
+        self.files = collections.OrderedDict()
+        self.pending = 0
+        self.next_flush = time.monotonic() + CONF.RECORD.flush_interval
+        self.day_path = None
+        self.rollover_at = 0
+
+    def rollover(self):
+        now = datetime.now()
+        self.close_all()
+        self.day_path = os.path.join(self.record_path,
+                                     now.strftime('%Y%m%d'))
+        os.makedirs(self.day_path, exist_ok=True)
+        midnight = datetime.combine(now.date() + timedelta(days=1),
+                                    datetime.min.time())
+        self.rollover_at = midnight.timestamp()
+
+    def open(self, name, is_binary=False):
+        if time.time() >= self.rollover_at:
+            self.rollover()
+        fp = self.files.get(name)
+        if fp is not None:
+            self.files.move_to_end(name)
+            return fp
+        if len(self.files) >= CONF.RECORD.max_open_files:
+            old_name, old_fp = self.files.popitem(last=False)
+            self.close_file(old_fp)
+        path = os.path.join(self.day_path, name)
+        if is_binary:
+            fp = open(path, 'ab')
+        else:
+            fp = open(path, 'a', encoding='utf-8')
+        self.files[name] = fp
+        return fp
+
+    def write(self, name, content_list):
+        """Append the lines of ``content_list`` to record file ``name``.
+        """
+        fp = self.open(name)
+        for content in content_list:
+            fp.write(content)
+            fp.write('\n')
+            self.pending += len(content) + 1
+        if self.pending >= CONF.RECORD.flush_bytes:
+            self.flush()
+
+    def offset(self, name):
+        """Current size of binary record file ``name``.
+        """
+        return self.open(name, is_binary=True).tell()
+
+    def write_bytes(self, name, data):
+        """Append ``data`` to binary record file ``name``, returns its offset.
+        """
+        fp = self.open(name, is_binary=True)
+        offset = fp.tell()
+        fp.write(data)
+        self.pending += len(data)
+        if self.pending >= CONF.RECORD.flush_bytes:
+            self.flush()
+        return offset
+
+    def tick(self):
+        """Flush when ``flush_interval`` passed, called by the recorder loop.
+        """
+        if self.pending and time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        for fp in self.files.values():
+            self.flush_file(fp)
+        self.pending = 0
+        self.next_flush = time.monotonic() + CONF.RECORD.flush_interval
+
+    def flush_file(self, fp):
+        try:
+            fp.flush()
+            if CONF.RECORD.fsync:
+                os.fsync(fp.fileno())
+        except OSError as _ex:
+            LOG.error('*** Flush record file: %s failed: %s'
+                      % (fp.name, str(_ex)))
+
+    def close_file(self, fp):
+        self.flush_file(fp)
+        try:
+            fp.close()
+        except OSError:
+            pass
+
+    def close(self, prefix):
+        """Close the record files of one channel, named ``prefix.*``.
+        """
+        for name in [name for name in self.files
+                     if name.startswith(prefix + '.')]:
+            self.close_file(self.files.pop(name))
+
+    def close_all(self):
+        while self.files:
+            name, fp = self.files.popitem(last=False)
+            self.close_file(fp)
+        self.pending = 0
@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import sys
+import json
+import math
+import time
+import logging
+import collections
+
+from osmo.base import Application
+from oslo_config import cfg
+
+import lanus.bastion.common as cm
+from lanus.bastion.lib.tracer import PHASES
+
+LOG = logging.getLogger(__name__)
+
+trace_cli_opts = [
+    cfg.StrOpt('trace', positional=True, required=False,
+               help='trace id to print the spans of, default the phase '
+                    'breakdown of every login.'),
+    cfg.StrOpt('file', default=None,
+               help='trace file to read, default METRICS.trace_file.'),
+    cfg.StrOpt('user', default=None,
+               help='only the logins of this bastion user.'),
+    cfg.StrOpt('since', default=None,
+               help='only the logins at or after, YYYY-mm-dd[ HH:MM:SS].'),
+    cfg.StrOpt('until', default=None,
+               help='only the logins before, YYYY-mm-dd[ HH:MM:SS].'),
+    cfg.IntOpt('slowest', default=0,
+               help='also list this many slowest logins with their trace id.')
+]
+
+CONF = cfg.CONF
+CONF.register_cli_opts(trace_cli_opts)
+CONF.import_opt('trace_file', 'lanus.bastion.lib.tracer', 'METRICS')
+
+# NOTE: ssh_connect包含在open_shell中, 服务器模块只在启动时加载一次, 都不计入总耗时.
+NESTED_PHASES = {'ssh_connect', 'load_server_moduli'}
+
+TOTAL = 'total'
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted ``values``.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+def load_spans(trace_file):
+    spans = []
+    with open(trace_file, encoding='utf-8') as fp:
+        for line in fp:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                # NOTE(进程被杀死时可能留下不完整的行)
+                continue
+    return spans
+
+
+class LoginTrace(Application):
+    name = 'lanus login trace'
+    version = '1.0'
+
+    def run(self):
+        trace_file = CONF.file or CONF.METRICS.trace_file
+        if not trace_file:
+            sys.exit('trace file is required, --file or METRICS.trace_file.')
+        spans = load_spans(trace_file)
+        if CONF.trace:
+            self.show_trace([span for span in spans
+                             if span.get('trace') == CONF.trace])
+            return
+        traces = self.group(spans)
+        self.show_phases(spans, traces)
+        if CONF.slowest > 0:
+            self.show_slowest(traces)
+
+    def group(self, spans):
+        """Spans by trace id, filtered by ``user`` and time.
+        """
+        since = cm.parse_time(CONF.since)
+        until = cm.parse_time(CONF.until)
+        traces = collections.OrderedDict()
+        for span in spans:
+            if span.get('trace'):
+                traces.setdefault(span['trace'], []).append(span)
+        for trace_id in list(traces):
+            trace_spans = traces[trace_id]
+            start = min(span['start'] for span in trace_spans)
+            users = {span.get('user') for span in trace_spans}
+            if (CONF.user and CONF.user not in users) or \
+               (since is not None and start < since) or \
+               (until is not None and start >= until):
+                del traces[trace_id]
+        return traces
+
+    def show_phases(self, spans, traces):
+        durations = collections.defaultdict(list)
+        # NOTE(服务器启动阶段没有trace id, 不受过滤条件影响)
+        for span in spans:
+            if not span.get('trace'):
+                durations[span['span']].append(span['ms'])
+        for trace_spans in traces.values():
+            for span in trace_spans:
+                durations[span['span']].append(span['ms'])
+            durations[TOTAL].append(self.total(trace_spans))
+
+        names = [name for name in PHASES if name in durations]
+        names += sorted(name for name in durations
+                        if name not in PHASES and name != TOTAL)
+        if traces:
+            names.append(TOTAL)
+        print('%-20s %8s %10s %10s %10s %8s'
+              % ('phase', 'count', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+        for name in names:
+            values = sorted(durations[name])
+            errors = sum(1 for trace_spans in traces.values()
+                         for span in trace_spans
+                         if span['span'] == name and 'error' in span)
+            print('%-20s %8s %10.1f %10.1f %10.1f %8s'
+                  % (name, len(values), percentile(values, 50),
+                     percentile(values, 99), values[-1], errors))
+        LOG.info('** Login trace read %s spans of %s logins.'
+                 % (len(spans), len(traces)))
+
+    def total(self, trace_spans):
+        return sum(span['ms'] for span in trace_spans
+                   if span['span'] not in NESTED_PHASES)
+
+    def show_slowest(self, traces):
+        slowest = sorted(traces.items(), key=lambda item: self.total(item[1]),
+                         reverse=True)[:CONF.slowest]
+        print('')
+        print('%-16s %-19s %-12s %10s  %s'
+              % ('trace', 'start', 'user', 'total ms', 'slowest phase'))
+        for trace_id, trace_spans in slowest:
+            start = min(span['start'] for span in trace_spans)
+            users = [span['user'] for span in trace_spans if 'user' in span]
+            phase = max(trace_spans, key=lambda span: span['ms'])
+            print('%-16s %-19s %-12s %10.1f  %s (%.1f ms)'
+                  % (trace_id, time.strftime('%Y-%m-%d %H:%M:%S',
+                                             time.localtime(start)),
+                     users[0] if users else '-', self.total(trace_spans),
+                     phase['span'], phase['ms']))
+
+    def show_trace(self, trace_spans):
+        if not trace_spans:
+            sys.exit('trace: %s not found.' % CONF.trace)
+        trace_spans.sort(key=lambda span: span['start'])
+        begin = trace_spans[0]['start']
+        for span in trace_spans:
+            attrs = ' '.join('%s=%s' % (key, span[key]) for key in sorted(span)
+                             if key not in ('trace', 'span', 'start', 'ms'))
+            print('+%9.1f ms %-20s %10.1f ms  %s'
+                  % ((span['start'] - begin) * 1000, span['span'],
+                     span['ms'], attrs))
+
+
+logintrace = LoginTrace().entry_point()
@@ -0,0 +1,131 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import sys
+import time
+import logging
+
+from osmo.base import Application
+from oslo_config import cfg
+
+from lanus.bastion.lib.frames import FrameReader
+from lanus.bastion.lib.frames import OUTPUT_FRAME
+from lanus.bastion.lib.keyframe import KEYFRAME_INTERVAL
+from lanus.bastion.lib.keyframe import KeyframeIndex
+from lanus.bastion.lib.keyframe import render
+
+LOG = logging.getLogger(__name__)
+
+replay_opts = [
+    cfg.StrOpt('record', positional=True,
+               help='.rec file to play, or a directory to build the '
+                    'keyframes of with --build.'),
+    cfg.FloatOpt('speed', default=1,
+                 help='playback speed, such as 1, 2 or 10.'),
+    cfg.StrOpt('seek', default='0',
+               help='start at this offset of the session, seconds or '
+                    '[HH:]MM:SS.'),
+    cfg.FloatOpt('max_wait', default=2,
+                 help='longest pause between two frames, in seconds of the '
+                      'playback.'),
+    cfg.IntOpt('keyframe_interval', default=KEYFRAME_INTERVAL,
+               help='seconds between two screen keyframes.'),
+    cfg.BoolOpt('info', default=False,
+                help='print the record header and duration, no playback.'),
+    cfg.BoolOpt('build', default=False,
+                help='build the keyframes of the record(s), no playback.')
+]
+
+CONF = cfg.CONF
+CONF.register_cli_opts(replay_opts)
+
+
+def parse_offset(value):
+    """Milliseconds of ``value``, seconds or ``[HH:]MM:SS``.
+    """
+    seconds = 0
+    for part in str(value).split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(seconds * 1000)
+
+
+def format_offset(ms):
+    seconds = ms // 1000
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+class Replay(Application):
+    name = 'lanus session replay'
+    version = '1.0'
+
+    def run(self):
+        record = CONF.record
+        if CONF.build:
+            self.build(record)
+            return
+        reader = FrameReader(record)
+        if CONF.info:
+            self.info(reader)
+            return
+        try:
+            self.play(reader, parse_offset(CONF.seek))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout.buffer.write(b'\x1b[0m\r\n')
+            sys.stdout.flush()
+
+    def build(self, record):
+        if os.path.isfile(record):
+            records = [record]
+        else:
+            records = [os.path.join(root, name)
+                       for root, dirs, files in os.walk(record)
+                       for name in sorted(files) if name.endswith('.rec')]
+        for rec_file in records:
+            try:
+                KeyframeIndex.load_or_build(FrameReader(rec_file),
+                                            CONF.keyframe_interval)
+            except Exception as _ex:
+                LOG.error('** Build keyframes of record: %s failed: %s'
+                          % (rec_file, str(_ex)))
+
+    def info(self, reader):
+        header = reader.header or {}
+        for key in sorted(header):
+            print('%-12s %s' % (key, header[key]))
+        print('%-12s %s' % ('duration', format_offset(reader.duration())))
+        print('%-12s %s' % ('blocks', len(reader.index)))
+
+    def play(self, reader, start_ms):
+        out = sys.stdout.buffer
+        index = KeyframeIndex.load_or_build(reader, CONF.keyframe_interval)
+        screen, frames = index.screen_at(start_ms)
+        out.write(render(screen))
+        out.flush()
+
+        speed = CONF.speed if CONF.speed > 0 else 1
+        last_ms = start_ms
+        begin_time = time.monotonic()
+        # NOTE(按帧时间计算应输出的时刻, 避免sleep误差累积)
+        play_at = 0
+        for block, frame, kind, ms, payload in frames:
+            if kind != OUTPUT_FRAME:
+                continue
+            play_at += min((ms - last_ms) / 1000.0 / speed, CONF.max_wait)
+            last_ms = ms
+            delay = begin_time + play_at - time.monotonic()
+            if delay > 0:
+                out.flush()
+                time.sleep(delay)
+            out.write(payload)
+        out.flush()
+
+
+replay = Replay().entry_point()
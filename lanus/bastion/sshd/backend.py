@@ -0,0 +1,243 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import logging
+import threading
+
+import paramiko
+from oslo_config import cfg
+
+from lanus.bastion.lib.metrics import Metrics
+
+LOG = logging.getLogger(__name__)
+
+backend_opts = [
+    cfg.IntOpt('backend_linger', default=300,
+               help='seconds an unused backend connection is kept for new '
+                    'windows of the same session.'),
+    cfg.BoolOpt('prewarm', default=False,
+                help='connect the backend in background as soon as the menu '
+                     'input narrows to one asset.'),
+    cfg.IntOpt('prewarm_ttl', default=5,
+               help='seconds a pre-warmed backend connection waits for the '
+                    'login before it is closed.'),
+    cfg.IntOpt('prewarm_min_chars', default=3,
+               help='characters an ip or hostname input needs before it '
+                    'may pre-warm its single match.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(backend_opts, 'SSH')
+
+
+class BackendConn:
+
+    def __init__(self, ssh_client):
+        self.ssh_client = ssh_client
+        self.channels = []
+        self.idle_since = None
+        # NOTE(预连接未被使用前的过期时间)
+        self.expire_at = None
+
+    @property
+    def transport(self):
+        return self.ssh_client.get_transport()
+
+    def is_active(self):
+        transport = self.transport
+        return transport is not None and transport.is_active()
+
+    def prune(self):
+        self.channels = [chan for chan in self.channels if not chan.closed]
+        if self.channels:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = time.monotonic()
+
+    def close(self):
+        try:
+            self.ssh_client.close()
+        except Exception:
+            pass
+
+
+class BackendPool:
+    """Authenticated backend connections of one session.
+
+    Keyed by (user, ip, port): a new window to a host the session is
+    already logged in opens one more shell channel on the live transport
+    instead of a new tcp connect, key exchange and password auth.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conns = {}
+        self.key_locks = {}
+        # NOTE(被替换但仍有窗口在使用的连接, 窗口全部关闭后再断开)
+        self.retired = []
+        self.warming = set()
+
+    def key_lock(self, key):
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+            return self.key_locks[key]
+
+    def open_shell(self, key, connect, term, width, height):
+        """Return a shell channel to ``key``, ``connect`` makes a new client.
+        """
+        self.reap()
+        with self.key_lock(key):
+            with self.lock:
+                conn = self.conns.get(key)
+            channel = None
+            if conn is not None and conn.is_active():
+                channel = self.reuse(key, conn, term, width, height)
+            if channel is None:
+                if conn is not None:
+                    self.retire(key, conn)
+                conn = BackendConn(connect())
+                channel = conn.ssh_client.invoke_shell(term=term,
+                                                       width=width,
+                                                       height=height)
+                with self.lock:
+                    self.conns[key] = conn
+            conn.expire_at = None
+            conn.channels.append(channel)
+            conn.prune()
+        return channel
+
+    def prewarm(self, key, connect):
+        """Connect ``key`` in background, closed unless used in prewarm_ttl.
+
+        Only takes the lock and starts a thread, so it is safe to call from
+        the reactor thread; the stale prewarm connections are closed there.
+        """
+        with self.lock:
+            if key in self.conns or key in self.warming:
+                return
+            self.warming.add(key)
+            # NOTE(只保留最新的预连接, 输入变化后之前的候选不再需要)
+            stale = [(other, conn) for other, conn in self.conns.items()
+                     if conn.expire_at is not None]
+        worker = threading.Thread(target=self.warm,
+                                  args=(key, connect, stale))
+        worker.daemon = True
+        worker.start()
+
+    def warm(self, key, connect, stale=()):
+        for other, conn in stale:
+            # NOTE(期间已被登录使用的连接不再关闭)
+            with self.key_lock(other):
+                if conn.expire_at is not None:
+                    self.retire(other, conn)
+        # NOTE(连接期间持有key锁, 此时登录同一机器会等待并复用这个连接)
+        try:
+            with self.key_lock(key):
+                with self.lock:
+                    if key in self.conns:
+                        return
+                conn = BackendConn(connect())
+                conn.expire_at = time.monotonic() + CONF.SSH.prewarm_ttl
+                with self.lock:
+                    self.conns[key] = conn
+        except Exception as _ex:
+            LOG.warn('** Prewarm backend connection of %s@%s:%s failed: %s'
+                     % (key + (str(_ex),)))
+            return
+        finally:
+            with self.lock:
+                self.warming.discard(key)
+        LOG.info('** Prewarm backend connection of %s@%s:%s.' % key)
+        timer = threading.Timer(CONF.SSH.prewarm_ttl + 1, self.reap)
+        timer.daemon = True
+        timer.start()
+
+    def reuse(self, key, conn, term, width, height):
+        try:
+            channel = conn.transport.open_session(timeout=10)
+            channel.get_pty(term=term, width=width, height=height)
+            channel.invoke_shell()
+        except Exception as _ex:
+            LOG.warn('** Reuse backend connection failed: %s' % str(_ex))
+            return None
+        LOG.info('** Reuse backend connection of %s@%s:%s.' % key)
+        return channel
+
+    def retire(self, key, conn):
+        with self.lock:
+            if self.conns.get(key) is conn:
+                self.conns.pop(key)
+            conn.prune()
+            if conn.channels and conn.is_active():
+                self.retired.append(conn)
+                return
+        conn.close()
+
+    def reap(self):
+        """Close idle connections and the expired pre-warmed ones.
+        """
+        now = time.monotonic()
+        with self.lock:
+            items = list(self.conns.items())
+        for key, conn in items:
+            conn.prune()
+            if not conn.is_active():
+                self.retire(key, conn)
+            elif conn.expire_at is not None and now > conn.expire_at:
+                LOG.info('** Drop unused prewarm connection of %s@%s:%s.'
+                         % key)
+                self.retire(key, conn)
+            elif conn.idle_since is not None and \
+                    now - conn.idle_since > CONF.SSH.backend_linger:
+                self.retire(key, conn)
+
+        with self.lock:
+            retired = self.retired
+            self.retired = []
+            for conn in retired:
+                conn.prune()
+                if conn.channels and conn.is_active():
+                    self.retired.append(conn)
+        for conn in retired:
+            if conn not in self.retired:
+                conn.close()
+
+    def close_all(self):
+        with self.lock:
+            conns = list(self.conns.values()) + self.retired
+            self.conns.clear()
+            self.retired = []
+        for conn in conns:
+            conn.close()
+
+
+def ssh_connect(ip, port, username, password):
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    result = 'error'
+    begin_time = time.monotonic()
+    try:
+        ssh_client.connect(ip,
+                           port=port,
+                           username=username,
+                           password=password,
+                           allow_agent=True,
+                           look_for_keys=False, compress=True, timeout=120)
+        result = 'ok'
+    finally:
+        Metrics.instance().observe('lanus_backend_connect_seconds',
+                                   time.monotonic() - begin_time,
+                                   result=result)
+    return ssh_client
+
+
+def close_backends(context):
+    # NOTE(DotMap访问不存在的属性会自动创建, 所以用in判断)
+    if 'backend_pool' in context:
+        context.backend_pool.close_all()
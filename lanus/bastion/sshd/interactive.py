@@ -16,8 +16,15 @@ import traceback
 from oslo_config import cfg
 
 import lanus.bastion.common as cm
-from lanus.bastion.lib.checker import Auth
+from lanus.bastion.lib.cache import AssetCache
+from lanus.bastion.lib.credential import wipe_credential
+from lanus.bastion.lib.metrics import track_active
+from lanus.bastion.lib.notifier import release_notifier
+from lanus.bastion.lib.search import AssetIndex
+from lanus.bastion.lib.tracer import Tracer
 from lanus.bastion.lib.toolkit import Toolkit
+from lanus.bastion.sshd.backend import close_backends
+from lanus.bastion.sshd.backend import ssh_connect
 from lanus.bastion.sshd.proxy import SSHProxy
 
 LOG = logging.getLogger(__name__)
@@ -29,97 +36,214 @@ idle_opts = [
 CONF = cfg.CONF
 CONF.register_opts(idle_opts, 'IDLE')
 
+TOOLS_PROMPT = '[lanus@tools ~]# '
 
-class SSHInteractive(threading.Thread):
+PAGER_PROMPT = 'Page %s/%s (Enter/n: next, b: prev, g<N>: jump, q: quit)> '
+
+MIN_PAGE_SIZE = 5
+
+MENU_COMMANDS = ['p', 'r', 't', 'h', 'q']
+
+
+class InteractiveMenu:
+    """Menu logic of one client channel.
+
+    Shared by the threaded ``SSHInteractive`` and the reactor session, the
+    caller owns how keystrokes are read and how blocking calls are made.
+    """
 
     def __init__(self, context, client_channel):
-        super().__init__()
         self.context = context
         self.client = context.client
         self.username = context.username
         self.client_channel = client_channel
-        self.assets = Auth().get_user_asset(self.username)
-
-    def run(self):
-        self.display_banner()
-
-        while True:
-            self.client_channel.sendall(cm.ws(cm.PROMPT, before=0, after=0))
-            try:
-                self.option_handler()
-            except:
-                traceback.print_exc()
-                self.exception_handle()
-                break
+        self.index = AssetIndex([])
+        self.mode = 'menu'
+        self.input_data = []
+        self.pager_assets = []
+        self.pager_index = self.index
+        self.page = 0
+
+    def write(self, data):
+        """Send menu output to the client channel.
+        """
+        self.client_channel.sendall(data)
+
+    @property
+    def assets(self):
+        return self.index.assets
+
+    @property
+    def prompt(self):
+        if self.mode == 'tools':
+            return TOOLS_PROMPT
+        if self.mode == 'pager':
+            return PAGER_PROMPT % (self.page + 1, self.page_count)
+        return cm.PROMPT
+
+    @property
+    def page_size(self):
+        # NOTE(表头和提示符各占一行)
+        height = getattr(self.client_channel, 'win_height', 0) or 33
+        return max(height - 2, MIN_PAGE_SIZE)
+
+    @property
+    def page_count(self):
+        size = self.page_size
+        return max((len(self.pager_assets) + size - 1) // size, 1)
 
     def display_banner(self):
         art = cm.terminal_art()
         nav = cm.terminal_nav(self.username)
-        self.client_channel.sendall(cm.CLEAR_CHAR)
-        self.client_channel.sendall(art + nav)
-        self.client_channel.sendall(cm.ws(''))
+        self.write(cm.CLEAR_CHAR)
+        self.write(art + nav)
+        self.write(cm.ws(''))
+
+    def dispatch(self, option):
+        # NOTE(使用缓存中最新的资产列表, 过期时后台刷新)
+        index = AssetCache.instance().peek(self.username)
+        if index is not None:
+            self.index = index
+        if self.mode == 'tools':
+            self.tool_handler(option)
+        elif self.mode == 'pager':
+            self.pager_handler(option)
+        else:
+            self.option_handler(option)
 
-    def option_handler(self):
-        option = self.readline()
+    def option_handler(self, option):
         if not option or option == '':
             pass
         elif option in ['p', 'P']:
             self.show_hostlist()
         elif option.startswith('/'):
             self.show_searchinfo(option)
+        elif option in ['r', 'R']:
+            self.refresh_assets()
         elif option in ['t', 'T']:
             self.entry_tool_page()
         elif option in ['h', 'H']:
             self.display_banner()
         elif option in ['q', 'Q']:
-            self.logout()
-            sys.exit(1)
+            self.quit()
         else:
             search_result = self.search_asset(option)
             if len(search_result) == 1:
                 self.redirect_ssh_proxy(search_result[0])
             elif len(search_result) == 0:
-                self.client_channel.sendall(cm.ws(
+                self.write(cm.ws(
                     'No asset match, please input again',
                     after=1, level='warn'))
             else:
-                self.client_channel.sendall(cm.ws(
+                self.write(cm.ws(
                     'Search result not unique, search again',
                     after=1, level='warn'))
                 self.show_hostlist()
 
+    def refresh_assets(self):
+        self.index = AssetCache.instance().get(self.username, refresh=True)
+        self.show_refresh_result()
+
+    def show_refresh_result(self):
+        self.write(cm.ws(
+            'Asset list refreshed, total: %s' % len(self.assets)))
+
     def show_hostlist(self):
         self.show_asset_table(self.assets)
 
     def show_asset_table(self, asset_list):
+        self.pager_assets = asset_list
+        self.pager_index = self.index
+        self.page = 0
+        self.show_page()
+
+    def show_page(self):
+        """Render one screen of the asset table with a single write.
+        """
+        size = self.page_size
+        begin = self.page * size
         line = '[%-4s] %-20s %-15s %-30s'
-        self.client_channel.sendall(cm.ws(
-            cm.wc(line % ('ID', 'IP', 'Port', 'Hostname'))))
-        for index, item in enumerate(asset_list):
-            self.client_channel.sendall(cm.ws(cm.wc(
-                    line % (index, item.ip, item.port, item.hostname), False)))
+        table = [cm.ws(cm.wc(line % ('ID', 'IP', 'Port', 'Hostname')))]
+        for item in self.pager_assets[begin:begin + size]:
+            # NOTE(ID为资产在完整列表中的位置, 搜索结果中也可直接输入登录)
+            table.append(cm.ws(cm.wc(line % (self.pager_index.position(item),
+                                             item.ip,
+                                             item.port,
+                                             item.hostname), False)))
+        self.write(''.join(table))
+        if self.page_count > 1:
+            self.mode = 'pager'
+        else:
+            self.mode = 'menu'
+
+    def pager_handler(self, option):
+        if option in ['', 'n', 'N']:
+            if self.page + 1 >= self.page_count:
+                self.mode = 'menu'
+                return
+            self.page += 1
+        elif option in ['b', 'B']:
+            self.page = max(self.page - 1, 0)
+        elif option[:1] in ['g', 'G'] and option[1:].strip().isdigit():
+            page = int(option[1:].strip()) - 1
+            self.page = min(max(page, 0), self.page_count - 1)
+        elif option in ['q', 'Q']:
+            self.mode = 'menu'
+            return
+        else:
+            # NOTE(其他输入退出分页, 按菜单命令处理)
+            self.mode = 'menu'
+            self.option_handler(option)
+            return
+        self.show_page()
 
     def show_searchinfo(self, option):
         option = option.lstrip('/').strip().lower()
         search_result = self.search_asset(option)
         self.show_asset_table(search_result)
+        if len(search_result) == 1:
+            self.prewarm(search_result[0])
 
     def search_asset(self, option):
-        if option:
-            search_result = []
-            # NOTE(按id方式搜索)
-            if option.isdigit() and int(option) < len(self.assets):
-                search_result = [self.assets[int(option)]]
-            else:
-                # NOTE(按ip/hostname匹配搜索)
-                search_result = [
-                    asset for asset in self.assets if option in asset.ip
-                ] or [
-                    asset for asset in self.assets
-                    if option in asset.hostname.lower()
-                ]
-            return search_result
-        return self.assets
+        return self.index.search(option)
+
+    def prewarm_input(self):
+        """Pre-connect while typing once the input names a single asset.
+
+        An id prewarms only when no longer id exists, an ip or hostname
+        only from ``prewarm_min_chars`` characters on.
+        """
+        if not CONF.SSH.prewarm or self.mode != 'menu':
+            return
+        try:
+            option = b''.join(self.input_data).strip().decode()
+        except UnicodeDecodeError:
+            return
+        if option.lower() in MENU_COMMANDS or option.startswith('/'):
+            return
+        count = len(self.assets)
+        if option.isdigit() and int(option) < count:
+            # NOTE(再输入一位数字仍可能选中另一台机器时, 不预连)
+            if count > 1 and int(option) * 10 < count:
+                return
+        elif len(option) < CONF.SSH.prewarm_min_chars:
+            return
+        search_result = self.search_asset(option)
+        if len(search_result) == 1:
+            self.prewarm(search_result[0])
+
+    def prewarm(self, asset_info):
+        if not CONF.SSH.prewarm:
+            return
+        username = self.username
+        credential = self.context.credential
+        ip, port = asset_info.ip, asset_info.port
+
+        def connect():
+            # NOTE(ldap密码也在后台获取, 登录时直接使用缓存)
+            return ssh_connect(ip, port, username, credential.get())
+
+        self.context.backend_pool.prewarm((username, ip, port), connect)
 
     def redirect_ssh_proxy(self, asset_info):
         ssh_proxy = SSHProxy(self.context, self.client_channel)
@@ -130,6 +254,156 @@ class SSHInteractive(threading.Thread):
         remote_host = self.context.remote_host
         LOG.info('Logout relay from %s:%s' % (remote_host, self.username))
 
+    def quit(self):
+        self.logout()
+
+    def handle_input(self, data, prompt=cm.PROMPT):
+        """Apply one chunk of keystrokes to the input line.
+
+        Returns the whole line once enter is received, otherwise ``None``.
+        """
+        input_data = self.input_data
+
+        # NOTE(上下键及不支持的键)
+        if data.startswith(b'\x1b') or data in cm.UNSUPPORT_CHAR:
+            self.write('')
+            return None
+
+        # NOTE(Ctrl-L 清屏)
+        if data.startswith(b'\x0c'):
+            self.write(cm.CLEAR_CHAR)
+            self.write(cm.ws(prompt, before=1, after=0))
+            return None
+
+        # NOTE(Ctrl-U 清行)
+        if data.startswith(b'\x15'):
+            clear_line_char = cm.BACKSPACE_CHAR[b'\x7f']
+            for i in range(len(input_data)):
+                self.write(clear_line_char)
+            input_data.clear()
+            return None
+
+        # NOTE(删除符)
+        if data in cm.BACKSPACE_CHAR:
+            if len(input_data) > 0:
+                data = cm.BACKSPACE_CHAR[data]
+                input_data.pop()
+            else:
+                data = cm.BELL_CHAR
+            self.write(data)
+            return None
+
+        # NOTE(回车符转到相应处理函数)
+        if data in cm.ENTER_CHAR:
+            self.write(cm.ws('', after=1))
+            option = b''.join(input_data).strip().decode()
+            input_data.clear()
+            return option
+
+        # NOTE(按下终端快捷键关闭窗口, 也就是断开连接,
+        #      此时发送数据会有异常)
+        try:
+            self.write(data)
+            input_data.append(data)
+        except:
+            return None
+        self.prewarm_input()
+        return None
+
+    def timeout_handle(self):
+        tips = '\033[1;31mLogout\r\n'
+        tips += ('Noting to do, timeout %s seconds, so disconnect.\033[0m'
+                 % CONF.IDLE.timeout)
+        self.write('\r\n' + tips + '\r\n')
+        LOG.warn('*** User %s idle timeout, so disconnect.' % self.username)
+
+    def exception_handle(self):
+        if self.context.channel_list and \
+           self.client_channel == self.context.channel_list[0]:
+            for channel in self.context.channel_list:
+                channel.close()
+            self.client.close()
+            self.context.transport.atfork()
+            wipe_credential(self.context)
+            close_backends(self.context)
+        elif not self.context.channel_list:
+            # NOTE: 先关闭channel、再关闭client socket、最后关闭server.
+            self.client_channel.close()
+            self.client.close()
+            self.context.transport.atfork()
+            wipe_credential(self.context)
+            close_backends(self.context)
+        else:
+            if self.client_channel in self.context.channel_list:
+                self.context.channel_list.remove(self.client_channel)
+            self.client_channel.close()
+
+    def entry_tool_page(self):
+        tips = cm.tools_nav()
+        self.write(cm.CLEAR_CHAR)
+        self.write(cm.ws(tips, before=0, after=2))
+        self.mode = 'tools'
+
+    def tool_handler(self, option):
+        if not option or option == '':
+            return
+        if option == 'clear':
+            self.write(cm.CLEAR_CHAR)
+            return
+        if option == 'quit':
+            self.mode = 'menu'
+            return
+
+        op_list = re.split('\s+', option)
+        try:
+            cmd = op_list[0]
+            param = op_list[1]
+        except:
+            result = cm.wc('输入格式错误!', has_bg=False)
+            self.write(cm.ws(result, before=0, after=1))
+            return
+
+        tool_layer = Toolkit()
+        try:
+            if cmd == 'ip':
+                result = tool_layer.run_ip(param)
+            elif cmd == 'hostname':
+                result = tool_layer.run_hostname(param)
+            else:
+                result = cm.wc('目前只支持 ip 和 hostname!', has_bg=False)
+        except:
+            result = cm.wc('查询结果不存在!', has_bg=False)
+        self.write(cm.ws(result, before=0, after=1))
+
+
+class SSHInteractive(InteractiveMenu, threading.Thread):
+
+    def __init__(self, context, client_channel):
+        InteractiveMenu.__init__(self, context, client_channel)
+        threading.Thread.__init__(self)
+        with Tracer.instance().span(context.trace_id, 'get_user_asset',
+                                    user=self.username):
+            self.index = AssetCache.instance().get(self.username)
+
+    @track_active('lanus_channels_active')
+    def run(self):
+        self.display_banner()
+
+        while True:
+            self.write(cm.ws(self.prompt, before=0, after=0))
+            try:
+                option = self.readline(self.prompt)
+                self.dispatch(option)
+            except:
+                traceback.print_exc()
+                self.exception_handle()
+                break
+        release_notifier(self.context, self.client_channel)
+
+    def quit(self):
+        self.logout()
+        sys.exit(1)
+
     def readline(self, prompt=cm.PROMPT):
         """Read one line data from the stream.
 
@@ -139,7 +413,7 @@ class SSHInteractive(threading.Thread):
         returned. If EOF is received and the receive buffer is empty, an empty
         bytes or str object is returned.
         """
-        input_data = []
+        self.input_data.clear()
         timeout = CONF.IDLE.timeout
         begin_time = int(time.time())
         while True:
@@ -169,106 +443,6 @@ class SSHInteractive(threading.Thread):
                     self.exception_handle()
                     sys.exit(1)
 
-                # NOTE(上下键及不支持的键)
-                if data.startswith(b'\x1b') or data in cm.UNSUPPORT_CHAR:
-                    self.client_channel.sendall('')
-                    continue
-
-                # NOTE(Ctrl-L 清屏)
-                if data.startswith(b'\x0c'):
-                    self.client_channel.sendall(cm.CLEAR_CHAR)
-                    self.client_channel.sendall(cm.ws(prompt, before=1, after=0))
-                    continue
-
-                # NOTE(Ctrl-U 清行)
-                if data.startswith(b'\x15'):
-                    clear_line_char = cm.BACKSPACE_CHAR[b'\x7f']
-                    for i in range(len(input_data)):
-                        self.client_channel.sendall(clear_line_char)
-                    input_data.clear()
-                    continue
-
-                # NOTE(删除符)
-                if data in cm.BACKSPACE_CHAR:
-                    if len(input_data) > 0:
-                        data = cm.BACKSPACE_CHAR[data]
-                        input_data.pop()
-                    else:
-                        data = cm.BELL_CHAR
-                    self.client_channel.sendall(data)
-                    continue
-
-                # NOTE(回车符转到相应处理函数)
-                if data in cm.ENTER_CHAR:
-                    self.client_channel.sendall(cm.ws('', after=1))
-                    option = b''.join(input_data).strip().decode()
+                option = self.handle_input(data, prompt)
+                if option is not None:
                     return option
-                else:
-                    # NOTE(按下终端快捷键关闭窗口, 也就是断开连接,
-                    #      此时发送数据会有异常)
-                    try:
-                        self.client_channel.sendall(data)
-                        input_data.append(data)
-                    except:
-                        pass
-
-    def timeout_handle(self):
-        tips = '\033[1;31mLogout\r\n'
-        tips += ('Noting to do, timeout %s seconds, so disconnect.\033[0m'
-                 % CONF.IDLE.timeout)
-        self.client_channel.sendall('\r\n' + tips + '\r\n')
-        LOG.warn('*** User %s idle timeout, so disconnect.' % self.username)
-
-    def exception_handle(self):
-        if self.context.channel_list and \
-           self.client_channel == self.context.channel_list[0]:
-            for channel in self.context.channel_list:
-                channel.close()
-            self.client.close()
-            self.context.transport.atfork()
-        elif not self.context.channel_list:
-            # NOTE: 先关闭channel、再关闭client socket、最后关闭server.
-            self.client_channel.close()
-            self.client.close()
-            self.context.transport.atfork()
-        else:
-            if self.client_channel in self.context.channel_list:
-                self.context.channel_list.remove(self.client_channel)
-            self.client_channel.close()
-
-    def entry_tool_page(self, prompt='[lanus@tools ~]# '):
-        tips = cm.tools_nav()
-        self.client_channel.sendall(cm.CLEAR_CHAR)
-        self.client_channel.sendall(cm.ws(tips, before=0, after=2))
-        tool_layer = Toolkit()
-
-        while True:
-            self.client_channel.sendall(cm.ws(prompt, before=0, after=0))
-            option = self.readline(prompt)
-            if not option or option == '':
-                continue
-            if option == 'clear' :
-                self.client_channel.sendall(cm.CLEAR_CHAR)
-                continue
-            if option == 'quit':
-                break
-
-            op_list = re.split('\s+', option)
-            try:
-                cmd = op_list[0]
-                param = op_list[1]
-            except:
-                result = cm.wc('输入格式错误!', has_bg=False)
-                self.client_channel.sendall(cm.ws(result, before=0, after=1))
-                continue
-
-            try:
-                if cmd == 'ip':
-                    result = tool_layer.run_ip(param)
-                elif cmd == 'hostname':
-                    result = tool_layer.run_hostname(param)
-                else:
-                    result = cm.wc('目前只支持 ip 和 hostname!', has_bg=False)
-            except:
-                result = cm.wc('查询结果不存在!', has_bg=False)
-            self.client_channel.sendall(cm.ws(result, before=0, after=1))
@@ -6,16 +6,33 @@
 #
 
 import os
+import time
 import logging
 import threading
 from io import StringIO
 
 import paramiko
+from oslo_config import cfg
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 
 from lanus.bastion.lib.checker import Auth
+from lanus.bastion.lib.credential import SessionCredential
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.tracer import Tracer
+from lanus.bastion.sshd.backend import BackendPool
 
 LOG = logging.getLogger(__name__)
 
+ssh_opts = [
+    cfg.ListOpt('host_key_types', default=['rsa'],
+                help='host key types served to clients, any of rsa, ecdsa '
+                     'and ed25519.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ssh_opts, 'SSH')
+
 
 class SSHServerInterface(paramiko.ServerInterface):
 
@@ -23,10 +40,20 @@ class SSHServerInterface(paramiko.ServerInterface):
         self.context = context
         self.shell_request_event = threading.Event()
         context.change_win_size_event = threading.Event()
+        context.backend_pool = BackendPool()
 
     def check_auth_password(self, username, password):
-        if Auth().validate(username, password):
+        begin_time = time.monotonic()
+        with Tracer.instance().span(self.context.trace_id, 'auth_validate',
+                                    user=username) as span:
+            is_valid = Auth().validate(username, password)
+            span['result'] = 'ok' if is_valid else 'fail'
+        Metrics.instance().observe('lanus_auth_seconds',
+                                   time.monotonic() - begin_time,
+                                   result=span['result'])
+        if is_valid:
             self.context.username = username
+            self.context.credential = SessionCredential(username)
             return paramiko.AUTH_SUCCESSFUL
         return paramiko.AUTH_FAILED
 
@@ -62,28 +89,87 @@ class SSHServerInterface(paramiko.ServerInterface):
         channel.win_width = width
         channel.win_height = height
 
-        # NOTE: 一个channel对应一个线程、一个channel对应一个队列.
-        # NOTE: 主进程感知某个channel的窗口变化, 将数据发送到对应的队列中,
-        #       channel线程从队列取出数据, 根据该数据动态调整窗口大小.
-        change_data = {'width': width, 'height': height}
-        self.context[channel].put(change_data)
+        # NOTE: 一个channel对应一个通知器, transport线程感知窗口变化后
+        #       唤醒该channel的转发循环, 由其调整后端窗口大小.
+        if channel in self.context:
+            self.context[channel].notify(width, height)
         LOG.debug('*** Interface check channel: %s window change data: '
                   '(%s, %s).' % (channel, width, height))
         return True
 
 
 class SSHKeyGen(object):
+    """Host keys and moduli of the bastion server.
+
+    Loaded once by the parent before the workers fork, every transport of
+    every worker then reuses the parsed objects.
+    """
+
+    _host_keys = None
+    _moduli_loaded = None
 
     @classmethod
-    def rsa_key(cls):
+    def key_path(cls, name):
         core_path = os.path.dirname(os.path.abspath(__file__))
         main_path = os.path.dirname(os.path.dirname(core_path))
         proj_path = os.path.dirname(main_path)
-        rsa_key_path = os.path.join(proj_path, '.keys', 'rsa_key')
+        return os.path.join(proj_path, '.keys', name)
+
+    @classmethod
+    def preload(cls):
+        cls.host_keys()
+        with Tracer.instance().span(None, 'load_server_moduli'):
+            is_loaded = cls.load_moduli()
+        if not is_loaded:
+            LOG.warn('*** Failed to load moduli -- gex will be unsupported.')
+
+    @classmethod
+    def host_keys(cls):
+        if cls._host_keys is None:
+            loaders = {
+                'rsa': cls.rsa_key,
+                'ecdsa': cls.ecdsa_key,
+                'ed25519': cls.ed25519_key,
+            }
+            host_keys = []
+            for key_type in CONF.SSH.host_key_types:
+                if key_type not in loaders:
+                    LOG.error('*** Unsupported host key type: %s.' % key_type)
+                    continue
+                host_keys.append(loaders[key_type]())
+            cls._host_keys = host_keys
+        return cls._host_keys
+
+    @classmethod
+    def load_moduli(cls):
+        # NOTE: moduli保存在Transport类属性上, fork后子进程直接复用.
+        if cls._moduli_loaded is None:
+            cls._moduli_loaded = paramiko.Transport.load_server_moduli()
+        return cls._moduli_loaded
+
+    @classmethod
+    def rsa_key(cls):
+        rsa_key_path = cls.key_path('rsa_key')
         if not os.path.isfile(rsa_key_path):
             cls.create_rsa_key(rsa_key_path)
         return paramiko.RSAKey(filename=rsa_key_path)
 
+    @classmethod
+    def ecdsa_key(cls):
+        ecdsa_key_path = cls.key_path('ecdsa_key')
+        if not os.path.isfile(ecdsa_key_path):
+            prv = paramiko.ECDSAKey.generate(bits=256)
+            prv.write_private_key_file(ecdsa_key_path)
+            os.chmod(ecdsa_key_path, 0o600)
+        return paramiko.ECDSAKey(filename=ecdsa_key_path)
+
+    @classmethod
+    def ed25519_key(cls):
+        ed25519_key_path = cls.key_path('ed25519_key')
+        if not os.path.isfile(ed25519_key_path):
+            cls.create_ed25519_key(ed25519_key_path)
+        return paramiko.Ed25519Key(filename=ed25519_key_path)
+
     @classmethod
     def create_rsa_key(cls, filename, length=2048, password=None):
         """Generating private key.
@@ -94,3 +180,15 @@ class SSHKeyGen(object):
         private_key = f.getvalue()
         with open(filename, 'w') as f:
             f.write(private_key)
+
+    @classmethod
+    def create_ed25519_key(cls, filename):
+        """Generating private key, paramiko can only read ed25519 keys.
+        """
+        prv = ed25519.Ed25519PrivateKey.generate()
+        private_key = prv.private_bytes(serialization.Encoding.PEM,
+                                        serialization.PrivateFormat.OpenSSH,
+                                        serialization.NoEncryption())
+        with open(filename, 'wb') as f:
+            f.write(private_key)
+        os.chmod(filename, 0o600)
@@ -5,24 +5,31 @@
 # Author: Jinlong Yang
 #
 
-import os
 import sys
-import copy
 import time
-import queue
 import logging
 import hashlib
 import selectors
-import threading
-import traceback
 from datetime import datetime
 
-import paramiko
 from oslo_config import cfg
 
 import lanus.bastion.common as cm
-from lanus.bastion.lib.checker import Auth
+from lanus.bastion.lib.buffer import BufferPool
+from lanus.bastion.lib.buffer import RingBuffer
 from lanus.bastion.lib.cleaner import IOCleaner
+from lanus.bastion.lib.credential import wipe_credential
+from lanus.bastion.lib.frames import FrameBuffer
+from lanus.bastion.lib.frames import INPUT_FRAME
+from lanus.bastion.lib.frames import OUTPUT_FRAME
+from lanus.bastion.lib.frames import RESIZE
+from lanus.bastion.lib.frames import RESIZE_FRAME
+from lanus.bastion.lib.frames import VERSION
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.recorder import Recorder
+from lanus.bastion.lib.tracer import Tracer
+from lanus.bastion.sshd.backend import close_backends
+from lanus.bastion.sshd.backend import ssh_connect
 
 LOG = logging.getLogger(__name__)
 
@@ -30,13 +37,11 @@ idle_opts = [
     cfg.IntOpt('timeout', help='Noting to do timeout.')
 ]
 
-record_opts = [
-    cfg.StrOpt('record_path', help='record operation log path.')
-]
-
 CONF = cfg.CONF
 CONF.register_opts(idle_opts, 'IDLE')
-CONF.register_opts(record_opts, 'RECORD')
+
+# NOTE(一条命令的输入, 超出部分丢弃最早的字节)
+CMD_BUFFER_SIZE = 4096
 
 
 class SSHProxy:
@@ -45,153 +50,286 @@ class SSHProxy:
         self.context = context
         self.username = context.username
         self.client_channel = client_channel
-        self.password = Auth().get_ldap_pass(self.username)
-        self.pipe = queue.Queue()
+        self.tracer = Tracer.instance()
+        # NOTE(同一会话内只获取一次ldap密码, 连接时才解码, 不保存副本)
+        self.credential = context.credential
+        with self.tracer.span(context.trace_id, 'get_ldap_pass',
+                              user=self.username):
+            self.credential.fetch()
+        self.recorder = Recorder.instance()
+        self.metrics = Metrics.instance()
+        self.is_full_capture = False
 
     def login(self, asset_info, term='xterm', width=167, height=33):
+        backend_channel = self.connect(asset_info, term, width, height)
+        if backend_channel is None:
+            return False
+        self.interactive_shell(backend_channel)
+        return True
+
+    def connect(self, asset_info, term='xterm', width=167, height=33):
+        """Open the backend shell, returns the channel or ``None``.
+        """
         self.ip = asset_info.ip
         self.port = asset_info.port
-
-        # NOTE: 单线程慢慢处理屏幕记录; 原因: 多线程有问题;
-        screen = ScreenCAP(self.username, self.ip, self.pipe)
-        screen.start()
+        self.is_full_capture = (asset_info.get('group') in
+                                CONF.RECORD.full_capture_groups)
 
         try:
             width = self.client_channel.win_width
             height = self.client_channel.win_height
         except:
             pass
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.client_channel.sendall(
+        self.write_client(
             cm.ws('Connecting to %s@%s, please wait....\r\n' % (
                 self.username, self.ip)))
+        key = (self.username, self.ip, self.port)
         try:
-            ssh_client.connect(self.ip,
-                               port=self.port,
-                               username=self.username,
-                               password=self.password,
-                               allow_agent=True,
-                               look_for_keys=False, compress=True, timeout=120)
+            # NOTE(包含新建连接时的ssh_connect, 复用连接时只有invoke_shell)
+            with self.tracer.span(self.context.trace_id, 'open_shell',
+                                  host=self.ip):
+                backend_channel = self.context.backend_pool.open_shell(
+                    key, self.ssh_connect, term, width, height)
         except Exception as _ex:
             msg = 'Connect host: %s failed: %s' % (self.ip, str(_ex))
-            self.client_channel.sendall(cm.ws(msg, level='warn'))
-            return False
+            self.write_client(cm.ws(msg, level='warn'))
+            return None
         LOG.info('** User: %s connect to host: %s success.' % (self.username,
                                                                self.ip))
-        backend_channel = ssh_client.invoke_shell(term=term,
-                                                  width=width,
-                                                  height=height)
         backend_channel.settimeout(100)
-        self.interactive_shell(backend_channel)
-        return True
+        return backend_channel
 
-    def interactive_shell(self, backend_channel):
-        log_info = []
-        cmd_info = []
-        begin_time = None
-        is_input_status = True
-        is_first_input = True
+    def ssh_connect(self):
+        with self.tracer.span(self.context.trace_id, 'ssh_connect',
+                              host=self.ip):
+            return ssh_connect(self.ip, self.port, self.username,
+                               self.credential.get())
 
-        client = self.context.client
+    def interactive_shell(self, backend_channel):
         client_channel = self.client_channel
-        io_cleaner = IOCleaner(client_channel.win_width,
-                               client_channel.win_height)
+        notifier = self.context[client_channel]
+        self.init_record()
 
+        # NOTE: 只等待channel及窗口变化通知, 不再监听transport的socket,
+        #       否则该socket上的每个包都会唤醒一次循环.
         sel = selectors.DefaultSelector()
-        sel.register(client, selectors.EVENT_READ)
         sel.register(client_channel, selectors.EVENT_READ)
         sel.register(backend_channel, selectors.EVENT_READ)
+        sel.register(notifier, selectors.EVENT_READ)
 
+        try:
+            self.relay(sel, notifier, backend_channel)
+        finally:
+            sel.close()
+            self.finish_record()
+
+    def relay(self, sel, notifier, backend_channel):
+        client_channel = self.client_channel
+        deadline = time.monotonic() + CONF.IDLE.timeout
         while True:
-            events = sel.select(CONF.IDLE.timeout)
-            fd_sets = [key.fileobj for key, mask in events if key]
-            # NOTE(SecureCrt events return [])
-            if not fd_sets:
+            events = sel.select(max(deadline - time.monotonic(), 0))
+            fd_sets = [key.fileobj for key, mask in events]
+            if not fd_sets and time.monotonic() >= deadline:
                 result = self.timeout_handle(client_channel, backend_channel)
                 if result == cm.TimeoutResult.PARENT_TIMEOUT.value:
                     # NOTE(主session超时, 则退到交互式界面.)
                     return
                 sys.exit(1)
 
-            # NOTE(Iterm2 events return [client事件])
-            if client_channel in fd_sets or backend_channel in fd_sets:
-                begin_time = int(time.time())
-            cur_time = int(time.time())
-            if (cur_time - begin_time) > CONF.IDLE.timeout:
-                result = self.timeout_handle(client_channel, backend_channel)
-                if result == cm.TimeoutResult.PARENT_TIMEOUT.value:
-                    # NOTE(主session超时, 则退到交互式界面.)
-                    return
-                sys.exit(1)
+            if notifier in fd_sets:
+                self.resize_backend(backend_channel)
 
-            try:
-                change_data = self.context[self.client_channel].get_nowait()
-                width = change_data.get('width')
-                height = change_data.get('height')
-                LOG.debug('*** Proxy fetch channel: %s window change size: '
-                          '(%s, %s).' % (self.client_channel, width, height))
-                if backend_channel:
-                    backend_channel.resize_pty(width=width, height=height)
-            except:
-                pass
+            if client_channel in fd_sets or backend_channel in fd_sets:
+                deadline = time.monotonic() + CONF.IDLE.timeout
 
             if client_channel in fd_sets:
-                is_input_status = True
                 client_data = client_channel.recv(cm.BUF_SIZE)
                 if len(client_data) == 0:
                     LOG.warn('*** Proxy receive client from user: %s data '
                              'length is 0, so exit.' % self.username)
                     self.exception_handle(backend_channel)
                     sys.exit(1)
-                if client_data in cm.ENTER_CHAR:
-                    is_input_status = False
-                backend_channel.sendall(client_data)
+                self.forward_client(client_data, backend_channel)
 
             if backend_channel in fd_sets:
                 backend_data = backend_channel.recv(cm.BUF_SIZE)
                 if len(backend_data) == 0:
-                    client_channel.sendall(cm.ws(
-                        'Disconnect from %s' % self.ip))
-                    LOG.info('*** Logout from user: %s on host: %s.'
-                             % (self.username, self.ip))
-                    # NOTE(退出该机器, 不能执行sys.exit(1)终止该线程,
-                    #      而是再次回到线程中等待下一次用户的输入)
-                    self.logout_handle(backend_channel)
+                    self.disconnect_handle(backend_channel)
                     return
+                self.forward_backend(backend_data)
+
+    def init_record(self):
+        self.buffer_pool = BufferPool.instance()
+        self.log_buffer = self.buffer_pool.acquire()
+        self.cmd_buffer = RingBuffer(CMD_BUFFER_SIZE)
+        self.is_finished = False
+        self.is_input_status = True
+        self.is_first_input = True
+        self.is_output = False
+        self.io_cleaner = IOCleaner(self.client_channel.win_width,
+                                    self.client_channel.win_height)
+        self.frames = None
+        self.is_record_input = CONF.RECORD.record_input
+        if CONF.RECORD.record_frames:
+            self.init_frames()
+
+    def init_frames(self):
+        now = datetime.now()
+        channel_id = self.client_channel.get_id()
+        header = {
+            'version': VERSION,
+            'username': self.username,
+            'ip': self.ip,
+            'port': self.port,
+            'channel_id': channel_id,
+            'start': time.time(),
+            'start_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+            'width': self.client_channel.win_width,
+            'height': self.client_channel.win_height,
+        }
+        # NOTE(文件名以channel的记录前缀开头, 会话结束时一起关闭)
+        self.frames_name = '%s_%s_%s.%s.rec' % (self.ip, self.username,
+                                                channel_id,
+                                                now.strftime('%H%M%S'))
+        self.frames = FrameBuffer(header)
+
+    def record_frame(self, kind, payload):
+        frames = self.frames
+        if frames is None:
+            return
+        frames.add(kind, payload)
+        if frames.is_ready():
+            self.handoff_frames()
+
+    def handoff_frames(self):
+        first_ms, block = self.frames.take()
+        if block:
+            self.recorder.submit_frames(self.frames_name, self.frames.header,
+                                        first_ms, block)
+
+    def resize_backend(self, backend_channel):
+        size = self.context[self.client_channel].fetch()
+        if size is None:
+            return
+        width, height = size
+        LOG.debug('*** Proxy fetch channel: %s window change size: '
+                  '(%s, %s).' % (self.client_channel, width, height))
+        self.record_frame(RESIZE_FRAME, RESIZE.pack(width, height))
+        self.io_cleaner.resize(width, height)
+        try:
+            backend_channel.resize_pty(width=width, height=height)
+        except Exception as _ex:
+            LOG.warn('** Resize backend pty failed: %s' % str(_ex))
+
+    def forward_client(self, client_data, backend_channel):
+        self.is_input_status = True
+        if client_data in cm.ENTER_CHAR:
+            self.is_input_status = False
+            self.is_output = False
+        self.write_backend(backend_channel, client_data)
+        self.metrics.inc('lanus_relay_bytes_total', len(client_data),
+                         direction='upstream')
+        # NOTE(按键包含无回显输入的密码, 默认不记录)
+        if self.is_record_input:
+            self.record_frame(INPUT_FRAME, client_data)
+
+    def write_client(self, data):
+        self.client_channel.sendall(data)
+
+    def write_backend(self, backend_channel, data):
+        backend_channel.sendall(data)
+
+    def forward_backend(self, backend_data):
+        cmd_buffer = self.cmd_buffer
+        if self.is_input_status:
+            # step1: 以下记录本次命令的输入.
+            log_buffer = self.log_buffer
+            if log_buffer is not None and self.is_first_input and log_buffer:
+                self.capture(self.preset_timestamp())
+                self.is_first_input = False
+            self.capture(backend_data)
+            cmd_buffer.append(backend_data)
+
+        elif not self.is_output:
+            self.is_first_input = True
+            self.is_output = True
+
+            # NOTE: 此时的log_buffer为: 上一次的输出 + 本次的输入.
+            #       整个buffer交给记录线程, 写完后归还, 这里换一个空的.
+            self.handoff(cmd_buffer.getvalue())
+
+            # step2: 以下记录本次命令的输出.
+            self.capture(backend_data.lstrip(b'\r\n'))
+            cmd_buffer.clear()
 
-                if is_input_status:
-                    # step1: 以下记录本次命令的输入.
-                    if is_first_input and log_info:
-                        log_info.append(self.preset_timestamp())
-                        is_first_input = False
-                    log_info.append(backend_data)
-                    cmd_info.append(backend_data)
-
-                else:
-                    is_first_input = True
-                    user_input_cmd = io_cleaner.input_clean(b''.join(cmd_info))
-
-                    channel_id = client_channel.get_id()
-                    # NOTE: 此时的log_info为: 上一次的输出 + 本次的输入.
-                    self.pipe.put((channel_id,
-                                   io_cleaner,
-                                   user_input_cmd,
-                                   copy.copy(log_info)))
-                    log_info.clear()
-
-                    # step2: 以下记录本次命令的输出.
-                    log_info.append(backend_data.lstrip(b'\r\n'))
-                    cmd_info.clear()
-
-                client_channel.sendall(backend_data)
-                time.sleep(paramiko.common.io_sleep)
+        else:
+            # NOTE(同一命令的后续输出, 超出buffer时只保留开头和最新的部分)
+            self.capture(backend_data)
+
+        self.write_client(backend_data)
+        self.metrics.inc('lanus_relay_bytes_total', len(backend_data),
+                         direction='downstream')
+        self.record_frame(OUTPUT_FRAME, backend_data)
+
+    def capture(self, data):
+        log_buffer = self.log_buffer
+        if log_buffer is None:
+            return
+        if not self.is_full_capture:
+            log_buffer.append(data)
+            return
+        # NOTE(全量记录的资产组, buffer写满时先交给记录线程, 不截断)
+        view = memoryview(data)
+        while view:
+            space = log_buffer.capacity - len(log_buffer)
+            if space <= 0:
+                self.handoff(b'', is_partial=True)
+                log_buffer = self.log_buffer
+                continue
+            log_buffer.append(view[:space])
+            view = view[space:]
+
+    def handoff(self, cmd_data, is_partial=False):
+        log_buffer = self.log_buffer
+        if log_buffer is not None or cmd_data:
+            self.recorder.submit(self.ip, self.username,
+                                 self.client_channel.get_id(),
+                                 self.io_cleaner, cmd_data, log_buffer,
+                                 is_partial)
+        self.log_buffer = self.buffer_pool.acquire()
+
+    def finish_record(self):
+        """Hand the output left since the last command to the recorder.
+        """
+        if self.is_finished:
+            return
+        self.is_finished = True
+        if self.frames is not None:
+            self.handoff_frames()
+        log_buffer, self.log_buffer = self.log_buffer, None
+        channel_id = self.client_channel.get_id()
+        if log_buffer is not None:
+            if log_buffer:
+                self.recorder.submit(self.ip, self.username, channel_id,
+                                     self.io_cleaner, b'', log_buffer)
+            else:
+                self.buffer_pool.release(log_buffer)
+        self.recorder.finish(self.ip, self.username, channel_id,
+                             self.io_cleaner)
+
+    def disconnect_handle(self, backend_channel):
+        self.write_client(cm.ws('Disconnect from %s' % self.ip))
+        LOG.info('*** Logout from user: %s on host: %s.'
+                 % (self.username, self.ip))
+        # NOTE(退出该机器, 不能执行sys.exit(1)终止该线程,
+        #      而是再次回到线程中等待下一次用户的输入)
+        self.logout_handle(backend_channel)
 
     def timeout_handle(self, client_channel, backend_channel):
         tips = '\033[1;31mLogout\r\n'
         tips += ('Noting to do, timeout %s seconds, so disconnect.\033[0m'
                  % CONF.IDLE.timeout)
-        client_channel.sendall('\r\n' + tips + '\r\n')
+        self.write_client('\r\n' + tips + '\r\n')
         LOG.warn('*** User %s on host %s %s' % (self.username, self.ip, tips))
         if client_channel == self.context.channel_list[0]:
             try:
@@ -216,6 +354,8 @@ class SSHProxy:
             for chan in self.context.channel_list:
                 chan.close()
             self.context.transport.atfork()
+            wipe_credential(self.context)
+            close_backends(self.context)
         else:
             if self.client_channel in self.context.channel_list:
                 self.context.channel_list.remove(self.client_channel)
@@ -238,52 +378,3 @@ class SSHProxy:
         oper_at_str = '[Command][%(uuid)s][%(time)s] ' % {'uuid': uuid,
                                                           'time': oper_at}
         return oper_at_str.encode('utf-8')
-
-
-class ScreenCAP(threading.Thread):
-
-    def __init__(self, username, ip, pipe):
-        super(ScreenCAP, self).__init__()
-        self.username = username
-        self.ip = ip
-        self.pipe = pipe
-
-    def run(self):
-        while True:
-            data = self.pipe.get()
-            self.record(*data)
-
-    def record(self, channel_id, io_cleaner, user_input_cmd, log_info):
-        self.io_cleaner = io_cleaner
-        try:
-            self._record_cmd(user_input_cmd, channel_id)
-            self._record_log(log_info, channel_id)
-        except:
-            LOG.error(traceback.format_exc())
-        log_info.clear()
-
-    def _record_cmd(self, user_input_cmd, channel_id):
-        """命令记录
-        """
-        if user_input_cmd:
-            oper_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            input_msg = '[%s] %s' % (oper_at, user_input_cmd)
-            self._write(channel_id, input_msg, 'cmd')
-
-    def _record_log(self, log_info, channel_id):
-        """日志记录-清洗
-        """
-        output_msg = self.io_cleaner.output_clean(b''.join(log_info))
-        self._write(channel_id, output_msg)
-
-    def _write(self, channel_id, content, log_type='log'):
-        today = datetime.now().strftime('%Y%m%d')
-        record_path = '%s/%s' % (CONF.RECORD.record_path, today)
-        if not os.path.isdir(record_path):
-            os.mkdir(record_path)
-        record_file = '%s/%s_%s_%s.%s' % (record_path, self.ip,
-                                          self.username, channel_id, log_type)
-        with open(record_file, 'a') as fp:
-            fp.write(content)
-            fp.write('\n')
-            fp.flush()
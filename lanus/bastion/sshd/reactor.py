@@ -0,0 +1,652 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import socket
+import logging
+import selectors
+import threading
+import traceback
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+from dotmap import DotMap
+from oslo_config import cfg
+
+import lanus.bastion.common as cm
+from lanus.bastion.lib.cache import AssetCache
+from lanus.bastion.lib.credential import wipe_credential
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.notifier import WindowNotifier
+from lanus.bastion.lib.notifier import release_notifier
+from lanus.bastion.lib.tracer import Tracer
+from lanus.bastion.lib.tracer import new_trace_id
+from lanus.bastion.sshd.interface import (
+    SSHKeyGen,
+    SSHServerInterface
+)
+from lanus.bastion.sshd.backend import close_backends
+from lanus.bastion.sshd.interactive import InteractiveMenu
+from lanus.bastion.sshd.proxy import SSHProxy
+
+LOG = logging.getLogger(__name__)
+
+reactor_opts = [
+    cfg.IntOpt('reactor_threads', default=16,
+               help='reactor thread count for blocking calls, such as '
+                    'backend api and backend host connect.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(reactor_opts, 'SERVER')
+
+# NOTE(最多每秒检查一次超时及断开的连接)
+SWEEP_INTERVAL = 1
+
+ACCEPT_BATCH = 64
+
+# NOTE(待发送数据超过该值时暂停读取另一端, 发送完后恢复)
+WRITE_HIGH_WATER = 1048576
+
+
+class HandshakeEvent(threading.Event):
+    """Completion event of a non-blocking ``start_server``.
+
+    Set by the transport thread once the key exchange ends, so the
+    handshake is timed without waiting for it on the reactor.
+    """
+
+    def __init__(self, transport, context):
+        super(HandshakeEvent, self).__init__()
+        self.transport = transport
+        self.context = context
+        self.start = time.time()
+        self.begin_time = time.monotonic()
+
+    def set(self):
+        if not self.is_set():
+            cost = time.monotonic() - self.begin_time
+            attrs = {'host': self.context.remote_host}
+            # NOTE(协商失败时transport已不是active状态)
+            if self.transport.is_active():
+                Metrics.instance().observe('lanus_handshake_seconds', cost)
+            else:
+                attrs['error'] = 'negotiation'
+            Tracer.instance().record(self.context.trace_id, 'start_server',
+                                     self.start, cost, **attrs)
+        super(HandshakeEvent, self).set()
+
+
+class WindowCondition(threading.Condition):
+    """``out_buffer_cv`` of a channel also calling ``on_notify``.
+
+    paramiko notifies it from the transport thread when the peer opens
+    the window or the channel closes.
+    """
+
+    def __init__(self, lock, on_notify):
+        super(WindowCondition, self).__init__(lock)
+        self.on_notify = on_notify
+
+    def notify_all(self):
+        super(WindowCondition, self).notify_all()
+        self.on_notify()
+
+
+class ChannelWriter:
+    """Non-blocking writes of one channel on the reactor thread.
+
+    Sends only what the peer's SSH window takes and keeps the rest
+    pending until paramiko reports a window adjust, so a slow client
+    never stalls the other sessions of the worker and a stalled one costs
+    nothing while its window stays closed.
+    """
+
+    def __init__(self, reactor, channel):
+        self.reactor = reactor
+        self.channel = channel
+        self.pending = collections.deque()
+        self.size = 0
+        self.on_drain = None
+        # NOTE: 此时没有线程在等待该条件变量, 替换后窗口变化由reactor线程发送.
+        channel.out_buffer_cv = WindowCondition(channel.lock, self.on_window)
+
+    def on_window(self):
+        # NOTE(运行在transport线程并持有channel.lock, 只唤醒reactor)
+        if self.pending:
+            self.reactor.call_soon(self.flush)
+
+    @property
+    def is_full(self):
+        return self.size >= WRITE_HIGH_WATER
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data:
+            self.pending.append(data)
+            self.size += len(data)
+        self.flush()
+
+    def flush(self):
+        channel = self.channel
+        try:
+            # NOTE: 只有reactor线程发送, 检查后窗口只会变大, send不会阻塞.
+            while self.pending and channel.send_ready():
+                data = self.pending[0]
+                sent = channel.send(data)
+                self.size -= sent
+                if sent < len(data):
+                    self.pending[0] = data[sent:]
+                else:
+                    self.pending.popleft()
+        except (EOFError, OSError):
+            # NOTE(channel已关闭, 由读事件或sweep清理会话)
+            self.pending.clear()
+            self.size = 0
+
+        if self.pending:
+            return
+        on_drain, self.on_drain = self.on_drain, None
+        if on_drain is not None:
+            on_drain()
+
+    def discard(self):
+        self.pending.clear()
+        self.size = 0
+        self.on_drain = None
+
+
+class ReactorServerInterface(SSHServerInterface):
+
+    def __init__(self, context, reactor):
+        super(ReactorServerInterface, self).__init__(context)
+        self.reactor = reactor
+
+    def check_channel_shell_request(self, channel):
+        # NOTE: 运行在transport线程, 由reactor线程接管该channel.
+        self.reactor.call_soon(self.reactor.add_channel, self.context, channel)
+        return super(ReactorServerInterface,
+                     self).check_channel_shell_request(channel)
+
+
+class ReactorProxy(SSHProxy):
+    """Proxy whose writes go through the session's channel writers.
+    """
+
+    def __init__(self, session):
+        super(ReactorProxy, self).__init__(session.context,
+                                           session.client_channel)
+        self.session = session
+
+    def write_client(self, data):
+        self.session.write(data)
+
+    def write_backend(self, backend_channel, data):
+        self.session.backend_writer.write(data)
+
+
+class ReactorSession(InteractiveMenu):
+    """One client channel driven by the reactor loop.
+
+    The menu reads keystrokes from the selector, the relay pumps bytes
+    between the client channel and the backend channel, and the blocking
+    calls (asset api, backend connect) run in the reactor executor.
+    """
+
+    def __init__(self, reactor, context, client_channel):
+        super(ReactorSession, self).__init__(context, client_channel)
+        self.reactor = reactor
+        self.writer = ChannelWriter(reactor, client_channel)
+        self.proxy = None
+        self.backend_channel = None
+        self.backend_writer = None
+        self.busy = False
+        self.closed = False
+        self.notifier = context[client_channel]
+        self.touch()
+
+    def touch(self):
+        self.deadline = time.monotonic() + CONF.IDLE.timeout
+
+    def write(self, data):
+        # NOTE(executor线程中连接后端时的提示, 交给reactor线程按序发送)
+        if self.reactor.in_loop():
+            self.writer.write(data)
+        else:
+            self.reactor.call_soon(self.writer.write, data)
+
+    def start(self):
+        self.busy = True
+        self.asset_start = (time.time(), time.monotonic())
+        future = self.reactor.executor.submit(AssetCache.instance().get,
+                                              self.username)
+        self.reactor.defer(future, self.on_assets)
+
+    def on_assets(self, future):
+        start, begin_time = self.asset_start
+        Tracer.instance().record(self.context.trace_id, 'get_user_asset',
+                                 start, time.monotonic() - begin_time,
+                                 user=self.username)
+        if self.closed:
+            return
+        self.busy = False
+        try:
+            self.index = future.result()
+        except Exception:
+            LOG.error(traceback.format_exc())
+        self.display_banner()
+        self.send_prompt()
+        self.reactor.watch(self.client_channel, self.on_menu_input)
+
+    def refresh_assets(self):
+        self.busy = True
+        self.reactor.unwatch(self.client_channel)
+        future = self.reactor.executor.submit(AssetCache.instance().get,
+                                              self.username, True)
+        self.reactor.defer(future, self.on_refresh)
+
+    def on_refresh(self, future):
+        if self.closed:
+            return
+        self.busy = False
+        try:
+            self.index = future.result()
+        except Exception:
+            LOG.error(traceback.format_exc())
+        self.show_refresh_result()
+        self.send_prompt()
+        self.reactor.watch(self.client_channel, self.on_menu_input)
+
+    def send_prompt(self):
+        self.write(cm.ws(self.prompt, before=0, after=0))
+
+    def on_menu_input(self, client_channel):
+        data = client_channel.recv(1024)
+
+        # NOTE(客户端关闭)
+        if 0 == len(data):
+            LOG.info('*** Interactive client from user: %s input data '
+                     'is 0, so exit.' % (self.username))
+            self.exception_handle()
+            return
+
+        self.touch()
+        option = self.handle_input(data, self.prompt)
+        if option is None:
+            return
+        self.dispatch(option)
+        if not (self.closed or self.busy):
+            self.send_prompt()
+
+    def redirect_ssh_proxy(self, asset_info):
+        self.busy = True
+        self.reactor.unwatch(self.client_channel)
+
+        def connect():
+            proxy = ReactorProxy(self)
+            return proxy, proxy.connect(asset_info)
+
+        future = self.reactor.executor.submit(connect)
+        self.reactor.defer(future, self.on_connected)
+
+    def on_connected(self, future):
+        try:
+            proxy, backend_channel = future.result()
+        except Exception:
+            LOG.error(traceback.format_exc())
+            proxy, backend_channel = None, None
+        if self.closed:
+            if backend_channel is not None:
+                proxy.logout_handle(backend_channel)
+            return
+        if backend_channel is None:
+            self.finish_relay()
+            return
+
+        self.touch()
+        self.proxy = proxy
+        self.backend_channel = backend_channel
+        self.backend_writer = ChannelWriter(self.reactor, backend_channel)
+        proxy.init_record()
+        self.reactor.watch(backend_channel, self.on_backend_data)
+        self.reactor.watch(self.client_channel, self.on_client_data)
+        self.reactor.watch(self.notifier, self.on_window_change)
+
+    def on_client_data(self, client_channel):
+        client_data = client_channel.recv(cm.BUF_SIZE)
+        if len(client_data) == 0:
+            LOG.warn('*** Proxy receive client from user: %s data '
+                     'length is 0, so exit.' % self.username)
+            self.reactor.unwatch(self.backend_channel)
+            self.proxy.logout_handle(self.backend_channel)
+            self.exception_handle()
+            return
+        self.touch()
+        self.proxy.forward_client(client_data, self.backend_channel)
+        if self.backend_writer.is_full:
+            # NOTE(后端窗口已满, 暂停读取客户端, 发送完后恢复)
+            self.reactor.unwatch(client_channel)
+            self.backend_writer.on_drain = self.resume_client
+
+    def on_backend_data(self, backend_channel):
+        backend_data = backend_channel.recv(cm.BUF_SIZE)
+        if len(backend_data) == 0:
+            self.reactor.unwatch(backend_channel)
+            self.proxy.disconnect_handle(backend_channel)
+            self.finish_relay()
+            return
+        self.touch()
+        self.proxy.forward_backend(backend_data)
+        if self.writer.is_full:
+            # NOTE(客户端窗口已满, 暂停读取后端, 发送完后恢复)
+            self.reactor.unwatch(backend_channel)
+            self.writer.on_drain = self.resume_backend
+
+    def resume_client(self):
+        if not self.closed and self.backend_channel is not None:
+            self.reactor.watch(self.client_channel, self.on_client_data)
+
+    def resume_backend(self):
+        if not self.closed and self.backend_channel is not None:
+            self.reactor.watch(self.backend_channel, self.on_backend_data)
+
+    def on_window_change(self, notifier):
+        self.proxy.resize_backend(self.backend_channel)
+
+    def finish_relay(self):
+        """Back to the menu once the backend shell is gone.
+        """
+        self.reactor.unwatch(self.notifier)
+        if self.proxy is not None:
+            self.proxy.finish_record()
+        if self.backend_writer is not None:
+            self.backend_writer.discard()
+        self.writer.on_drain = None
+        self.proxy = None
+        self.backend_channel = None
+        self.backend_writer = None
+        self.busy = False
+        self.touch()
+        self.send_prompt()
+        self.reactor.watch(self.client_channel, self.on_menu_input)
+
+    def on_timeout(self):
+        if self.busy and self.backend_channel is None:
+            # NOTE(正在获取资产或连接后端机器)
+            self.touch()
+            return
+
+        if self.backend_channel is not None:
+            self.reactor.unwatch(self.backend_channel)
+            self.reactor.unwatch(self.client_channel)
+            result = self.proxy.timeout_handle(self.client_channel,
+                                               self.backend_channel)
+            if result == cm.TimeoutResult.PARENT_TIMEOUT.value:
+                # NOTE(主session超时, 则退到交互式界面.)
+                self.finish_relay()
+            else:
+                self.close()
+            return
+
+        self.timeout_handle()
+        self.exception_handle()
+
+    def quit(self):
+        self.logout()
+
+    def exception_handle(self):
+        channel_list = self.context.channel_list
+        if not channel_list or self.client_channel == channel_list[0]:
+            self.reactor.drop_connection(self.context)
+            return
+        self.close()
+        if self.client_channel in channel_list:
+            channel_list.remove(self.client_channel)
+        self.client_channel.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        Metrics.instance().dec('lanus_channels_active')
+        self.writer.discard()
+        if self.backend_writer is not None:
+            self.backend_writer.discard()
+        self.reactor.unwatch(self.client_channel)
+        self.reactor.unwatch(self.notifier)
+        if self.backend_channel is not None:
+            self.reactor.unwatch(self.backend_channel)
+            self.proxy.logout_handle(self.backend_channel)
+            self.proxy.finish_record()
+            self.backend_channel = None
+        release_notifier(self.context, self.client_channel)
+        self.reactor.remove_session(self)
+
+
+class SessionReactor:
+    """Event loop of one worker process.
+
+    A single selector multiplexes the listening socket, the accepted
+    transports, the interactive menus and the proxy relays. paramiko still
+    runs one packet thread per transport, the reactor owns everything else.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.sel = selectors.DefaultSelector()
+        self.executor = ThreadPoolExecutor(CONF.SERVER.reactor_threads)
+        self.pending = collections.deque()
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.fds = {}
+        self.connections = {}
+        self.sessions = set()
+        self.thread = None
+        self.next_sweep = 0
+
+    def watch(self, fileobj, handler):
+        fd = self.fds.get(fileobj)
+        if fd is not None:
+            self.sel.modify(fd, selectors.EVENT_READ, (fileobj, handler))
+            return
+        fd = fileobj.fileno()
+        key = self.sel.get_map().get(fd)
+        if key is not None:
+            # NOTE(已关闭对象的fd在回收前被复用)
+            self.unwatch(key.data[0])
+        self.sel.register(fd, selectors.EVENT_READ, (fileobj, handler))
+        self.fds[fileobj] = fd
+
+    def unwatch(self, fileobj):
+        # NOTE: 按fd注销; 已关闭的channel再调用fileno()会新建管道.
+        fd = self.fds.pop(fileobj, None)
+        if fd is None:
+            return
+        try:
+            self.sel.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def call_soon(self, callback, *args):
+        """Run ``callback`` on the reactor thread, safe from any thread.
+        """
+        self.pending.append((callback, args))
+        try:
+            self.waker_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def defer(self, future, callback):
+        future.add_done_callback(lambda f: self.call_soon(callback, f))
+
+    def serve_forever(self):
+        self.thread = threading.current_thread()
+        self.listener.setblocking(False)
+        self.watch(self.listener, self.on_accept)
+        self.watch(self.waker_r, self.on_wakeup)
+        while True:
+            events = self.sel.select(SWEEP_INTERVAL)
+            for key, mask in events:
+                fileobj, handler = key.data
+                # NOTE(同一批事件中, 之前的回调可能已注销该对象或更换了回调)
+                current = self.sel.get_map().get(key.fd)
+                if current is None or current.data != key.data:
+                    continue
+                try:
+                    handler(fileobj)
+                except Exception:
+                    LOG.error(traceback.format_exc())
+                    self.on_handler_error(fileobj)
+            self.sweep()
+
+    def on_handler_error(self, fileobj):
+        for session in list(self.sessions):
+            if fileobj in (session.client_channel, session.backend_channel):
+                try:
+                    session.exception_handle()
+                except Exception:
+                    LOG.error(traceback.format_exc())
+                    session.close()
+
+    def on_wakeup(self, waker):
+        try:
+            while waker.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while self.pending:
+            callback, args = self.pending.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                LOG.error(traceback.format_exc())
+
+    def on_accept(self, listener):
+        for i in range(ACCEPT_BATCH):
+            try:
+                cs, (rhost, rport) = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                # NOTE(其他worker已经accept)
+                return
+            LOG.info('*** Receive client addr: %s:%s' % (rhost, rport))
+            try:
+                self.add_connection(cs, rhost, rport)
+            except Exception:
+                LOG.error(traceback.format_exc())
+                cs.close()
+
+    def add_connection(self, client, rhost, rport):
+        context = DotMap()
+        context.client = client
+        context.channel_list = []
+        context.remote_host = rhost
+        context.remote_port = rport
+        context.trace_id = new_trace_id()
+
+        transport = paramiko.Transport(client, gss_kex=False)
+        context.transport = transport
+        for host_key in SSHKeyGen.host_keys():
+            transport.add_server_key(host_key)
+
+        ssh_server = ReactorServerInterface(context, self)
+        try:
+            transport.start_server(event=HandshakeEvent(transport, context),
+                                   server=ssh_server)
+        except paramiko.SSHException as _ex:
+            LOG.error('*** Reactor ssh start server failed: %s' % str(_ex))
+            client.close()
+            return
+        context.deadline = time.monotonic() + CONF.SSH.timeout
+        self.connections[id(context)] = context
+        Metrics.instance().inc('lanus_transports_active')
+
+    def add_channel(self, context, client_channel):
+        transport = context.transport
+        # NOTE(从transport的accept队列中取出该channel)
+        transport.accept(0)
+        if id(context) not in self.connections or \
+           not transport.is_active():
+            return
+
+        if (len(context.channel_list) + 1) > CONF.SERVER.session_limit:
+            tip = u'超出session预定上限值! 请使用已打开的窗口, 并关闭该窗口.'
+            # NOTE(新channel的窗口足够, 尽力发送后即关闭)
+            writer = ChannelWriter(self, client_channel)
+            writer.write(cm.ws(tip, 1))
+            writer.discard()
+            LOG.info('*** Session over limit from user: %s.'
+                     % context.username)
+            Metrics.instance().inc('lanus_session_rejected_total')
+            client_channel.close()
+            return
+
+        context.channel_list.append(client_channel)
+        context[client_channel] = WindowNotifier()
+        context.deadline = time.monotonic() + CONF.SSH.timeout
+        LOG.info('*** Login user: %s from (%s:%s) on reactor.'
+                 % (context.username, context.remote_host,
+                    context.remote_port))
+
+        session = ReactorSession(self, context, client_channel)
+        self.sessions.add(session)
+        Metrics.instance().inc('lanus_channels_active')
+        session.start()
+
+    def remove_session(self, session):
+        self.sessions.discard(session)
+
+    def drop_connection(self, context):
+        for session in list(self.sessions):
+            if session.context is context:
+                session.close()
+        for channel in context.channel_list:
+            try:
+                channel.close()
+            except Exception:
+                pass
+        context.channel_list = []
+        wipe_credential(context)
+        close_backends(context)
+        try:
+            context.transport.close()
+            context.client.close()
+        except Exception:
+            pass
+        if self.connections.pop(id(context), None) is not None:
+            Metrics.instance().dec('lanus_transports_active')
+        LOG.info('*** Client from %s transport closed on reactor.'
+                 % context.remote_host)
+
+    def sweep(self):
+        now = time.monotonic()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + SWEEP_INTERVAL
+
+        for context in list(self.connections.values()):
+            if not context.transport.is_active():
+                self.drop_connection(context)
+            elif not context.channel_list and now > context.deadline:
+                LOG.error('*** Client channel timeout from host: %s.'
+                          % context.remote_host)
+                self.drop_connection(context)
+
+        for session in list(self.sessions):
+            if session.client_channel.closed:
+                session.close()
+            elif now > session.deadline:
+                try:
+                    session.on_timeout()
+                except Exception:
+                    LOG.error(traceback.format_exc())
+                    session.close()
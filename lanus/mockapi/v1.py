@@ -7,7 +7,17 @@
 
 import osmo.util as ou
 from flask import Blueprint
+from oslo_config import cfg
 
+mock_opts = [
+    cfg.StrOpt('asset_ip', default='10.12.16.248',
+               help='ip of the one asset every user is granted.'),
+    cfg.IntOpt('asset_port', default=50022,
+               help='ssh port of the one asset every user is granted.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(mock_opts, 'MOCK')
 
 bp = Blueprint('v1', __name__)
 
@@ -32,7 +42,8 @@ def auth():
 @bp.route('/asset', methods=['POST'])
 def asset():
     asset_list = [
-        {'id': 1, 'ip': '10.12.16.248', 'port': 50022, 'hostname': 'hello00'}
+        {'id': 1, 'ip': CONF.MOCK.asset_ip, 'port': CONF.MOCK.asset_port,
+         'hostname': 'hello00', 'group': 'default'}
     ]
     return ou.context(ou.RESULT.SUCC.value, data=asset_list)
 
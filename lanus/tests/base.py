@@ -0,0 +1,34 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import shutil
+import tempfile
+import unittest
+
+from oslo_config import cfg
+
+CONF = cfg.CONF
+
+
+class TestCase(unittest.TestCase):
+    """Default config parsed, overrides and temp dirs undone after a test.
+    """
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        CONF([], project='lanus')
+        self.addCleanup(CONF.reset)
+
+    def flags(self, group, **overrides):
+        for name, value in overrides.items():
+            CONF.set_override(name, value, group)
+            self.addCleanup(CONF.clear_override, name, group)
+
+    def make_dir(self):
+        path = tempfile.mkdtemp(prefix='lanus-test-')
+        self.addCleanup(shutil.rmtree, path, True)
+        return path
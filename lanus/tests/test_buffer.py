@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+from lanus.bastion.lib.buffer import BufferPool
+from lanus.bastion.lib.buffer import RingBuffer
+from lanus.bastion.lib.buffer import TRUNCATED_MARKER
+from lanus.tests import base
+
+
+class RingBufferTest(base.TestCase):
+
+    def test_keeps_all_below_capacity(self):
+        buffer = RingBuffer(16, head=4)
+        buffer.append(b'abc')
+        buffer.append(memoryview(b'defgh'))
+        self.assertEqual(b'abcdefgh', buffer.getvalue())
+        self.assertEqual(8, len(buffer))
+        self.assertEqual(0, buffer.dropped)
+        self.assertFalse(buffer.is_full())
+
+    def test_keeps_head_and_latest_with_marker(self):
+        buffer = RingBuffer(16, head=4)
+        buffer.append(b'abcdefghijklmnopqrstuvwxyz')
+        marker = (TRUNCATED_MARKER % (10, 26)).encode('utf-8')
+        self.assertEqual(b'abcd' + marker + b'opqrstuvwxyz',
+                         buffer.getvalue())
+        self.assertEqual(26, buffer.total)
+        self.assertTrue(buffer.is_full())
+
+    def test_ring_wraps_over_small_appends(self):
+        buffer = RingBuffer(8)
+        for chunk in (b'abc', b'def', b'ghi', b'j'):
+            buffer.append(chunk)
+        self.assertEqual(b'cdefghij', buffer.getvalue())
+        self.assertEqual(2, buffer.dropped)
+        # NOTE(没有head时不插入截断标记)
+        self.assertEqual(2, len(buffer.segments()))
+
+    def test_clear(self):
+        buffer = RingBuffer(8, head=2)
+        buffer.append(b'0123456789')
+        buffer.clear()
+        self.assertEqual(0, len(buffer))
+        self.assertEqual(0, buffer.total)
+        buffer.append(b'xy')
+        self.assertEqual(b'xy', buffer.getvalue())
+
+
+class BufferPoolTest(base.TestCase):
+
+    def test_release_reuses_buffer(self):
+        pool = BufferPool(64, 2, head=8)
+        buffer = pool.acquire()
+        buffer.append(b'output')
+        pool.release(buffer)
+        self.assertIs(buffer, pool.acquire())
+        self.assertEqual(0, len(buffer))
+
+    def test_overflow_past_limit(self):
+        pool = BufferPool(64, 1, head=16, overflow=16)
+        pooled = pool.acquire()
+        overflow = pool.acquire()
+        self.assertEqual(64, pooled.capacity)
+        self.assertEqual(16, overflow.capacity)
+        self.assertEqual(4, overflow.head)
+        self.assertTrue(pool.is_exhausted)
+
+        # NOTE(溢出的buffer不放回池中)
+        pool.release(overflow)
+        pool.release(pooled)
+        self.assertEqual([pooled], pool.free)
+        self.assertFalse(pool.is_exhausted)
@@ -0,0 +1,139 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+from datetime import datetime
+from datetime import timedelta
+
+from lanus.bastion.lib.cmdindex import CommandIndex
+from lanus.bastion.lib.cmdindex import SUFFIX_SIZE
+from lanus.bastion.lib.cmdindex import parse_name
+from lanus.bastion.lib.cmdindex import prefix_end
+from lanus.bastion.lib.cmdindex import query_tokens
+from lanus.bastion.lib.cmdindex import suffixes
+from lanus.bastion.lib.cmdindex import tokenize
+from lanus.tests import base
+
+
+class TokenTest(base.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual({'cat', '/etc/hosts', 'grep', 'web'},
+                         tokenize('cat /etc/hosts|grep "Web"'))
+
+    def test_query_tokens_mark_the_edges(self):
+        self.assertEqual([('rm', True, False), ('-rf', False, False),
+                          ('/var', False, True)],
+                         query_tokens('rm -rf /var'))
+        self.assertEqual([('dump', True, True)], query_tokens('Dump'))
+        self.assertEqual([('ls', False, False)], query_tokens(' ls '))
+
+    def test_suffixes(self):
+        self.assertEqual({'ump', 'mp', 'p'}, suffixes(['dump']))
+        long_token = 'x' * (SUFFIX_SIZE + 5)
+        self.assertEqual(SUFFIX_SIZE,
+                         max(len(suffix) for suffix in suffixes([long_token])))
+
+    def test_prefix_end(self):
+        self.assertEqual('mysqm', prefix_end('mysql'))
+        self.assertTrue('mysql' < 'mysqldump' < prefix_end('mysql'))
+
+    def test_parse_name(self):
+        self.assertEqual(('10.0.0.1', 'bob_ops', '3'),
+                         parse_name('10.0.0.1_bob_ops_3.cmd'))
+
+
+class CommandIndexTest(base.TestCase):
+
+    def setUp(self):
+        super(CommandIndexTest, self).setUp()
+        self.record_path = self.make_dir()
+        self.day = datetime.now().strftime('%Y%m%d')
+        os.mkdir(os.path.join(self.record_path, self.day))
+        self.write('10.0.0.1_bob_3.cmd', [
+            '[2017-06-08 10:00:00] mysqldump -u root db',
+            '[2017-06-08 10:01:00] rm -rf /var/log/old',
+        ])
+        self.write('10.0.0.2_alice_4.cmd', [
+            '[2017-06-08 11:00:00] ls -l',
+            '[2017-06-08 11:01:00] cat /etc/averylongconfigurationname.conf',
+        ])
+        self.index = CommandIndex(self.record_path)
+        self.addCleanup(self.index.close)
+        self.index.update()
+
+    def write(self, name, lines, end='\n', day=None):
+        day_path = os.path.join(self.record_path, day or self.day)
+        with open(os.path.join(day_path, name), 'a') as fp:
+            fp.write('\n'.join(lines) + end)
+
+    def query(self, text=None, **filters):
+        return [row[-1] for row in self.index.query(text, **filters)]
+
+    def test_substrings_of_tokens(self):
+        for text in ('mysql', 'dump', 'sqldu', 'ump -u', '-u root d',
+                     'dump -u root'):
+            self.assertEqual(['mysqldump -u root db'], self.query(text))
+
+    def test_prefixes_and_paths(self):
+        self.assertEqual(['rm -rf /var/log/old'], self.query('rm -rf /var'))
+        self.assertEqual(['rm -rf /var/log/old'], self.query('var/log'))
+        self.assertEqual(['rm -rf /var/log/old'], self.query('rm -rf'))
+
+    def test_long_substring(self):
+        self.assertEqual(['cat /etc/averylongconfigurationname.conf'],
+                         self.query('longconfigurationname.co'))
+
+    def test_no_match(self):
+        self.assertEqual([], self.query('nothing'))
+        self.assertEqual([], self.query('rm -rf /tmp'))
+
+    def test_filters(self):
+        self.assertEqual(['ls -l', 'cat /etc/averylongconfigurationname.conf'],
+                         self.query(user='alice'))
+        self.assertEqual(['mysqldump -u root db', 'rm -rf /var/log/old'],
+                         self.query(host='10.0.0.1'))
+        self.assertEqual(['mysqldump -u root db'],
+                         self.query('l', host='10.0.0.*', limit=1))
+        self.assertEqual(['ls -l'], self.query('l', host='10.0.0.2',
+                                               limit=1))
+
+    def test_update_reads_only_new_complete_lines(self):
+        self.write('10.0.0.1_bob_3.cmd', ['[2017-06-08 12:00:00] uptime'])
+        self.write('10.0.0.1_bob_3.cmd', ['[2017-06-08 12:01:00] who'],
+                   end='')
+        self.assertEqual(1, self.index.update())
+        self.assertEqual(['uptime'], self.query('uptime'))
+        self.assertEqual([], self.query('who'))
+        self.write('10.0.0.1_bob_3.cmd', [''])
+        self.assertEqual(1, self.index.update())
+        self.assertEqual(['who'], self.query('who'))
+
+    def test_closed_day_is_not_read_again(self):
+        day = (datetime.now() - timedelta(days=3)).strftime('%Y%m%d')
+        os.mkdir(os.path.join(self.record_path, day))
+        self.write('10.0.0.1_bob_5.cmd', ['[2017-06-05 09:00:00] df -h'],
+                   day=day)
+        self.assertEqual(1, self.index.update())
+        self.write('10.0.0.1_bob_5.cmd', ['[2017-06-05 09:01:00] free'],
+                   day=day)
+        self.assertEqual(0, self.index.update())
+        self.assertEqual(['df -h'], self.query('df'))
+
+    def test_forget(self):
+        self.index.forget(self.day)
+        self.assertEqual([], self.query())
+        for table in ('tokens', 'suffixes'):
+            self.assertEqual((0,), self.index.db.execute(
+                'SELECT count(*) FROM %s' % table).fetchone())
+
+    def test_suffixes_filled_for_old_index(self):
+        self.index.db.execute('DROP TABLE suffixes')
+        self.index.db.commit()
+        self.index.close()
+        self.index = CommandIndex(self.record_path)
+        self.assertEqual(['mysqldump -u root db'], self.query('dump'))
@@ -0,0 +1,173 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import json
+import unittest
+
+from lanus.bastion.lib import frames
+from lanus.bastion.lib.frames import FrameBuffer
+from lanus.bastion.lib.frames import FrameReader
+from lanus.bastion.lib.frames import HEADER_FRAME
+from lanus.bastion.lib.frames import INDEX_ENTRY
+from lanus.bastion.lib.frames import OUTPUT_FRAME
+from lanus.bastion.lib.frames import RESIZE
+from lanus.bastion.lib.frames import RESIZE_FRAME
+from lanus.bastion.lib.frames import compress
+from lanus.bastion.lib.frames import decompress
+from lanus.bastion.lib.frames import iter_frames
+from lanus.bastion.lib.frames import pack_frame
+from lanus.bastion.lib.keyframe import KeyframeIndex
+from lanus.tests import base
+
+HEADER = {'username': 'bob', 'ip': '10.0.0.1', 'width': 40, 'height': 5}
+
+
+def write_record(rec_file, blocks, header=HEADER, is_indexed=True):
+    """Write ``.rec`` (and ``.idx``) as the recorder does, ``blocks`` is a
+    list of frame lists.
+    """
+    header_block = pack_frame(HEADER_FRAME, 0,
+                              json.dumps(header).encode('utf-8'))
+    entries = [(0, header_block)]
+    for block in blocks:
+        entries.append((block[0][1], b''.join(
+            pack_frame(kind, ms, payload) for kind, ms, payload in block)))
+    with open(rec_file, 'wb') as rec_fp:
+        for first_ms, data in entries:
+            compressed = compress(data)
+            if is_indexed:
+                with open('%s.idx' % rec_file, 'ab') as idx_fp:
+                    idx_fp.write(INDEX_ENTRY.pack(first_ms, rec_fp.tell(),
+                                                  len(compressed)))
+            rec_fp.write(compressed)
+
+
+class FrameCodecTest(base.TestCase):
+
+    def test_pack_and_iter_frames(self):
+        data = (pack_frame(OUTPUT_FRAME, 5, b'ls\r\n') +
+                pack_frame(RESIZE_FRAME, 7, RESIZE.pack(120, 40)))
+        self.assertEqual([(OUTPUT_FRAME, 5, b'ls\r\n'),
+                          (RESIZE_FRAME, 7, RESIZE.pack(120, 40))],
+                         list(iter_frames(data)))
+
+    def test_gzip_round_trip(self):
+        data = b'output ' * 1000
+        self.assertEqual(data, decompress(compress(data)))
+
+    @unittest.skipIf(frames.zstandard is None, 'zstandard is not installed')
+    def test_zstd_round_trip(self):
+        data = b'output ' * 1000
+        self.assertEqual(data, decompress(compress(data, 'zstd')))
+
+
+class FrameBufferTest(base.TestCase):
+
+    def test_take_hands_block_over(self):
+        buffer = FrameBuffer(HEADER)
+        self.assertFalse(buffer.is_ready())
+        buffer.add(OUTPUT_FRAME, b'abc')
+        first_ms, block = buffer.take()
+        self.assertEqual([(OUTPUT_FRAME, first_ms, b'abc')],
+                         list(iter_frames(block)))
+        self.assertFalse(buffer.is_ready())
+        kind, ms, payload = next(iter_frames(buffer.header))
+        self.assertEqual(HEADER, json.loads(payload.decode('utf-8')))
+
+    def test_ready_by_size(self):
+        self.flags('RECORD', frames_block_size=16)
+        buffer = FrameBuffer(HEADER)
+        buffer.add(OUTPUT_FRAME, b'a')
+        self.assertFalse(buffer.is_ready())
+        buffer.add(OUTPUT_FRAME, b'0123456789')
+        self.assertTrue(buffer.is_ready())
+
+
+class FrameReaderTest(base.TestCase):
+
+    def setUp(self):
+        super(FrameReaderTest, self).setUp()
+        self.blocks = [
+            [(OUTPUT_FRAME, 10, b'a'), (OUTPUT_FRAME, 900, b'b')],
+            [(OUTPUT_FRAME, 1000, b'c'), (RESIZE_FRAME, 1500,
+                                          RESIZE.pack(80, 24))],
+            [(OUTPUT_FRAME, 2000, b'd'), (OUTPUT_FRAME, 2600, b'e')],
+        ]
+        self.rec_file = os.path.join(self.make_dir(), 'session.rec')
+
+    def test_header_and_duration(self):
+        write_record(self.rec_file, self.blocks)
+        reader = FrameReader(self.rec_file)
+        self.assertEqual(HEADER, reader.header)
+        self.assertEqual(4, len(reader.index))
+        self.assertEqual(2600, reader.duration())
+
+    def test_seek_starts_at_block_before(self):
+        write_record(self.rec_file, self.blocks)
+        reader = FrameReader(self.rec_file)
+        self.assertEqual(2, reader.seek(1200))
+        payloads = [payload for kind, ms, payload in reader.frames(1200)
+                    if kind == OUTPUT_FRAME]
+        self.assertEqual([b'c', b'd', b'e'], payloads)
+
+    def test_positions_from_frame(self):
+        write_record(self.rec_file, self.blocks)
+        reader = FrameReader(self.rec_file)
+        positions = list(reader.positions(2, 1))
+        self.assertEqual((2, 1, RESIZE_FRAME, 1500), positions[0][:4])
+        self.assertEqual([b'd', b'e'],
+                         [position[4] for position in positions[1:]])
+
+    def test_without_index_scans_members(self):
+        write_record(self.rec_file, self.blocks, is_indexed=False)
+        reader = FrameReader(self.rec_file)
+        self.assertEqual([], reader.index)
+        self.assertEqual(HEADER, reader.header)
+        self.assertEqual([b'a', b'b', b'c', b'd', b'e'],
+                         [payload for kind, ms, payload in reader.frames()
+                          if kind == OUTPUT_FRAME])
+
+
+class KeyframeIndexTest(base.TestCase):
+
+    def setUp(self):
+        super(KeyframeIndexTest, self).setUp()
+        self.rec_file = os.path.join(self.make_dir(), 'session.rec')
+        write_record(self.rec_file, [
+            [(OUTPUT_FRAME, 100, b'first\r\n')],
+            [(OUTPUT_FRAME, 1200, b'second\r\n')],
+            [(OUTPUT_FRAME, 2300, b'third\r\n')],
+        ])
+
+    def lines(self, screen):
+        return [line.rstrip() for line in screen.display if line.strip()]
+
+    def test_build_and_seek(self):
+        index = KeyframeIndex.load_or_build(FrameReader(self.rec_file), 1)
+        self.assertEqual([1200, 2300],
+                         [keyframe.ms for keyframe in index.keyframes])
+        screen, rest = index.screen_at(1500)
+        self.assertEqual(['first', 'second'], self.lines(screen))
+        self.assertEqual([b'third\r\n'],
+                         [position[4] for position in rest])
+
+    def test_seek_before_first_keyframe(self):
+        index = KeyframeIndex.load_or_build(FrameReader(self.rec_file), 1)
+        screen, rest = index.screen_at(500)
+        self.assertEqual(['first'], self.lines(screen))
+        self.assertEqual(2, len(list(rest)))
+
+    def test_saved_keyframes_are_loaded(self):
+        KeyframeIndex.load_or_build(FrameReader(self.rec_file), 1)
+        self.assertTrue(os.path.exists('%s.key' % self.rec_file))
+        index = KeyframeIndex(FrameReader(self.rec_file), 1)
+        self.assertTrue(index.load())
+        screen, stream = index.keyframes[-1].restore()
+        self.assertEqual(['first', 'second'], self.lines(screen))
+        # NOTE(间隔不同时缓存失效)
+        self.assertFalse(KeyframeIndex(FrameReader(self.rec_file), 2).load())
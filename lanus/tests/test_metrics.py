@@ -0,0 +1,92 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import subprocess
+
+from lanus.bastion.lib.metrics import Metrics
+from lanus.bastion.lib.metrics import RETIRED_FILE
+from lanus.bastion.lib.metrics import SnapshotCollector
+from lanus.bastion.lib.metrics import format_labels
+from lanus.bastion.lib.metrics import write_snapshot
+from lanus.tests import base
+
+
+def dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+class SnapshotCollectorTest(base.TestCase):
+
+    def setUp(self):
+        super(SnapshotCollectorTest, self).setUp()
+        self.directory = self.make_dir()
+
+    def dump(self, pid, metrics):
+        write_snapshot(os.path.join(self.directory, '%s.json' % pid),
+                       metrics.snapshot())
+
+    def test_format_labels(self):
+        self.assertEqual('', format_labels(()))
+        self.assertEqual('{direction="up",path="a\\"b"}',
+                         format_labels((('direction', 'up'),
+                                        ('path', 'a"b'))))
+
+    def test_render_adds_processes_up(self):
+        live = Metrics()
+        live.inc('lanus_relay_bytes_total', 100, direction='upstream')
+        live.set('lanus_channels_active', 3)
+        live.observe('lanus_auth_seconds', 0.02, result='ok')
+        self.dump(os.getpid(), live)
+
+        exited = Metrics()
+        exited.inc('lanus_relay_bytes_total', 50, direction='upstream')
+        exited.set('lanus_channels_active', 7)
+        exited.observe('lanus_auth_seconds', 3, result='ok')
+        pid = dead_pid()
+        self.dump(pid, exited)
+
+        lines = SnapshotCollector(self.directory).render().splitlines()
+        self.assertIn('# TYPE lanus_relay_bytes_total counter', lines)
+        self.assertIn('lanus_relay_bytes_total{direction="upstream"} 150',
+                      lines)
+        # NOTE(gauge只输出存活进程的, 带pid标签)
+        self.assertIn('lanus_channels_active{pid="%s"} 3' % os.getpid(),
+                      lines)
+        self.assertEqual(1, len([line for line in lines if line.startswith(
+            'lanus_channels_active{')]))
+        self.assertIn('lanus_auth_seconds_bucket{result="ok",le="0.025"} 1',
+                      lines)
+        self.assertIn('lanus_auth_seconds_bucket{result="ok",le="5"} 2',
+                      lines)
+        self.assertIn('lanus_auth_seconds_bucket{result="ok",le="+Inf"} 2',
+                      lines)
+        self.assertIn('lanus_auth_seconds_sum{result="ok"} 3.02', lines)
+        self.assertIn('lanus_auth_seconds_count{result="ok"} 2', lines)
+        self.assertNotIn('# TYPE lanus_pool_busy gauge', lines)
+
+    def test_exited_process_is_folded(self):
+        exited = Metrics()
+        exited.inc('lanus_session_rejected_total', 2)
+        pid = dead_pid()
+        self.dump(pid, exited)
+
+        collector = SnapshotCollector(self.directory)
+        collector.render()
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, '%s.json' % pid)))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, RETIRED_FILE)))
+
+        # NOTE(新的exporter从retired文件继续累加, 计数不回退)
+        exited = Metrics()
+        exited.inc('lanus_session_rejected_total', 1)
+        self.dump(dead_pid(), exited)
+        lines = SnapshotCollector(self.directory).render().splitlines()
+        self.assertIn('lanus_session_rejected_total 3', lines)
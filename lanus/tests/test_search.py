@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+from dotmap import DotMap
+
+from lanus.bastion.lib.search import AssetIndex
+from lanus.bastion.lib.search import FieldIndex
+from lanus.bastion.lib.search import short_grams
+from lanus.tests import base
+
+
+class FieldIndexTest(base.TestCase):
+
+    def setUp(self):
+        super(FieldIndexTest, self).setUp()
+        self.index = FieldIndex(['web01', 'web', 'db-web', 'cache'])
+
+    def test_short_grams(self):
+        self.assertEqual({'a', 'b', 'c', 'ab', 'bc', 'abc'},
+                         short_grams('abc'))
+
+    def test_ranks_exact_prefix_substring(self):
+        self.assertEqual([1, 0, 2], self.index.search('web'))
+
+    def test_short_keyword_uses_postings(self):
+        self.assertEqual([0], list(self.index.candidates('01')))
+        self.assertEqual([2], list(self.index.candidates('-w')))
+        self.assertEqual([0, 1, 2], list(self.index.candidates('w')))
+        self.assertEqual((), self.index.candidates('z'))
+
+    def test_no_match(self):
+        self.assertEqual([], self.index.search('webx'))
+        self.assertEqual([], self.index.search('x'))
+
+
+class AssetIndexTest(base.TestCase):
+
+    def setUp(self):
+        super(AssetIndexTest, self).setUp()
+        self.assets = [
+            DotMap(ip='10.12.16.248', hostname='web01.dc1'),
+            DotMap(ip='10.12.17.3', hostname='db01.dc1'),
+            DotMap(ip='192.168.1.7', hostname='Web02.dc2'),
+        ]
+        self.index = AssetIndex(self.assets)
+
+    def search(self, option):
+        return [self.assets.index(asset)
+                for asset in self.index.search(option)]
+
+    def test_empty_option_lists_all(self):
+        self.assertEqual([0, 1, 2], self.search(''))
+
+    def test_id(self):
+        self.assertEqual([2], self.search('2'))
+
+    def test_ip_before_hostname(self):
+        self.assertEqual([0, 1], self.search('10.12'))
+        self.assertEqual([1], self.search('17.3'))
+        # NOTE(数字超出id范围时按ip匹配)
+        self.assertEqual([2], self.search('168'))
+
+    def test_hostname(self):
+        self.assertEqual([0, 2], self.search('WEB'))
+        self.assertEqual([2], self.search('dc2'))
+        self.assertEqual([], self.search('mysql'))
+
+    def test_position(self):
+        self.assertEqual(1, self.index.position(self.assets[1]))
+        self.assertIsNone(self.index.position(DotMap(ip='10.0.0.1')))
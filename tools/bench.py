@@ -0,0 +1,656 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright @ 2017 OPS Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Concurrent session benchmark of lanus-bastion.
+
+Starts lanus-mockapi, a paramiko stub sshd and lanus-bastion on localhost,
+then for every session count drives that many concurrent users through
+password auth, the asset menu, host selection and scripted shell traffic.
+The bastion is restarted for every count, so the figures of one count do
+not carry over to the next.
+
+    $ tools/with_venv.sh python tools/bench.py --sessions 100,1000,5000
+    $ tools/with_venv.sh python tools/bench.py --set SERVER.mode=reactor
+
+The simulated users run in ``--procs`` driver processes and the stub sshd
+in ``--stub-procs`` processes, so the paramiko clients do not share a GIL
+with the backend they measure.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import configparser
+import multiprocessing
+
+import paramiko
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+import lanus.bastion.common as cm  # noqa: E402
+
+BASTION_MAIN = 'from lanus.bastion.cmd import bastion; bastion()'
+MOCKAPI_MAIN = 'from lanus.mockapi.app import mock_api; mock_api()'
+
+MENU_PROMPT = cm.PROMPT.encode()
+STUB_PROMPT = b'[bench@stub ~]$ '
+# NOTE(stub sshd输出的一行, 80字节)
+OUTPUT_LINE = b'x' * 78 + b'\r\n'
+OUTPUT_CHUNK = OUTPUT_LINE * 400
+KEYS = 'abcdefghij'
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted ``values``, ``None`` if empty.
+    """
+    if not values:
+        return None
+    rank = int(-(-percent * len(values) // 100))
+    return values[max(rank - 1, 0)]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_port(proc, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('process: %s exit with code: %s.'
+                               % (proc.pid, proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('port: %s not listening after %ss.' % (port, timeout))
+
+
+class StubServer(paramiko.ServerInterface):
+    """Backend sshd accepting every password, one shell thread a channel.
+    """
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height,
+                                            pixelwidth, pixelheight):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        thread = threading.Thread(target=stub_shell, args=(channel,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+def stub_shell(channel):
+    """Echo every keystroke, ``out <bytes>`` writes that much output.
+    """
+    try:
+        channel.sendall(STUB_PROMPT)
+        line = b''
+        while True:
+            data = channel.recv(1024)
+            if not data:
+                break
+            channel.sendall(data)
+            line += data
+            if b'\r' not in line:
+                continue
+            command, line = line.split(b'\r', 1)[0].strip(), b''
+            if command == b'exit':
+                break
+            channel.sendall(b'\r\n')
+            if command.startswith(b'out '):
+                size = int(command.split()[1])
+                while size > 0:
+                    channel.sendall(OUTPUT_CHUNK[:size])
+                    size -= len(OUTPUT_CHUNK)
+            channel.sendall(STUB_PROMPT)
+    except (EOFError, OSError, ValueError):
+        pass
+    finally:
+        channel.close()
+
+
+def stub_loop(sock, host_key):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    paramiko.util.get_logger('paramiko').setLevel(100)
+    while True:
+        client, addr = sock.accept()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(client)
+        transport.add_server_key(host_key)
+        # NOTE(传入event则协商在transport线程中进行, 不阻塞accept)
+        transport.start_server(event=threading.Event(), server=StubServer())
+
+
+def start_stub(port, procs):
+    """Stub sshd processes sharing one listening socket.
+    """
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1024)
+    host_key = paramiko.ECDSAKey.generate(bits=256)
+    processes = []
+    for _ in range(procs):
+        proc = multiprocessing.Process(target=stub_loop,
+                                       args=(sock, host_key))
+        proc.daemon = True
+        proc.start()
+        processes.append(proc)
+    sock.close()
+    return processes
+
+
+def read_until(channel, marker):
+    """Read until ``marker`` arrives, returns the bytes read.
+    """
+    size, tail = 0, b''
+    while True:
+        data = channel.recv(65536)
+        if not data:
+            raise EOFError('channel closed before: %r' % marker)
+        size += len(data)
+        tail = (tail + data)[-4096:]
+        if marker in tail:
+            return size
+
+
+def type_line(channel, line):
+    """Type ``line`` key by key as a terminal does, then enter.
+    """
+    # NOTE(菜单只把单独的回车识别为输入结束, 每个按键等回显后再发下一个)
+    for key in line:
+        channel.sendall(key)
+        read_until(channel, key.encode())
+    channel.sendall('\r')
+
+
+def run_session(name, args, gate, traffic, results):
+    result = {'user': name}
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
+    channel = None
+    # step1: 登录, 从连接开始到后端提示符出现计为登录耗时.
+    with gate:
+        begin_time = time.time()
+        step = 'connect'
+        try:
+            client.connect('127.0.0.1', port=args.port, username=name,
+                           password='bench', timeout=args.timeout,
+                           banner_timeout=args.timeout,
+                           auth_timeout=args.timeout,
+                           look_for_keys=False, allow_agent=False)
+            step = 'menu'
+            channel = client.invoke_shell(width=120, height=40)
+            channel.settimeout(args.timeout)
+            read_until(channel, MENU_PROMPT)
+            step = 'select'
+            type_line(channel, args.host)
+            read_until(channel, STUB_PROMPT)
+            result['login'] = (begin_time, time.time())
+        except Exception as _ex:
+            result['error'] = '%s %s: %s' % (step, type(_ex).__name__, _ex)
+    # NOTE(Queue在后台线程中序列化, 放入副本)
+    results.put(('login', dict(result)))
+
+    # step2: 全部用户登录后再开始输入, 保证各会话同时在线.
+    if 'login' in result:
+        traffic.wait(args.timeout)
+        step = 'keystroke'
+        try:
+            rtts = []
+            for i in range(args.keystrokes):
+                time.sleep(args.think)
+                key = KEYS[i % len(KEYS)]
+                key_time = time.monotonic()
+                channel.sendall(key)
+                read_until(channel, key.encode())
+                rtts.append(time.monotonic() - key_time)
+            channel.sendall('\r')
+            read_until(channel, STUB_PROMPT)
+            result['rtts'] = rtts
+
+            step = 'relay'
+            relay_time = time.time()
+            type_line(channel, 'out %s' % args.relay_bytes)
+            size = read_until(channel, STUB_PROMPT)
+            result['relay'] = (relay_time, time.time(), size)
+            type_line(channel, 'exit')
+        except Exception as _ex:
+            result['error'] = '%s %s: %s' % (step, type(_ex).__name__, _ex)
+    client.close()
+    results.put(('done', result))
+
+
+def drive(names, args, gate_size, traffic, results):
+    """Driver process, one thread per simulated user.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    paramiko.util.get_logger('paramiko').setLevel(100)
+    # NOTE(每个用户两个线程: 会话线程和paramiko的transport线程)
+    threading.stack_size(512 * 1024)
+    gate = threading.BoundedSemaphore(gate_size)
+    threads = []
+    for name in names:
+        thread = threading.Thread(target=run_session,
+                                  args=(name, args, gate, traffic, results))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+class ProcessSampler(threading.Thread):
+    """Sample CPU seconds and RSS of the bastion process tree from /proc.
+    """
+
+    def __init__(self, root_pid, interval=1.0):
+        super(ProcessSampler, self).__init__()
+        self.daemon = True
+        self.root_pid = root_pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = {}
+
+    def tree(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % entry) as fp:
+                    fields = fp.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            children.setdefault(int(fields[1]), []).append(int(entry))
+        pids, todo = [], [self.root_pid]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            todo.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        now = time.monotonic()
+        for pid in self.tree():
+            try:
+                with open('/proc/%s/stat' % pid) as fp:
+                    fields = fp.read().rsplit(')', 1)[1].split()
+                with open('/proc/%s/statm' % pid) as fp:
+                    rss = int(fp.read().split()[1]) * PAGE_SIZE
+            except OSError:
+                continue
+            cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            sample = self.samples.setdefault(
+                pid, {'first': (now, cpu), 'rss': 0})
+            sample['last'] = (now, cpu)
+            sample['rss'] = max(sample['rss'], rss)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.sample()
+        self.stopped.set()
+        self.join()
+
+    def report(self):
+        rows = []
+        for pid, sample in sorted(self.samples.items()):
+            (first_time, first_cpu), (last_time, last_cpu) = \
+                sample['first'], sample['last']
+            elapsed = last_time - first_time
+            rows.append({
+                'pid': pid,
+                'role': 'master' if pid == self.root_pid else 'child',
+                'cpu': (last_cpu - first_cpu) / elapsed * 100
+                if elapsed > 0 else 0.0,
+                'rss': sample['rss'] / 1048576.0,
+            })
+        return rows
+
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = args.workdir or tempfile.mkdtemp(prefix='lanus-bench-')
+        os.makedirs(self.workdir, exist_ok=True)
+        self.env = dict(os.environ, PYTHONPATH=ROOT_PATH)
+        self.mockapi = None
+
+    def write_conf(self, name, sections):
+        path = os.path.join(self.workdir, name)
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        for section, options in sections.items():
+            if section != 'DEFAULT':
+                parser.add_section(section)
+            for key, value in options.items():
+                parser.set(section, key, str(value))
+        with open(path, 'w') as fp:
+            parser.write(fp)
+        return path
+
+    def spawn(self, name, main, *conf_files):
+        command = [sys.executable, '-c', main]
+        for conf_file in conf_files:
+            command.extend(['--config-file', conf_file])
+        out = open(os.path.join(self.workdir, name + '.out'), 'ab')
+        return subprocess.Popen(command, cwd=ROOT_PATH, env=self.env,
+                                stdout=out, stderr=subprocess.STDOUT)
+
+    def start_backends(self):
+        args = self.args
+        args.stub_port = args.stub_port or free_port()
+        start_stub(args.stub_port, args.stub_procs)
+        if not args.api:
+            api_port = free_port()
+            conf_file = self.write_conf('mockapi.conf', {
+                'DEFAULT': {'debug': False, 'log_dir': self.workdir,
+                            'log_file': 'mockapi.log'},
+                'WEB': {'bind': '127.0.0.1', 'port': api_port,
+                        'run_mode': args.api_mode},
+                'MOCK': {'asset_ip': '127.0.0.1',
+                         'asset_port': args.stub_port},
+            })
+            self.mockapi = self.spawn('mockapi', MOCKAPI_MAIN, conf_file)
+            wait_port(self.mockapi, api_port, 30)
+            args.api = 'http://127.0.0.1:%s' % api_port
+
+    def bastion_conf(self, sessions):
+        args = self.args
+        api = args.api.rstrip('/')
+        record_path = os.path.join(self.workdir, 'record')
+        sections = {
+            'DEFAULT': {'log_dir': self.workdir,
+                        'log_file': 'lanus-%s.log' % sessions},
+            'SERVER': {'host': '127.0.0.1', 'port': args.port,
+                       'status_file': os.path.join(self.workdir, 'status')},
+            'RECORD': {'record_path': record_path,
+                       'index_file': os.path.join(record_path,
+                                                  'cmd_index.db')},
+            'INTF': {'totp_check_intf': api + '/totp',
+                     'user_check_intf': api + '/auth',
+                     'user_asset_intf': api + '/asset',
+                     'user_ldap_pass_intf': api + '/ldap/pass'},
+            'METRICS': {'port': free_port(),
+                        'trace_file': os.path.join(
+                            self.workdir, 'trace-%s.jsonl' % sessions)},
+        }
+        for option in args.set:
+            name, value = option.split('=', 1)
+            section, key = name.split('.', 1)
+            sections.setdefault(section, {})[key] = value
+        return self.write_conf('bastion-%s.conf' % sessions, sections)
+
+    def stop(self, proc, pids=()):
+        """SIGTERM the process and its children, SIGKILL them if it hangs.
+        """
+        for pid in [proc.pid] + [pid for pid in pids if pid != proc.pid]:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def run(self):
+        args = self.args
+        self.start_backends()
+        reports = []
+        try:
+            for sessions in args.sessions:
+                reports.append(self.run_level(sessions))
+                self.show(reports[-1])
+        finally:
+            if self.mockapi is not None:
+                self.stop(self.mockapi)
+        if args.json:
+            with open(args.json, 'w') as fp:
+                json.dump({'config_file': args.config_file, 'set': args.set,
+                           'reports': reports}, fp, indent=2)
+        print('\nlogs and login traces in: %s, see lanus-trace --file '
+              '%s/trace-<sessions>.jsonl' % (self.workdir, self.workdir))
+
+    def run_level(self, sessions):
+        args = self.args
+        args.port = args.bastion_port or free_port()
+        bastion = self.spawn('bastion', BASTION_MAIN, args.config_file,
+                             self.bastion_conf(sessions))
+        wait_port(bastion, args.port, 60)
+        # NOTE(等待预fork的worker就绪, 避免计入首批登录)
+        time.sleep(args.warmup)
+        sampler = ProcessSampler(bastion.pid)
+        sampler.sample()
+        sampler.start()
+
+        procs = min(args.procs, sessions)
+        names = ['%s%05d' % (args.user_prefix, i) for i in range(sessions)]
+        traffic = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        gate_size = max(1, args.concurrency // procs)
+        drivers = []
+        for i in range(procs):
+            proc = multiprocessing.Process(
+                target=drive,
+                args=(names[i::procs], args, gate_size, traffic, results))
+            proc.daemon = True
+            proc.start()
+            drivers.append(proc)
+
+        logins, done = 0, []
+        while len(done) < sessions:
+            try:
+                kind, result = results.get(timeout=args.timeout * 2)
+            except queue.Empty:
+                print('** %s sessions stalled, %s of them unfinished.'
+                      % (sessions, sessions - len(done)))
+                break
+            if kind == 'login':
+                logins += 1
+                if logins == sessions:
+                    traffic.set()
+            else:
+                done.append(result)
+        for proc in drivers:
+            proc.join(args.timeout)
+            if proc.is_alive():
+                proc.terminate()
+        sampler.stop()
+        self.stop(bastion, sampler.tree())
+        return self.summary(sessions, done, sampler.report())
+
+    def summary(self, sessions, results, processes):
+        logins = [result['login'] for result in results if 'login' in result]
+        latencies = sorted(end - begin for begin, end in logins)
+        rtts = sorted(rtt for result in results
+                      for rtt in result.get('rtts', []))
+        relays = [result['relay'] for result in results if 'relay' in result]
+        errors = {}
+        for result in results:
+            if 'error' in result:
+                error = result['error'][:80]
+                errors[error] = errors.get(error, 0) + 1
+
+        report = {'sessions': sessions, 'ok': len(logins),
+                  'failed': sessions - len(logins), 'errors': errors,
+                  'processes': processes}
+        if logins:
+            elapsed = (max(end for begin, end in logins) -
+                       min(begin for begin, end in logins))
+            report['logins_per_sec'] = len(logins) / elapsed \
+                if elapsed > 0 else None
+            report['login_ms'] = {
+                'p50': percentile(latencies, 50) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'max': latencies[-1] * 1000}
+        if rtts:
+            report['keystroke_ms'] = {
+                'p50': percentile(rtts, 50) * 1000,
+                'p99': percentile(rtts, 99) * 1000,
+                'max': rtts[-1] * 1000, 'count': len(rtts)}
+        if relays:
+            elapsed = (max(end for begin, end, size in relays) -
+                       min(begin for begin, end, size in relays))
+            total = sum(size for begin, end, size in relays)
+            report['relay_mb_per_sec'] = total / 1048576.0 / elapsed \
+                if elapsed > 0 else None
+        return report
+
+    def show(self, report):
+        def ms(name):
+            values = report.get(name)
+            if not values:
+                return '-'
+            return 'p50 %8.1f  p99 %8.1f  max %8.1f' % (
+                values['p50'], values['p99'], values['max'])
+
+        print('\n== %s sessions' % report['sessions'])
+        print('%-14s ok %s  failed %s  %s /s'
+              % ('logins', report['ok'], report['failed'],
+                 '%.1f' % report['logins_per_sec']
+                 if report.get('logins_per_sec') else '-'))
+        print('%-14s %s' % ('login ms', ms('login_ms')))
+        print('%-14s %s' % ('keystroke ms', ms('keystroke_ms')))
+        print('%-14s %s MB/s'
+              % ('relay', '%.1f' % report['relay_mb_per_sec']
+                 if report.get('relay_mb_per_sec') else '-'))
+        for error, count in sorted(report['errors'].items()):
+            print('%-14s %6s  %s' % ('error', count, error))
+        # NOTE(pool模式的worker可能有上百个, 只列出CPU最高的几个)
+        rows = report['processes']
+        children = sorted((row for row in rows if row['role'] == 'child'),
+                          key=lambda row: row['cpu'], reverse=True)
+        print('%-8s %-7s %8s %9s' % ('pid', 'role', 'cpu %', 'rss MB'))
+        for row in [row for row in rows if row['role'] == 'master'] + \
+                children[:self.args.top]:
+            print('%-8s %-7s %8.1f %9.1f'
+                  % (row['pid'], row['role'], row['cpu'], row['rss']))
+        if children:
+            print('%-8s %-7s %8.1f %9.1f'
+                  % (len(children), 'total', sum(row['cpu'] for row in rows),
+                     sum(row['rss'] for row in rows)))
+
+
+def raise_nofile(sessions):
+    """Every session holds a client, a bastion and a backend socket.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard != resource.RLIM_INFINITY and hard < sessions * 4:
+        print('** open files limit: %s is low for %s sessions.'
+              % (hard, sessions))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Concurrent session benchmark of lanus-bastion.')
+    parser.add_argument('--sessions', default='100,1000,5000',
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        help='comma separated concurrent session counts.')
+    parser.add_argument('--config-file',
+                        default=os.path.join(ROOT_PATH, 'etc', 'prod.conf'),
+                        help='bastion config, ports, paths and apis are '
+                             'overridden by the bench.')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='SECTION.key=value',
+                        help='override a bastion option, e.g. '
+                             'SERVER.mode=reactor, may repeat.')
+    parser.add_argument('--procs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='driver processes of the simulated users.')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='logins in flight at most.')
+    parser.add_argument('--keystrokes', type=int, default=20,
+                        help='keystrokes typed by every user.')
+    parser.add_argument('--think', type=float, default=0.05,
+                        help='seconds between two keystrokes.')
+    parser.add_argument('--relay-bytes', type=int, default=1048576,
+                        help='bytes of output read by every user.')
+    parser.add_argument('--host', default='0',
+                        help='option typed at the asset menu.')
+    parser.add_argument('--user-prefix', default='bench',
+                        help='simulated users are named prefix00000...')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds a session waits on any step.')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds between bastion startup and the load.')
+    parser.add_argument('--api', default=None,
+                        help='base url of a running api, default start '
+                             'lanus-mockapi.')
+    parser.add_argument('--api-mode', default='werkzeug',
+                        choices=('werkzeug', 'gunicorn'),
+                        help='run mode of lanus-mockapi.')
+    parser.add_argument('--stub-procs', type=int, default=2,
+                        help='stub sshd processes.')
+    parser.add_argument('--stub-port', type=int, default=0,
+                        help='stub sshd port, default a free one.')
+    parser.add_argument('--bastion-port', type=int, default=0,
+                        help='bastion port, default a free one.')
+    parser.add_argument('--top', type=int, default=8,
+                        help='busiest children listed in the report.')
+    parser.add_argument('--workdir', default=None,
+                        help='config, log and record directory.')
+    parser.add_argument('--json', default=None,
+                        help='also write the reports to this json file.')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    raise_nofile(max(args.sessions))
+    Bench(args).run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])